@@ -0,0 +1,759 @@
+import abc
+import sys
+import copy
+import json
+import argparse
+import threading
+import time
+import numpy as np
+from face_gallery import FaceGallery
+
+
+# ========== INDEX CHO GALLERY LỚN (flat / IVF / lượng tử hóa) ==========
+# Giao diện chung: add(key_id, vec) · remove(key_id) · search(query, k) · save(path) · len()
+# - "flat": quét toàn bộ, chính xác tuyệt đối → baseline để đo recall
+# - "ivf" : chia gallery thành nlist cụm (k-means), mỗi truy vấn chỉ quét nprobe cụm gần nhất,
+#           các ứng viên trong cụm được tính lại khoảng cách float32 chính xác rồi lấy top-k
+# - "sq8" / "pq": chỉ giữ mã uint8 trong RAM (vector đơn vị, khoảng cách cosine), xem _QuantizedIndex
+
+class FlatIndex(FaceGallery):
+    kind = "flat"
+
+    def build(self, keys, matrix):
+        return self.load(zip(keys, matrix))
+
+    def add(self, key_id, embedding):
+        self.upsert(key_id, embedding)
+
+    def refill(self, keys, matrix):
+        return self.build(keys, matrix)
+
+    def save(self, path):
+        with self._lock:
+            np.savez(path, kind=self.kind, params=json.dumps({}),
+                     keys=np.array(self._keys, dtype=str), vectors=self.matrix)
+
+    @classmethod
+    def from_arrays(cls, params, keys, vectors, **_):
+        return cls().build(list(keys), vectors)
+
+
+def _sq_dists(x, centroids, c_norms):
+    """Bình phương khoảng cách từ từng hàng x tới mọi centroid (ma trận len(x) x nlist)."""
+    d = np.einsum("ij,ij->i", x, x)[:, None] - 2.0 * (x @ centroids.T) + c_norms[None, :]
+    np.maximum(d, 0.0, out=d)
+    return d
+
+
+def _assign(matrix, centroids, chunk=65536):
+    c_norms = np.einsum("ij,ij->i", centroids, centroids)
+    out = np.empty(matrix.shape[0], dtype=np.int32)
+    for s in range(0, matrix.shape[0], chunk):
+        out[s:s + chunk] = np.argmin(_sq_dists(matrix[s:s + chunk], centroids, c_norms), axis=1)
+    return out
+
+
+def train_kmeans(matrix, nlist, iters=20, sample=64, seed=0):
+    """k-means Lloyd trên một mẫu (tối đa nlist * sample điểm) → centroids float32 (nlist x d)."""
+    rng = np.random.default_rng(seed)
+    n = matrix.shape[0]
+    nlist = max(1, min(nlist, n))
+    if n > nlist * sample:
+        matrix = matrix[rng.choice(n, nlist * sample, replace=False)]
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    centroids = matrix[rng.choice(matrix.shape[0], nlist, replace=False)].copy()
+    for _ in range(iters):
+        assign = _assign(matrix, centroids)
+        counts = np.bincount(assign, minlength=nlist)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, matrix)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        if empty.any():   # cụm rỗng → lấy lại điểm ngẫu nhiên
+            centroids[empty] = matrix[rng.choice(matrix.shape[0], int(empty.sum()), replace=False)]
+    return centroids
+
+
+class IVFIndex:
+    """
+    Inverted-file index (IVF-Flat).
+    nlist      : số cụm thô (~ sqrt(N) tới 4*sqrt(N))
+    nprobe     : số cụm quét mỗi truy vấn — tăng nprobe → recall cao hơn, chậm hơn
+    train_iters: số vòng k-means khi build
+    normalized : centroids được train trên vector đơn vị (lưu cùng index; file cũ không có → False)
+    """
+    kind = "ivf"
+
+    def __init__(self, nlist=256, nprobe=8, train_iters=20, seed=0, normalized=False):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.train_iters = train_iters
+        self.seed = seed
+        self.normalized = normalized
+        self.dim = None
+        self.centroids = None
+        self._lock = threading.RLock()
+        self._reset_storage()
+
+    def _reset_storage(self, capacity=0):
+        self._vecs = np.empty((capacity, self.dim or 0), dtype=np.float32)
+        self._norms = np.empty(capacity, dtype=np.float32)
+        self._alive = np.zeros(capacity, dtype=bool)
+        self._size = 0
+        self._keys = []
+        self._row_of = {}
+        self._lists = [[] for _ in range(self.nlist)]
+        self._list_cache = {}
+        self._dead = 0
+
+    def __len__(self):
+        return len(self._row_of)
+
+    def __contains__(self, key_id):
+        return key_id in self._row_of
+
+    @property
+    def params(self):
+        return {"nlist": self.nlist, "nprobe": self.nprobe, "train_iters": self.train_iters, "seed": self.seed,
+                "normalized": self.normalized}
+
+    # ---------- build / cập nhật ----------
+    def build(self, keys, matrix):
+        matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        with self._lock:
+            self.dim = matrix.shape[1]
+            self.centroids = train_kmeans(matrix, self.nlist, self.train_iters, seed=self.seed)
+            self.nlist = self.centroids.shape[0]
+            self._fill(list(keys), matrix)
+        return self
+
+    def refill(self, keys, matrix):
+        """Nạp lại toàn bộ vector với centroids hiện có (không train lại k-means)."""
+        with self._lock:
+            self._fill(list(keys), np.ascontiguousarray(matrix, dtype=np.float32))
+        return self
+
+    def _fill(self, keys, matrix):
+        self._reset_storage(capacity=max(len(keys), 1))
+        n = len(keys)
+        if not n:
+            return
+        self._vecs[:n] = matrix
+        self._norms[:n] = np.einsum("ij,ij->i", matrix, matrix)
+        self._alive[:n] = True
+        self._size = n
+        self._keys = list(keys)
+        self._row_of = {k: i for i, k in enumerate(keys)}
+        assign = _assign(matrix, self.centroids)
+        order = np.argsort(assign, kind="stable")
+        bounds = np.searchsorted(assign[order], np.arange(self.nlist + 1))
+        for c in range(self.nlist):
+            self._lists[c] = order[bounds[c]:bounds[c + 1]].tolist()
+
+    def _grow(self):
+        cap = max(1024, 2 * self._vecs.shape[0])
+        vecs = np.empty((cap, self.dim), dtype=np.float32)
+        norms = np.empty(cap, dtype=np.float32)
+        alive = np.zeros(cap, dtype=bool)
+        vecs[:self._size] = self._vecs[:self._size]
+        norms[:self._size] = self._norms[:self._size]
+        alive[:self._size] = self._alive[:self._size]
+        self._vecs, self._norms, self._alive = vecs, norms, alive
+
+    def add(self, key_id, embedding):
+        """Thêm/thay vector: gán vào cụm gần nhất (không train lại)."""
+        if self.centroids is None:
+            raise RuntimeError("IVFIndex chưa được build/train.")
+        vec = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        with self._lock:
+            self.remove(key_id)
+            if self._size >= self._vecs.shape[0]:
+                self._grow()
+            row = self._size
+            self._size += 1
+            self._vecs[row] = vec
+            self._norms[row] = float(vec @ vec)
+            self._alive[row] = True
+            self._keys.append(key_id)
+            self._row_of[key_id] = row
+            c = int(_assign(vec[None, :], self.centroids)[0])
+            self._lists[c].append(row)
+            self._list_cache.pop(c, None)
+
+    upsert = add
+
+    def remove(self, key_id):
+        with self._lock:
+            row = self._row_of.pop(key_id, None)
+            if row is None:
+                return False
+            self._alive[row] = False
+            self._dead += 1
+            if self._dead > max(1024, self._size // 4):
+                self.compact()
+            return True
+
+    def compact(self):
+        """Bỏ các hàng đã xóa/thay thế (giữ nguyên centroids)."""
+        with self._lock:
+            rows = np.flatnonzero(self._alive[:self._size])
+            keys = [self._keys[r] for r in rows]
+            self._fill(keys, self._vecs[rows].copy())
+
+    # ---------- truy vấn ----------
+    def _list_array(self, c):
+        arr = self._list_cache.get(c)
+        if arr is None:
+            arr = np.asarray(self._lists[c], dtype=np.int64)
+            self._list_cache[c] = arr
+        return arr
+
+    def search(self, query, k=1, nprobe=None):
+        q = np.asarray(query, dtype=np.float32).reshape(-1)
+        with self._lock:
+            if not len(self) or k <= 0:
+                return []
+            nprobe = max(1, min(nprobe or self.nprobe, self.nlist))
+            cd = ((self.centroids - q) ** 2).sum(axis=1)
+            probe = np.argpartition(cd, nprobe - 1)[:nprobe] if nprobe < self.nlist else np.arange(self.nlist)
+            cand = np.concatenate([self._list_array(int(c)) for c in probe])
+            cand = cand[self._alive[cand]]
+            if not cand.size:
+                return []
+            # Re-rank chính xác (float32) trên các ứng viên của nprobe cụm
+            d2 = self._norms[cand] - 2.0 * (self._vecs[cand] @ q) + float(q @ q)
+            np.maximum(d2, 0.0, out=d2)
+            k = min(k, cand.size)
+            top = np.argpartition(d2, k - 1)[:k]
+            top = top[np.argsort(d2[top], kind="stable")]
+            return [(self._keys[cand[i]], float(np.sqrt(d2[i]))) for i in top]
+
+    # ---------- lưu / nạp ----------
+    def save(self, path):
+        with self._lock:
+            rows = np.flatnonzero(self._alive[:self._size])
+            np.savez(path, kind=self.kind, params=json.dumps(self.params),
+                     keys=np.array([self._keys[r] for r in rows], dtype=str),
+                     vectors=self._vecs[rows], centroids=self.centroids)
+
+    @classmethod
+    def from_arrays(cls, params, keys, vectors, centroids=None, **_):
+        index = cls(**params)
+        index.dim = vectors.shape[1]
+        index.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        index.nlist = index.centroids.shape[0]
+        index._fill(list(keys), np.ascontiguousarray(vectors, dtype=np.float32))
+        return index
+
+
+# ========== LƯỢNG TỬ HÓA (sq8 / pq) ==========
+# Gallery hàng triệu người: float32 128 chiều = 512 byte/người. Index lượng tử hóa chỉ giữ mã uint8:
+# - sq8: mỗi chiều 1 byte theo khoảng [min, max] đã train → 128 byte (4x)
+# - pq : chia vector thành m đoạn, mỗi đoạn 1 byte = chỉ số centroid trong codebook 256 phần tử
+#        → m byte (m=32: 16x, m=16: 32x)
+# Truy vấn: khoảng cách BẤT ĐỐI XỨNG (query float so với vector tái tạo từ mã) trên toàn bộ mã,
+# lấy `rerank` ứng viên tốt nhất rồi tính lại chính xác bằng vector float do rerank_source cung cấp
+# (vd. đọc đúng các key_id đó từ DB) → không cần giữ ma trận float trong RAM.
+
+class _QuantizedIndex(abc.ABC):
+    """
+    Phần chung của sq8/pq. Embedding phải là vector đơn vị; khoảng cách trả về là cosine (1 - x.q).
+    rerank       : số ứng viên re-rank chính xác (0 = chỉ dùng khoảng cách xấp xỉ)
+    rerank_source: callable(list key_id) -> {key_id: vector float}; None = không re-rank
+    trained_on   : số vector đã dùng để train codebook (lưu cùng index)
+    """
+    metric = "cosine"
+    _CHUNK = 65536
+
+    def __init__(self, rerank=32, seed=0, rerank_source=None, trained_on=0):
+        self.rerank = rerank
+        self.seed = seed
+        self.rerank_source = rerank_source
+        self.trained_on = trained_on
+        self.dim = None
+        self._lock = threading.RLock()
+        self._reset_storage()
+
+    # ---------- phần riêng của từng kiểu lượng tử hóa ----------
+    @property
+    @abc.abstractmethod
+    def params(self):
+        """Tham số khởi tạo, lưu cùng index (from_arrays gọi lại cls(**params))."""
+
+    @property
+    @abc.abstractmethod
+    def code_size(self):
+        """Số byte mã của mỗi vector."""
+
+    @property
+    @abc.abstractmethod
+    def trained(self):
+        """Đã có codebook chưa."""
+
+    @abc.abstractmethod
+    def _train(self, matrix):
+        """Học codebook từ ma trận vector đơn vị."""
+
+    @abc.abstractmethod
+    def _encode(self, matrix):
+        """Ma trận (n x dim) float32 -> mã (n x code_size) uint8."""
+
+    @abc.abstractmethod
+    def _scorer(self, q):
+        """Hàm codes (c x code_size) -> x̂.q (c,) cho query q cố định."""
+
+    @abc.abstractmethod
+    def _codebook_arrays(self):
+        """{tên: mảng} của codebook để np.savez."""
+
+    @abc.abstractmethod
+    def _set_codebook(self, **arrays):
+        """Nạp lại codebook từ các mảng của _codebook_arrays."""
+
+    # ---------- lưu trữ mã ----------
+    # key_id nằm trong MỘT mảng bytes độ rộng cố định (numpy "S") song song với _codes, tra bằng
+    # searchsorted theo thứ tự đã sắp _order (int32) của phần [0, _base); hàng thêm sau lần nạp/compact
+    # cuối nằm trong dict nhỏ _extra. Không giữ str/list/dict Python cho từng người — phần đó
+    # (~80 byte/người) lớn hơn cả mã pq.
+    def _reset_storage(self, capacity=0):
+        self._codes = np.empty((capacity, self.code_size), dtype=np.uint8)
+        self._alive = np.zeros(capacity, dtype=bool)
+        self._keys = np.empty(capacity, dtype="S1")
+        self._order = np.empty(0, dtype=np.int32)
+        self._base = 0
+        self._extra = {}            # key_id -> hàng, chỉ cho các hàng >= _base
+        self._size = 0
+        self._count = 0             # số hàng còn sống
+        self._dead = 0
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, key_id):
+        return self._row(key_id) is not None
+
+    @staticmethod
+    def _key_array(keys):
+        return np.array([k.encode("utf-8") if isinstance(k, str) else bytes(k) for k in keys], dtype=bytes)
+
+    def _row(self, key_id):
+        """Hàng còn sống của key_id, None nếu không có."""
+        row = self._extra.get(key_id)
+        if row is not None:
+            return row
+        needle = key_id.encode("utf-8")
+        if not self._base or len(needle) > self._keys.dtype.itemsize:
+            return None
+        # side="right": key_id trùng trong phần đã sắp → lấy hàng sau cùng (sắp ổn định)
+        pos = int(np.searchsorted(self._keys[:self._base], needle, side="right", sorter=self._order)) - 1
+        if pos < 0:
+            return None
+        row = int(self._order[pos])
+        return row if self._keys[row] == needle and self._alive[row] else None
+
+    @property
+    def keys(self):
+        with self._lock:
+            rows = np.flatnonzero(self._alive[:self._size])
+            return np.array([k.decode("utf-8") for k in self._keys[rows].tolist()], dtype=object)
+
+    def memory_stats(self):
+        """
+        Byte thực giữ cho mỗi người (mã + key_id + _order + cờ alive, kể cả phần dự trữ) so với riêng
+        vector float32 của FaceGallery (chưa tính key_id của FaceGallery → tỉ lệ là cận dưới).
+        """
+        with self._lock:
+            held = self._codes.nbytes + self._keys.nbytes + self._order.nbytes + self._alive.nbytes
+            held += sys.getsizeof(self._extra) + sum(sys.getsizeof(k) for k in self._extra)
+            per_identity = held / max(1, self._count)
+            key_bytes = self._keys.dtype.itemsize
+        float_bytes = 4 * (self.dim or 0)
+        return {"code_bytes": self.code_size, "key_bytes": key_bytes, "bytes_per_identity": per_identity,
+                "float_bytes": float_bytes, "ratio": float_bytes / max(per_identity, 1e-9),
+                "total_bytes": int(held)}
+
+    # ---------- build / cập nhật ----------
+    def train(self, matrix):
+        """Train codebook trên một mẫu (không thêm vector nào vào index)."""
+        matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        with self._lock:
+            self.dim = matrix.shape[1]
+            self._train(matrix)
+            self.trained_on = matrix.shape[0]
+        return self
+
+    def build(self, keys, matrix):
+        matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        with self._lock:
+            self.train(matrix)
+            self._fill(list(keys), matrix)
+        return self
+
+    def refill(self, keys, matrix):
+        """Mã hóa lại toàn bộ vector với codebook hiện có; chưa train → train trên chính dữ liệu này."""
+        matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        if not self.trained:
+            return self.build(keys, matrix)
+        with self._lock:
+            self._fill(list(keys), matrix)
+        return self
+
+    def load(self, items):
+        """Giống FaceGallery.load: dict {key_id: embedding} hoặc iterable (key_id, embedding)."""
+        if isinstance(items, dict):
+            items = items.items()
+        keys, vecs = [], []
+        for key_id, emb in items:
+            keys.append(key_id)
+            vecs.append(np.asarray(emb, dtype=np.float32).reshape(-1))
+        if not keys:
+            with self._lock:
+                self._reset_storage()
+            return self
+        return self.refill(keys, np.vstack(vecs))
+
+    def load_chunks(self, chunks, sample=None):
+        """
+        Nạp lại toàn bộ từ iterable (keys, ma trận) theo từng khối: chỉ một khối float nằm trong RAM.
+        sample: ma trận để train (lại) codebook trước khi mã hóa; None → giữ codebook hiện có
+        (chưa train thì train trên khối đầu tiên). Index được dựng riêng rồi thay một lần dưới lock,
+        nên truy vấn đang chạy vẫn dùng mã + codebook cũ nhất quán. Trả về số vector đã nạp.
+        """
+        staged = copy.copy(self)
+        staged._lock = threading.RLock()
+        if sample is not None:
+            staged.train(sample)
+        staged._reset_storage()
+        for keys, matrix in chunks:
+            matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+            if not staged.trained:
+                staged.train(matrix)
+                staged._reset_storage()
+            staged._append(keys, matrix)
+        staged._seal()
+        state = dict(vars(staged))
+        state.pop("_lock")
+        with self._lock:
+            self.__dict__.update(state)
+        return self._count
+
+    def _fill(self, keys, matrix):
+        self._reset_storage(capacity=max(len(keys), 1))
+        self._append(keys, matrix)
+        self._seal()
+
+    def _set_rows(self, codes, keys):
+        """Thay toàn bộ bằng mã + key_id (bytes) có sẵn — không cần vector float."""
+        n = keys.shape[0]
+        self._reset_storage(capacity=max(n, 1))
+        self._keys = self._keys.astype(keys.dtype)
+        self._codes[:n] = codes
+        self._keys[:n] = keys
+        self._alive[:n] = True
+        self._size = self._count = n
+        self._seal()
+
+    def _grow(self, need=0):
+        cap = max(1024, 2 * self._codes.shape[0], need)
+        codes = np.empty((cap, self.code_size), dtype=np.uint8)
+        alive = np.zeros(cap, dtype=bool)
+        keys = np.empty(cap, dtype=self._keys.dtype)
+        codes[:self._size] = self._codes[:self._size]
+        alive[:self._size] = self._alive[:self._size]
+        keys[:self._size] = self._keys[:self._size]
+        self._codes, self._alive, self._keys = codes, alive, keys
+
+    def _append(self, keys, matrix):
+        """Mã hóa và thêm một khối hàng mới vào cuối (chưa vào _order — xem _seal / add)."""
+        arr = self._key_array(keys)
+        n = arr.shape[0]
+        if not n:
+            return
+        if self._size + n > self._codes.shape[0]:
+            self._grow(self._size + n)
+        if arr.dtype.itemsize > self._keys.dtype.itemsize:
+            self._keys = self._keys.astype(arr.dtype)   # key_id dài hơn → nới độ rộng
+        s = self._size
+        for c in range(0, n, self._CHUNK):
+            e = min(c + self._CHUNK, n)
+            self._codes[s + c:s + e] = self._encode(matrix[c:e])
+        self._keys[s:s + n] = arr
+        self._alive[s:s + n] = True
+        self._size += n
+        self._count += n
+
+    def _seal(self):
+        """Sắp lại mọi key_id → tra bằng searchsorted; key_id trùng thì chỉ giữ hàng sau cùng."""
+        n = self._size
+        order = np.argsort(self._keys[:n], kind="stable").astype(np.int32)
+        if n > 1:
+            ordered = self._keys[order]
+            older = order[:-1][(ordered[1:] == ordered[:-1]) & self._alive[order[:-1]]]
+            self._alive[older] = False
+            self._count -= older.size
+            self._dead += older.size
+        self._order, self._base, self._extra = order, n, {}
+
+    def add(self, key_id, embedding):
+        """Thêm/thay vector bằng codebook hiện có (không train lại)."""
+        if not self.trained:
+            raise RuntimeError(f"{type(self).__name__} chưa được build/train.")
+        vec = np.asarray(embedding, dtype=np.float32).reshape(1, -1)
+        with self._lock:
+            self.remove(key_id)
+            row = self._size
+            self._append([key_id], vec)
+            self._extra[key_id] = row
+
+    upsert = add
+
+    def remove(self, key_id):
+        with self._lock:
+            row = self._extra.pop(key_id, None)
+            if row is None:
+                row = self._row(key_id)
+            if row is None:
+                return False
+            self._alive[row] = False
+            self._count -= 1
+            self._dead += 1
+            if self._dead > max(1024, self._size // 4):
+                self.compact()
+            return True
+
+    def compact(self):
+        """Bỏ các hàng đã xóa/thay thế — chỉ chép mã, không cần vector float."""
+        with self._lock:
+            rows = np.flatnonzero(self._alive[:self._size])
+            self._set_rows(self._codes[rows], self._keys[rows])
+
+    # ---------- truy vấn ----------
+    def search(self, query, k=1, rerank=None):
+        q = np.asarray(query, dtype=np.float32).reshape(-1)
+        norm = float(np.linalg.norm(q))
+        q = q / norm if norm > 0 else q
+        rerank = self.rerank if rerank is None else rerank
+        with self._lock:
+            alive = len(self)
+            if not alive or k <= 0:
+                return []
+            n = self._size
+            score, codes = self._scorer(q), self._codes[:n]
+            scores = np.empty(n, dtype=np.float32)
+            for s in range(0, n, self._CHUNK):
+                scores[s:s + self._CHUNK] = score(codes[s:s + self._CHUNK])
+            scores[~self._alive[:n]] = -np.inf
+            short = min(max(k, rerank), alive)
+            cand = np.argpartition(-scores, short - 1)[:short]
+            keys = [k.decode("utf-8") for k in self._keys[cand].tolist()]
+            dists = 1.0 - scores[cand]
+        # Re-rank chính xác ngoài lock (rerank_source có thể truy vấn DB)
+        exact = self.rerank_source(keys) if rerank and self.rerank_source is not None else {}
+        for i, key in enumerate(keys):
+            vec = exact.get(key)
+            if vec is not None:
+                dists[i] = 1.0 - float(np.asarray(vec, dtype=np.float32).reshape(-1) @ q)
+        np.maximum(dists, 0.0, out=dists)
+        k = min(k, len(keys))
+        top = np.argsort(dists, kind="stable")[:k]
+        return [(keys[i], float(dists[i])) for i in top]
+
+    # ---------- lưu / nạp ----------
+    def save(self, path):
+        with self._lock:
+            rows = np.flatnonzero(self._alive[:self._size])
+            np.savez(path, kind=self.kind, params=json.dumps(self.params),
+                     keys=self._keys[rows], codes=self._codes[rows], **self._codebook_arrays())
+
+    @classmethod
+    def from_arrays(cls, params, keys, codes, **codebook):
+        index = cls(**params)
+        index._set_codebook(**codebook)
+        with index._lock:
+            index._set_rows(np.asarray(codes, dtype=np.uint8), index._key_array(keys))
+        return index
+
+
+class SQ8Index(_QuantizedIndex):
+    """Lượng tử hóa vô hướng 8-bit theo từng chiều: x̂ = lo + code * scale."""
+    kind = "sq8"
+
+    def __init__(self, rerank=32, seed=0, rerank_source=None, trained_on=0):
+        self.lo = self.scale = None
+        super().__init__(rerank=rerank, seed=seed, rerank_source=rerank_source, trained_on=trained_on)
+
+    @property
+    def params(self):
+        return {"rerank": self.rerank, "seed": self.seed, "trained_on": self.trained_on}
+
+    @property
+    def code_size(self):
+        return self.dim or 0
+
+    @property
+    def trained(self):
+        return self.lo is not None
+
+    def _train(self, matrix):
+        lo, hi = matrix.min(axis=0), matrix.max(axis=0)
+        span = hi - lo
+        self.lo = lo.astype(np.float32)
+        self.scale = np.where(span > 0, span / 255.0, 1.0).astype(np.float32)
+
+    def _encode(self, matrix):
+        return np.clip(np.rint((matrix - self.lo) / self.scale), 0, 255).astype(np.uint8)
+
+    def _scorer(self, q):
+        base, w = float(q @ self.lo), q * self.scale
+        return lambda codes: base + codes.astype(np.float32) @ w
+
+    def _codebook_arrays(self):
+        return {"lo": self.lo, "scale": self.scale}
+
+    def _set_codebook(self, lo, scale):
+        self.lo = np.asarray(lo, dtype=np.float32)
+        self.scale = np.asarray(scale, dtype=np.float32)
+        self.dim = self.lo.shape[0]
+
+
+class PQIndex(_QuantizedIndex):
+    """
+    Product quantization: m đoạn con, mỗi đoạn một codebook ks (≤ 256) centroid train bằng k-means.
+    Khoảng cách bất đối xứng = tra bảng (m x ks) tích vô hướng query-đoạn với từng centroid.
+    """
+    kind = "pq"
+
+    def __init__(self, m=32, ks=256, train_iters=20, rerank=32, seed=0, rerank_source=None, trained_on=0):
+        if not 1 <= ks <= 256:
+            raise ValueError("ks phải trong khoảng 1..256 (mã 1 byte).")
+        self.m = m
+        self.ks = ks
+        self.train_iters = train_iters
+        self.codebooks = None      # (m x ks x dim/m)
+        super().__init__(rerank=rerank, seed=seed, rerank_source=rerank_source, trained_on=trained_on)
+
+    @property
+    def params(self):
+        return {"m": self.m, "ks": self.ks, "train_iters": self.train_iters, "rerank": self.rerank, "seed": self.seed,
+                "trained_on": self.trained_on}
+
+    @property
+    def code_size(self):
+        return self.m
+
+    @property
+    def trained(self):
+        return self.codebooks is not None
+
+    def _train(self, matrix):
+        d = matrix.shape[1]
+        if d % self.m:
+            raise ValueError(f"Số chiều {d} không chia hết cho m={self.m}.")
+        ds = d // self.m
+        ks = min(self.ks, matrix.shape[0])
+        books = np.zeros((self.m, ks, ds), dtype=np.float32)
+        for j in range(self.m):
+            books[j] = train_kmeans(matrix[:, j * ds:(j + 1) * ds], ks, self.train_iters, seed=self.seed + j)
+        self.codebooks = books
+
+    def _encode(self, matrix):
+        ds = self.codebooks.shape[2]
+        codes = np.empty((matrix.shape[0], self.m), dtype=np.uint8)
+        for j in range(self.m):
+            sub = np.ascontiguousarray(matrix[:, j * ds:(j + 1) * ds])
+            codes[:, j] = _assign(sub, self.codebooks[j])
+        return codes
+
+    def _scorer(self, q):
+        lut = np.einsum("jcd,jd->jc", self.codebooks, q.reshape(self.m, -1))   # (m x ks)
+        cols = np.arange(self.m)
+        return lambda codes: lut[cols, codes].sum(axis=1)
+
+    def _codebook_arrays(self):
+        return {"codebooks": self.codebooks}
+
+    def _set_codebook(self, codebooks):
+        self.codebooks = np.asarray(codebooks, dtype=np.float32)
+        self.m = self.codebooks.shape[0]
+        self.dim = self.m * self.codebooks.shape[2]
+
+
+INDEX_TYPES = {"flat": FlatIndex, "ivf": IVFIndex, "sq8": SQ8Index, "pq": PQIndex}
+
+
+def build_index(kind, keys, matrix, **params):
+    return INDEX_TYPES[kind](**params).build(keys, matrix)
+
+
+def load_index(path):
+    with np.load(path, allow_pickle=False) as z:
+        kind = str(z["kind"])
+        arrays = {name: z[name] for name in z.files if name not in ("kind", "params")}
+        params = json.loads(str(z["params"]))
+    arrays["keys"] = arrays["keys"].tolist()
+    return INDEX_TYPES[kind].from_arrays(params, **arrays)
+
+
+class _NoRerank:
+    """Bọc index lượng tử hóa để đo recall của riêng khoảng cách xấp xỉ."""
+
+    def __init__(self, index):
+        self.index = index
+
+    def search(self, query, k=1):
+        return self.index.search(query, k=k, rerank=0)
+
+
+def recall_at_k(index, baseline, queries, k=1):
+    """Tỉ lệ top-k của index trùng với top-k của baseline (flat) trên tập queries."""
+    hit = 0
+    for q in queries:
+        truth = {key for key, _ in baseline.search(q, k)}
+        hit += len(truth & {key for key, _ in index.search(q, k)})
+    return hit / max(1, len(queries) * k)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build/đánh giá ANN index cho face_embeddings")
+    parser.add_argument("--kind", choices=sorted(INDEX_TYPES), default="ivf")
+    parser.add_argument("--nlist", type=int, default=256)
+    parser.add_argument("--nprobe", type=int, default=8)
+    parser.add_argument("--m", type=int, default=32, help="pq: số đoạn con (byte mỗi vector)")
+    parser.add_argument("--rerank", type=int, default=32, help="sq8/pq: số ứng viên re-rank bằng float")
+    parser.add_argument("--out", default="face_ann_index.npz")
+    parser.add_argument("--eval", type=int, default=200, help="số truy vấn mẫu để đo recall@1 so với flat")
+    args = parser.parse_args()
+
+    from face_verify_pg import load_embeddings_from_db
+    data = load_embeddings_from_db()
+    keys = list(data)
+    matrix = np.vstack([data[k] for k in keys]).astype(np.float32)
+
+    t0 = time.perf_counter()
+    params = {
+        "ivf": {"nlist": args.nlist, "nprobe": args.nprobe, "normalized": True},   # load_embeddings_from_db đã chuẩn hóa
+        "sq8": {"rerank": args.rerank},
+        "pq": {"m": args.m, "rerank": args.rerank},
+    }.get(args.kind, {})
+    index = build_index(args.kind, keys, matrix, **params)
+    print(f"[ℹ️] Build {args.kind} cho {len(keys)} embeddings trong {time.perf_counter() - t0:.2f}s")
+    if hasattr(index, "memory_stats"):
+        mem = index.memory_stats()
+        print(f"[ℹ️] {mem['bytes_per_identity']:.0f} byte/người (mã {mem['code_bytes']} + key_id {mem['key_bytes']} "
+              f"+ tra cứu) thay vì {mem['float_bytes']} byte vector float (giảm {mem['ratio']:.1f}x), "
+              f"tổng {mem['total_bytes'] / 2**20:.1f} MiB")
+        index.rerank_source = lambda ks: {k: data[k] for k in ks}   # re-rank từ vector float đã nạp
+    index.save(args.out)
+    print(f"[✅] Đã lưu index tại {args.out}")
+
+    if args.eval and keys:
+        flat = build_index("flat", keys, matrix)
+        rng = np.random.default_rng(0)
+        queries = matrix[rng.choice(len(keys), min(args.eval, len(keys)), replace=False)]
+        queries = queries + rng.normal(scale=0.05, size=queries.shape).astype(np.float32)
+        t0 = time.perf_counter()
+        r = recall_at_k(index, flat, queries, k=1)
+        print(f"[ℹ️] recall@1 = {r:.3f}  ({(time.perf_counter() - t0) / len(queries) * 1000:.2f} ms/truy vấn gồm cả flat)")
+        if hasattr(index, "rerank_source"):
+            r0 = recall_at_k(_NoRerank(index), flat, queries, k=1)
+            print(f"[ℹ️] recall@1 không re-rank (chỉ khoảng cách trên mã) = {r0:.3f}")
@@ -0,0 +1,139 @@
+import os
+import csv
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+
+from embedding_service import get_embedding_service
+from embedding_pool import EmbeddingPool
+from face_register_pg import insert_embeddings_batch
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".bmp")
+
+
+# ========== ĐỌC DANH SÁCH ẢNH ==========
+def read_manifest(source):
+    """
+    Trả về [(ma_truong, ma_sv, image_path)] từ:
+    - file CSV có cột ma_truong, ma_sv, image_path (đường dẫn tương đối tính theo thư mục CSV)
+    - thư mục ảnh đặt tên {ma_truong}_{ma_sv}.jpg
+    """
+    items = []
+    if os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            stem, ext = os.path.splitext(name)
+            if ext.lower() not in IMAGE_EXTS or "_" not in stem:
+                continue
+            ma_truong, ma_sv = stem.split("_", 1)
+            items.append((ma_truong, ma_sv, os.path.join(source, name)))
+    else:
+        base = os.path.dirname(os.path.abspath(source))
+        with open(source, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                path = row["image_path"].strip()
+                if not os.path.isabs(path):
+                    path = os.path.join(base, path)
+                items.append((row["ma_truong"].strip(), row["ma_sv"].strip(), path))
+    return items
+
+
+def _decode(path):
+    img = cv2.imread(path)
+    if img is None:
+        raise ValueError("không đọc được ảnh")
+    return img
+
+
+# ========== ENROLL THEO LÔ ==========
+def enroll_batch(items, batch_size=32, workers=8, embed_fn=None):
+    """
+    Đăng ký hàng loạt:
+    - giải mã ảnh bằng thread pool (lô kế tiếp được đọc trong lúc lô hiện tại chạy model)
+    - detect + embedding theo lô cố định (EmbeddingService.represent_batch)
+    - ghi DB một câu execute_values mỗi lô
+    embed_fn: hàm nhận list ảnh → list embedding (mặc định: EmbeddingService dùng chung)
+    """
+    embed_fn = embed_fn or get_embedding_service().represent_batch
+    report = {"total": len(items), "ok": 0, "failed": [], "seconds": 0.0,
+              "stage_seconds": {"decode": 0.0, "embed": 0.0, "db": 0.0}}
+    t_start = time.perf_counter()
+    batches = [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = [pool.submit(_decode, path) for _, _, path in batches[0]] if batches else []
+        for b, batch in enumerate(batches):
+            t0 = time.perf_counter()
+            images = []
+            for (ma_truong, ma_sv, path), fut in zip(batch, pending):
+                try:
+                    images.append(fut.result())
+                except Exception as e:
+                    images.append(None)
+                    report["failed"].append((f"{ma_truong}_{ma_sv}", path, str(e)))
+            report["stage_seconds"]["decode"] += time.perf_counter() - t0
+            # đọc trước lô sau trong lúc model chạy lô này
+            if b + 1 < len(batches):
+                pending = [pool.submit(_decode, path) for _, _, path in batches[b + 1]]
+
+            t0 = time.perf_counter()
+            embeddings = embed_fn(images)
+            report["stage_seconds"]["embed"] += time.perf_counter() - t0
+
+            rows = []
+            for (ma_truong, ma_sv, path), img, emb in zip(batch, images, embeddings):
+                if img is None:
+                    continue
+                key_id = f"{ma_truong}_{ma_sv}"
+                if emb is None:
+                    report["failed"].append((key_id, path, "không lấy được embedding"))
+                    continue
+                rows.append((ma_truong, ma_sv, key_id, emb, path))
+
+            t0 = time.perf_counter()
+            try:
+                report["ok"] += insert_embeddings_batch(rows)
+            except Exception as e:
+                for _, _, key_id, _, path in rows:
+                    report["failed"].append((key_id, path, f"lỗi DB: {e}"))
+            report["stage_seconds"]["db"] += time.perf_counter() - t0
+
+            done = min((b + 1) * batch_size, len(items))
+            print(f"[ℹ️] {done}/{len(items)} ảnh đã xử lý ({report['ok']} thành công)")
+
+    report["seconds"] = time.perf_counter() - t_start
+    return report
+
+
+def print_report(report):
+    secs = report["seconds"] or 1e-9
+    print("=== KẾT QUẢ ĐĂNG KÝ HÀNG LOẠT ===")
+    print(f"Tổng: {report['total']} | Thành công: {report['ok']} | Lỗi: {len(report['failed'])}")
+    print(f"Thời gian: {report['seconds']:.1f}s | Tốc độ: {report['total'] / secs:.1f} ảnh/giây")
+    print("Theo giai đoạn: " + ", ".join(f"{k}={v:.1f}s" for k, v in report["stage_seconds"].items()))
+    for key_id, path, reason in report["failed"]:
+        print(f"  [❌] {key_id} ({path}): {reason}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Đăng ký khuôn mặt hàng loạt từ thư mục hoặc CSV")
+    parser.add_argument("source", help="thư mục ảnh {ma_truong}_{ma_sv}.jpg hoặc CSV (ma_truong, ma_sv, image_path)")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=8, help="số thread giải mã ảnh")
+    parser.add_argument("--processes", type=int, default=0, help="số process chạy model (0 = trong process hiện tại)")
+    parser.add_argument("--threads-per-process", type=int, default=1)
+    args = parser.parse_args()
+
+    items = read_manifest(args.source)
+    if not items:
+        print("❌ Không tìm thấy ảnh nào.")
+        exit()
+    if args.processes > 0:
+        with EmbeddingPool(workers=args.processes, intra_op_threads=args.threads_per_process) as pool:
+            pool.warm_up()
+            # mỗi lô được chia đều cho các process → nên đặt batch-size >= processes
+            print_report(enroll_batch(items, batch_size=args.batch_size, workers=args.workers,
+                                      embed_fn=pool.represent_batch))
+    else:
+        get_embedding_service().warm_up()
+        print_report(enroll_batch(items, batch_size=args.batch_size, workers=args.workers))
@@ -0,0 +1,159 @@
+import os
+import hashlib
+import csv
+import time
+import argparse
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from rsq_mappingid import read_certificate, load_or_generate_keys, generate_keys, sign_digest
+from certificate_store import upsert_certificates_batch
+
+CERT_EXTS = (".txt",)
+IN_FLIGHT_PER_PROCESS = 4   # số văn bằng chờ/đang ký tối đa mỗi process → bộ nhớ không tăng theo N
+
+
+# ========== ĐỌC DANH SÁCH VĂN BẰNG ==========
+def read_manifest(source):
+    """
+    Trả về [(school_code, student_id, path)] từ:
+    - file CSV có cột school_code, student_id, path (đường dẫn tương đối tính theo thư mục CSV)
+    - thư mục file văn bằng đặt tên {school_code}_{student_id}.txt
+    """
+    items = []
+    if os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            stem, ext = os.path.splitext(name)
+            if ext.lower() not in CERT_EXTS or "_" not in stem:
+                continue
+            school_code, student_id = stem.split("_", 1)
+            items.append((school_code, student_id, os.path.join(source, name)))
+    else:
+        base = os.path.dirname(os.path.abspath(source))
+        with open(source, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                path = row["path"].strip()
+                if not os.path.isabs(path):
+                    path = os.path.join(base, path)
+                items.append((row["school_code"].strip(), row["student_id"].strip(), path))
+    return items
+
+
+# ========== WORKER (chạy trong process con) ==========
+def _sign_one(school_code, student_id, path, reuse_keys, save_dir):
+    """Đọc → (sinh khóa) → ký một văn bằng. Trả về (row, {giai đoạn: giây})."""
+    timings = {}
+    t0 = time.perf_counter()
+    certificate_text, cleaned_text, message = read_certificate(path)
+    digest = hashlib.sha256(message).digest()
+    t1 = time.perf_counter()
+    timings["read"] = t1 - t0
+
+    if reuse_keys:
+        identifier, pem_public = load_or_generate_keys(school_code, student_id, save_dir)
+    else:
+        identifier, pem_public = generate_keys(school_code, student_id, save_dir)
+    t2 = time.perf_counter()
+    timings["keys"] = t2 - t1
+
+    signature = sign_digest(identifier, digest, save_dir)
+    timings["sign"] = time.perf_counter() - t2
+
+    row = (identifier, school_code, student_id, certificate_text, cleaned_text, message, signature, pem_public, digest)
+    return row, timings
+
+
+# ========== PHÁT HÀNH THEO LÔ ==========
+def issue_batch(items, processes=None, batch_size=200, reuse_keys=True, save_dir="keys"):
+    """
+    Phát hành hàng loạt:
+    - đọc + ký RSA-PSS (CPU-bound) trên pool process "spawn"
+    - ghi DB một câu execute_values mỗi batch_size văn bằng
+    reuse_keys=True → dùng lại private key đã có trong save_dir, chỉ sinh khóa khi chưa có
+    stage_seconds của read/keys/sign là tổng thời gian cộng dồn trên các process.
+    Chỉ giữ tối đa processes * IN_FLIGHT_PER_PROCESS future cùng lúc (nộp thêm khi có kết quả).
+    """
+    processes = processes or os.cpu_count() or 1
+    # mỗi identifier chỉ một lần: hai process không được ghi cùng một file khóa
+    unique = list({f"{s}_{m}": (s, m, p) for s, m, p in items}.values())
+    report = {"total": len(unique), "duplicates": len(items) - len(unique), "ok": 0, "failed": [],
+              "seconds": 0.0, "stage_seconds": {"read": 0.0, "keys": 0.0, "sign": 0.0, "db": 0.0}}
+    t_start = time.perf_counter()
+
+    def flush(rows):
+        t0 = time.perf_counter()
+        try:
+            saved, duplicates = upsert_certificates_batch(rows)
+            report["ok"] += saved
+            for identifier, owner in duplicates:   # cùng file đã được cấp cho identifier khác
+                report["failed"].append((identifier, path_of.get(identifier, ""), f"trùng nội dung với {owner}"))
+        except Exception as e:
+            for row in rows:
+                report["failed"].append((row[0], "", f"lỗi DB: {e}"))
+        report["stage_seconds"]["db"] += time.perf_counter() - t0
+
+    rows = []
+    path_of = {}
+    done = 0
+
+    def consume(entry):
+        nonlocal rows, done
+        (school_code, student_id, path), fut = entry
+        done += 1
+        try:
+            row, timings = fut.result()
+        except Exception as e:
+            report["failed"].append((f"{school_code}_{student_id}", path, str(e)))
+        else:
+            for k, v in timings.items():
+                report["stage_seconds"][k] += v
+            rows.append(row)
+            path_of[row[0]] = path
+        if len(rows) >= batch_size:
+            flush(rows)
+            rows = []
+            print(f"[ℹ️] {done}/{len(unique)} văn bằng đã xử lý ({report['ok']} đã lưu)")
+
+    in_flight = deque()
+    max_in_flight = processes * IN_FLIGHT_PER_PROCESS
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn")) as pool:
+        for item in unique:
+            in_flight.append((item, pool.submit(_sign_one, *item, reuse_keys, save_dir)))
+            if len(in_flight) >= max_in_flight:
+                consume(in_flight.popleft())
+        while in_flight:
+            consume(in_flight.popleft())
+    if rows:
+        flush(rows)
+
+    report["seconds"] = time.perf_counter() - t_start
+    return report
+
+
+def print_report(report):
+    secs = report["seconds"] or 1e-9
+    print("=== KẾT QUẢ PHÁT HÀNH HÀNG LOẠT ===")
+    print(f"Tổng: {report['total']} | Thành công: {report['ok']} | Lỗi: {len(report['failed'])}"
+          f" | Trùng identifier (bỏ qua): {report['duplicates']}")
+    print(f"Thời gian: {report['seconds']:.1f}s | Tốc độ: {report['total'] / secs:.1f} văn bằng/giây")
+    print("Theo giai đoạn: " + ", ".join(f"{k}={v:.1f}s" for k, v in report["stage_seconds"].items()))
+    for identifier, path, reason in report["failed"]:
+        print(f"  [❌] {identifier} ({path}): {reason}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Phát hành (ký + lưu) văn bằng hàng loạt từ thư mục hoặc CSV")
+    parser.add_argument("source", help="thư mục {school_code}_{student_id}.txt hoặc CSV (school_code, student_id, path)")
+    parser.add_argument("--processes", type=int, default=0, help="số process ký (0 = số core)")
+    parser.add_argument("--batch-size", type=int, default=200, help="số dòng mỗi câu upsert")
+    parser.add_argument("--keys-dir", default="keys")
+    parser.add_argument("--new-keys", action="store_true", help="luôn sinh cặp khóa mới (mặc định dùng lại khóa đã có)")
+    args = parser.parse_args()
+
+    items = read_manifest(args.source)
+    if not items:
+        print("❌ Không tìm thấy văn bằng nào.")
+        exit()
+    print_report(issue_batch(items, processes=args.processes or None, batch_size=args.batch_size,
+                             reuse_keys=not args.new_keys, save_dir=args.keys_dir))
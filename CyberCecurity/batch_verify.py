@@ -0,0 +1,147 @@
+import os
+import csv
+import json
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from rsq_mappingid import verify_file
+from certificate_store import fetch_signatures
+
+CERT_EXTS = (".txt",)
+RESULT_FIELDS = ("identifier", "path", "verdict", "detail", "seconds")
+
+
+# ========== ĐỌC DANH SÁCH CẦN XÁC THỰC ==========
+def read_manifest(source):
+    """
+    Trả về [(identifier, path)] từ:
+    - file CSV có cột identifier, path (đường dẫn tương đối tính theo thư mục CSV)
+    - thư mục file đặt tên {identifier}.txt
+    """
+    items = []
+    if os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            stem, ext = os.path.splitext(name)
+            if ext.lower() in CERT_EXTS:
+                items.append((stem, os.path.join(source, name)))
+    else:
+        base = os.path.dirname(os.path.abspath(source))
+        with open(source, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                path = row["path"].strip()
+                if not os.path.isabs(path):
+                    path = os.path.join(base, path)
+                items.append((row["identifier"].strip(), path))
+    return items
+
+
+# ========== WORKER ==========
+def _verify_one(identifier, path, record):
+    """Một dòng kết quả: verdict = valid | invalid | not_issued | error."""
+    t0 = time.perf_counter()
+    if record is None:
+        verdict, detail = "not_issued", "chưa phát hành certificate cho identifier này"
+    else:
+        try:
+            public_key_pem, signature = record
+            if verify_file(public_key_pem, signature, path):   # SHA-256 theo luồng, không nạp cả file
+                verdict, detail = "valid", ""
+            else:
+                verdict, detail = "invalid", "nội dung không khớp chữ ký"
+        except Exception as e:
+            verdict, detail = "error", str(e)
+    return {"identifier": identifier, "path": path, "verdict": verdict, "detail": detail,
+            "seconds": time.perf_counter() - t0}
+
+
+def _verify_chunk(jobs):
+    # public key đã parse được KEY_STORE trong process này dùng lại giữa các dòng cùng khóa
+    return [_verify_one(*job) for job in jobs]
+
+
+# ========== XÁC THỰC HÀNG LOẠT ==========
+def verify_batch(items, processes=None, chunk_size=None):
+    """
+    Xác thực nhiều cặp (identifier, file):
+    - lấy public_key + signature của tất cả identifier bằng MỘT câu WHERE identifier = ANY(%s)
+    - đọc file + verify RSA-PSS theo từng khúc trên pool process "spawn" (processes=1 → chạy tại chỗ)
+    Trả về (results, stats); results giữ nguyên thứ tự đầu vào.
+    """
+    processes = processes or os.cpu_count() or 1
+    t_start = time.perf_counter()
+    records = fetch_signatures(identifier for identifier, _ in items)
+    t_fetch = time.perf_counter() - t_start
+
+    jobs = [(identifier, path, records.get(identifier)) for identifier, path in items]
+    if processes <= 1 or len(jobs) <= 1:
+        results = _verify_chunk(jobs)
+    else:
+        # vài khúc mỗi process: đủ cân bằng tải mà không tốn IPC cho từng dòng
+        chunk_size = chunk_size or max(1, -(-len(jobs) // (processes * 4)))
+        chunks = [jobs[i:i + chunk_size] for i in range(0, len(jobs), chunk_size)]
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn")) as pool:
+            results = [r for part in pool.map(_verify_chunk, chunks) for r in part]
+
+    stats = summarize(results, time.perf_counter() - t_start, t_fetch)
+    return results, stats
+
+
+def summarize(results, seconds, fetch_seconds):
+    per_item = np.array([r["seconds"] for r in results]) if results else np.zeros(1)
+    counts = {}
+    for r in results:
+        counts[r["verdict"]] = counts.get(r["verdict"], 0) + 1
+    return {
+        "total": len(results),
+        "verdicts": counts,
+        "seconds": seconds,
+        "fetch_seconds": fetch_seconds,
+        "items_per_second": len(results) / (seconds or 1e-9),
+        "item_ms": {"mean": float(per_item.mean() * 1000), "p50": float(np.percentile(per_item, 50) * 1000),
+                    "p95": float(np.percentile(per_item, 95) * 1000), "max": float(per_item.max() * 1000)},
+    }
+
+
+# ========== XUẤT KẾT QUẢ ==========
+def write_results(results, stats, out_path):
+    """Ghi bảng kết quả: .json → {"stats", "results"}; còn lại → CSV (kèm file .stats.json)."""
+    if out_path.lower().endswith(".json"):
+        with open(out_path, "w", encoding="utf-8") as f:
+            json.dump({"stats": stats, "results": results}, f, ensure_ascii=False, indent=2)
+        return
+    with open(out_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+        writer.writeheader()
+        for r in results:
+            writer.writerow({**r, "seconds": f"{r['seconds']:.6f}"})
+    with open(os.path.splitext(out_path)[0] + ".stats.json", "w", encoding="utf-8") as f:
+        json.dump(stats, f, ensure_ascii=False, indent=2)
+
+
+def print_stats(stats):
+    print("=== KẾT QUẢ XÁC THỰC HÀNG LOẠT ===")
+    print(f"Tổng: {stats['total']} | " + " | ".join(f"{k}: {v}" for k, v in sorted(stats["verdicts"].items())))
+    print(f"Thời gian: {stats['seconds']:.2f}s (truy vấn DB {stats['fetch_seconds']:.2f}s)"
+          f" | Tốc độ: {stats['items_per_second']:.1f} file/giây")
+    print("Mỗi file (ms): " + ", ".join(f"{k}={v:.2f}" for k, v in stats["item_ms"].items()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Xác thực văn bằng hàng loạt từ thư mục hoặc CSV")
+    parser.add_argument("source", help="thư mục {identifier}.txt hoặc CSV (identifier, path)")
+    parser.add_argument("-o", "--output", default="verify_results.csv", help="file kết quả .csv hoặc .json")
+    parser.add_argument("--processes", type=int, default=0, help="số process (0 = số core, 1 = không dùng pool)")
+    args = parser.parse_args()
+
+    items = read_manifest(args.source)
+    if not items:
+        print("❌ Không có file nào cần xác thực.")
+        exit()
+    results, stats = verify_batch(items, processes=args.processes or None)
+    write_results(results, stats, args.output)
+    print_stats(stats)
+    print(f"[✅] Đã ghi kết quả vào {args.output}")
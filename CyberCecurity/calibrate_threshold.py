@@ -0,0 +1,125 @@
+import os
+import csv
+import json
+import argparse
+from datetime import datetime
+import numpy as np
+
+from embedding_codec import decode_normalized, decode_header, is_encoded, l2_normalize, DEFAULT_MODEL
+from db import transaction
+
+
+# ========== HIỆU CHỈNH NGƯỠNG SO KHỚP KHUÔN MẶT ==========
+# Cặp impostor: embedding của hai key_id KHÁC nhau trong face_embeddings (mỗi dòng là một người)
+#   → FAR(t) = tỉ lệ cặp impostor có khoảng cách cosine < t.
+# Cặp genuine (tuỳ chọn): CSV key_id,image_path gồm ảnh MỚI của người đã đăng ký
+#   → FRR(t) = tỉ lệ ảnh có khoảng cách tới embedding của chính mình >= t.
+# Ngưỡng chọn = lớn nhất mà FAR ≤ far_target; lưu cùng model/metric để face_verify_pg chỉ áp dụng
+# khi dữ liệu đang dùng cùng loại.
+
+def load_sample(limit=2000):
+    """(keys, ma trận vector đơn vị, model) — tối đa limit dòng lấy ngẫu nhiên ngay trên server."""
+    with transaction() as cur:
+        cur.execute("""
+            SELECT key_id, embedding FROM face_embeddings
+            WHERE embedding IS NOT NULL
+            ORDER BY random()
+            LIMIT %s
+        """, (limit,))
+        rows = cur.fetchall()
+    models = {decode_header(blob)["model"] if is_encoded(blob) else DEFAULT_MODEL for _, blob in rows}
+    if len(models) > 1:
+        raise ValueError(f"Mẫu trộn nhiều model embedding: {sorted(models)}")
+    keys = [key for key, _ in rows]
+    matrix = np.vstack([decode_normalized(blob) for _, blob in rows]) if rows else np.empty((0, 0), np.float32)
+    return keys, matrix.astype(np.float32, copy=False), (models.pop() if models else DEFAULT_MODEL)
+
+
+def impostor_distances(matrix, chunk=1024):
+    """Khoảng cách cosine của mọi cặp (i < j) — theo khối để không dựng cả ma trận N x N."""
+    n = matrix.shape[0]
+    parts = []
+    for s in range(0, n, chunk):
+        block = 1.0 - matrix[s:s + chunk] @ matrix.T           # (chunk x N)
+        rows = np.arange(s, min(s + chunk, n))[:, None]
+        parts.append(block[np.arange(n)[None, :] > rows])        # chỉ nửa trên đường chéo
+    return np.concatenate(parts) if parts else np.empty(0, np.float32)
+
+
+def genuine_distances(csv_path, keys, matrix):
+    """Khoảng cách từ ảnh mới (CSV key_id,image_path) tới embedding đã đăng ký của cùng key_id."""
+    from face_verify_pg import get_embedding
+
+    row_of = {key: i for i, key in enumerate(keys)}
+    dists, skipped = [], 0
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        for rec in csv.DictReader(f):
+            i = row_of.get(rec["key_id"].strip())
+            emb = get_embedding(rec["image_path"].strip()) if i is not None else None
+            if emb is None:
+                skipped += 1
+                continue
+            dists.append(1.0 - float(matrix[i] @ l2_normalize(emb)))
+    if skipped:
+        print(f"[⚠️] Bỏ qua {skipped} ảnh genuine (không có key_id trong mẫu hoặc không lấy được embedding)")
+    return np.asarray(dists, dtype=np.float32)
+
+
+def pick_threshold(impostor, far_target):
+    """Ngưỡng lớn nhất t sao cho tỉ lệ impostor có khoảng cách < t không vượt far_target."""
+    if not impostor.size:
+        raise ValueError("Cần ít nhất 2 embedding để tạo cặp impostor.")
+    ordered = np.sort(impostor)
+    allowed = int(np.floor(far_target * ordered.size))
+    return float(ordered[min(allowed, ordered.size - 1)])
+
+
+def calibrate(far_target=1e-3, limit=2000, genuine_csv=None):
+    keys, matrix, model = load_sample(limit)
+    impostor = impostor_distances(matrix)
+    threshold = pick_threshold(impostor, far_target)
+    result = {
+        "model": model,
+        "dim": int(matrix.shape[1]) if matrix.size else 0,
+        "metric": "cosine",
+        "normalized": True,
+        "far_target": far_target,
+        "threshold": threshold,
+        "far": float((impostor < threshold).mean()),
+        "impostor_pairs": int(impostor.size),
+        "sample_size": len(keys),
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+    }
+    if genuine_csv:
+        genuine = genuine_distances(genuine_csv, keys, matrix)
+        result["genuine_pairs"] = int(genuine.size)
+        result["frr"] = float((genuine >= threshold).mean()) if genuine.size else None
+    return result
+
+
+def save_calibration(result, path):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+if __name__ == "__main__":
+    from face_verify_pg import CALIBRATION_PATH
+
+    parser = argparse.ArgumentParser(description="Chọn ngưỡng khoảng cách cosine theo FAR mục tiêu")
+    parser.add_argument("--far", type=float, default=1e-3, help="tỉ lệ chấp nhận nhầm mục tiêu")
+    parser.add_argument("--limit", type=int, default=2000, help="số embedding lấy mẫu từ face_embeddings")
+    parser.add_argument("--genuine", help="CSV key_id,image_path (ảnh mới của người đã đăng ký) để đo FRR")
+    parser.add_argument("--out", default=CALIBRATION_PATH)
+    parser.add_argument("--dry-run", action="store_true", help="chỉ in kết quả, không ghi file")
+    args = parser.parse_args()
+
+    res = calibrate(args.far, args.limit, args.genuine)
+    print(f"[ℹ️] {res['model']} dim={res['dim']}: {res['sample_size']} embedding, {res['impostor_pairs']} cặp impostor")
+    print(f"[✅] Ngưỡng cosine = {res['threshold']:.4f} (FAR đo được {res['far']:.5f} ≤ {res['far_target']})")
+    if res.get("frr") is not None:
+        print(f"[ℹ️] FRR = {res['frr']:.4f} trên {res['genuine_pairs']} cặp genuine")
+    if not args.dry_run:
+        save_calibration(res, args.out)
+        print(f"[✅] Đã lưu hiệu chỉnh tại {args.out}")
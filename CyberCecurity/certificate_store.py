@@ -0,0 +1,363 @@
+import os
+import time
+import hashlib
+import argparse
+import threading
+from collections import OrderedDict
+import psycopg2.errors
+from db import transaction, connection
+from rsq_mappingid import read_certificate, file_digest, verify_digest, load_or_generate_keys, sign_digest
+
+# Cách lưu nội dung certificate:
+# - "digest": chỉ giữ certificate_text (hiển thị/tìm kiếm) + digest SHA-256; cleaned_text, message = NULL
+# - "full"  : như trước, lưu thêm cleaned_text và message (bytes đầy đủ)
+# Chữ ký luôn là RSA-PSS trên digest (Prehashed) — verify được cho cả hai chế độ.
+CERT_CONFIG = {
+    "storage": os.environ.get("CERT_STORAGE", "digest"),
+}
+
+_COLUMNS = "identifier, school_code, student_id, certificate_text, cleaned_text, message, digest, signature, public_key"
+_UPSERT_SET = """
+            ON CONFLICT (identifier) DO UPDATE SET
+                certificate_text=EXCLUDED.certificate_text,
+                cleaned_text=EXCLUDED.cleaned_text,
+                message=EXCLUDED.message,
+                digest=EXCLUDED.digest,
+                signature=EXCLUDED.signature,
+                public_key=EXCLUDED.public_key,
+                created_at=CURRENT_TIMESTAMP;
+"""
+
+
+def _storage_row(identifier, school_code, student_id, certificate_text, cleaned_text, message_bytes,
+                 signature, public_key_pem, digest=None):
+    if digest is None:
+        digest = hashlib.sha256(message_bytes).digest()
+    if CERT_CONFIG["storage"] == "digest":
+        cleaned_text, message_bytes = None, None
+    return (identifier, school_code, student_id, certificate_text, cleaned_text, message_bytes,
+            digest, signature, public_key_pem)
+
+
+class DuplicateCertificateError(ValueError):
+    """Cùng nội dung (digest, index unique idx_certificates_digest) đã được cấp cho identifier khác."""
+
+    def __init__(self, identifier, existing_identifier=None):
+        self.identifier = identifier
+        self.existing_identifier = existing_identifier
+        owner = existing_identifier or "một certificate khác"
+        super().__init__(f"Nội dung văn bằng của {identifier} trùng với {owner} đã phát hành.")
+
+
+def _digest_owners(cur, digests):
+    """{digest: identifier} của các certificate đã có digest trong danh sách (một truy vấn ANY)."""
+    cur.execute("SELECT digest, identifier FROM certificates WHERE digest = ANY(%s)", (list(digests),))
+    return {bytes(d): identifier for d, identifier in cur.fetchall()}
+
+
+# ====== CERTIFICATES: lưu / phát hành / tìm kiếm ======
+def upsert_certificate(identifier: str, school_code: str, student_id: str,
+                       certificate_text: str, cleaned_text: str, message_bytes: bytes,
+                       signature: bytes, public_key_pem: bytes, digest: bytes | None = None):
+    """Raise DuplicateCertificateError nếu cùng nội dung đã thuộc về identifier khác."""
+    row = _storage_row(identifier, school_code, student_id, certificate_text, cleaned_text, message_bytes,
+                       signature, public_key_pem, digest)
+    try:
+        with transaction() as cur:
+            owner = _digest_owners(cur, [row[6]]).get(bytes(row[6]))
+            if owner is not None and owner != identifier:
+                raise DuplicateCertificateError(identifier, owner)
+            cur.execute(f"""
+                INSERT INTO certificates ({_COLUMNS})
+                VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)
+                {_UPSERT_SET}
+            """, row)
+    except psycopg2.errors.UniqueViolation as e:   # ghi đồng thời lọt qua bước kiểm tra
+        raise DuplicateCertificateError(identifier) from e
+    clear_search_cache()
+
+def upsert_certificates_batch(rows):
+    """
+    Upsert nhiều certificate bằng MỘT câu execute_values.
+    rows: [(identifier, school_code, student_id, certificate_text, cleaned_text, message, signature, public_key, digest)]
+    Trả về (số dòng đã lưu, [(identifier, identifier đã giữ cùng nội dung)]) — các dòng trùng digest với
+    identifier khác bị bỏ ra thay vì làm hỏng cả lô (index unique idx_certificates_digest).
+    """
+    from psycopg2.extras import execute_values
+    rows = list({r[0]: _storage_row(*r) for r in rows}.values())   # ON CONFLICT: mỗi identifier một lần/câu
+    if not rows:
+        return 0, []
+    duplicates, keep = [], []
+    with transaction() as cur:
+        owners = _digest_owners(cur, [r[6] for r in rows])
+        for row in rows:
+            digest = bytes(row[6])
+            owner = owners.setdefault(digest, row[0])   # trùng trong chính lô: dòng đầu tiên giữ digest
+            if owner != row[0]:
+                duplicates.append((row[0], owner))
+            else:
+                keep.append(row)
+        if keep:
+            execute_values(cur, f"""
+                INSERT INTO certificates ({_COLUMNS})
+                VALUES %s
+                {_UPSERT_SET}
+            """, keep, page_size=len(keep))
+    clear_search_cache()
+    return len(keep), duplicates
+
+def issue_certificate(school_code: str, student_id: str, path: str) -> str:
+    """Đọc file văn bằng → (sinh khóa) → ký → upsert. Chạy được ngoài Tk thread. Trả về identifier."""
+    identifier = f"{school_code}_{student_id}"
+
+    # Đọc file MỘT lần: bản gốc + nội dung sạch + message theo rsq_mappingid
+    certificate_text, cleaned_text, message = read_certificate(path)
+    digest = hashlib.sha256(message).digest()
+    # kiểm tra trùng nội dung TRƯỚC khi sinh khóa / ký
+    existing = find_certificate_by_digest(digest)
+    if existing is not None and existing[0] != identifier:
+        raise DuplicateCertificateError(identifier, existing[0])
+
+    # Khóa ký theo identifier: dùng lại private key đã có trong ./keys (chữ ký cũ vẫn verify được),
+    # chưa có thì sinh mới; public key lưu DB cùng certificate
+    _, pem_public = load_or_generate_keys(school_code, student_id)
+
+    # Ký digital (RSA-PSS trên digest SHA-256 của message)
+    signature = sign_digest(identifier, digest)
+
+    # Lưu certificates
+    upsert_certificate(identifier, school_code, student_id, certificate_text, cleaned_text, message, signature,
+                       pem_public, digest)
+    return identifier
+
+def fetch_signatures(identifiers):
+    """{identifier: (public_key, signature)} cho nhiều identifier bằng MỘT truy vấn."""
+    identifiers = list(dict.fromkeys(identifiers))
+    if not identifiers:
+        return {}
+    with transaction() as cur:
+        cur.execute("SELECT identifier, public_key, signature FROM certificates WHERE identifier = ANY(%s)",
+                    (identifiers,))
+        return {identifier: (bytes(pk), bytes(sig)) for identifier, pk, sig in cur.fetchall()}
+
+def find_certificate_by_digest(digest: bytes):
+    """(identifier, school_code, student_id, public_key, signature) của certificate có digest này, hoặc None."""
+    with transaction() as cur:
+        cur.execute("""
+            SELECT identifier, school_code, student_id, public_key, signature
+            FROM certificates WHERE digest=%s
+        """, (digest,))
+        return cur.fetchone()
+
+def identify_certificate(path: str):
+    """
+    "File này là certificate nào?" — băm file theo luồng rồi tra index unique trên digest.
+    Trả về (identifier, hợp lệ?) hoặc (None, False) nếu không có certificate nào khớp.
+    """
+    digest = file_digest(path)
+    row = find_certificate_by_digest(digest)
+    if row is None:
+        return None, False
+    identifier, _, _, public_key_pem, signature = row
+    return identifier, verify_digest(bytes(public_key_pem), bytes(signature), digest)
+
+def delete_certificate(identifier: str):
+    with transaction() as cur:
+        cur.execute("DELETE FROM certificates WHERE identifier=%s", (identifier,))
+    clear_search_cache()
+
+def _like_pattern(keyword: str) -> str:
+    """'%kw%' cho ILIKE, thoát các ký tự đại diện người dùng gõ vào."""
+    return "%" + keyword.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+# Sắp xếp đẩy xuống SQL: cột → chiều; mỗi cột có index (cột, id) cho phân trang keyset
+SORT_COLUMNS = {
+    "created_at": "DESC",
+    "student_id": "ASC",
+    "school_code": "ASC",
+    "identifier": "ASC",
+}
+# cột cho phép NULL → sắp/so sánh trên COALESCE (khớp index biểu thức trong DDL_INDEXES);
+# so sánh hàng (col, id) > (NULL, x) cho ra NULL nên các dòng NULL sẽ bị bỏ qua khi phân trang
+_SORT_EXPR = {
+    "student_id": "COALESCE(student_id, '')",
+    "school_code": "COALESCE(school_code, '')",
+}
+
+def search_certificates(keyword: str = "", sort: str = "created_at", cursor=None, limit: int = 50, on_cancel=None):
+    """
+    Một trang certificate: ([(identifier, school_code, student_id, preview)], next_cursor).
+    next_cursor=None → hết dữ liệu; truyền lại next_cursor để lấy trang kế.
+    - sort là cột trong SORT_COLUMNS: phân trang keyset trên (cột, id) → trang sâu vẫn nhanh như trang đầu
+    - sort="relevance" (cần keyword): xếp hạng khớp chính xác mã → tiền tố mã → ts_rank nội dung;
+      thứ hạng không có index nên trang kế dùng OFFSET
+    Lọc keyword: identifier / student_id ILIKE '%kw%' (GIN pg_trgm) hoặc full-text search_tsv (GIN).
+    on_cancel: hàm đăng ký callback hủy (vd. Task.on_cancel) → hủy được truy vấn đang chạy trên server.
+    """
+    keyword = keyword.strip()
+    params = {"limit": limit + 1}
+    where = []
+    if keyword:
+        like = _like_pattern(keyword)
+        params.update(kw=keyword, like=like, kw_exact=like[1:-1], prefix=like[1:])
+        where.append("(identifier ILIKE %(like)s OR student_id ILIKE %(like)s"
+                     " OR search_tsv @@ plainto_tsquery('simple', %(kw)s))")
+
+    if sort == "relevance" and keyword:
+        params["offset"] = cursor or 0
+        sql = f"""
+            SELECT identifier, school_code, student_id, LEFT(certificate_text,120)
+            FROM certificates
+            WHERE {where[0]}
+            ORDER BY (identifier ILIKE %(kw_exact)s OR student_id ILIKE %(kw_exact)s) DESC,
+                     (identifier ILIKE %(prefix)s OR student_id ILIKE %(prefix)s) DESC,
+                     ts_rank(search_tsv, plainto_tsquery('simple', %(kw)s)) DESC,
+                     created_at DESC, id DESC
+            LIMIT %(limit)s OFFSET %(offset)s
+        """
+    else:
+        column = sort if sort in SORT_COLUMNS else "created_at"
+        direction = SORT_COLUMNS[column]
+        expr = _SORT_EXPR.get(column, column)
+        if cursor is not None:
+            params["after_value"], params["after_id"] = cursor
+            op = "<" if direction == "DESC" else ">"
+            where.append(f"({expr}, id) {op} (%(after_value)s, %(after_id)s)")
+        where_sql = "WHERE " + " AND ".join(where) if where else ""
+        sql = f"""
+            SELECT identifier, school_code, student_id, LEFT(certificate_text,120), {expr}, id
+            FROM certificates
+            {where_sql}
+            ORDER BY {expr} {direction}, id {direction}
+            LIMIT %(limit)s
+        """
+
+    with connection() as conn:
+        remove = on_cancel(conn.cancel) if on_cancel else None
+        try:
+            with conn.cursor() as cur:
+                cur.execute(sql, params)
+                rows = cur.fetchall()
+        finally:
+            if remove:
+                remove()   # gỡ trước khi kết nối về pool: không hủy nhầm truy vấn của người khác
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if not has_more:
+        next_cursor = None
+    elif "offset" in params:
+        next_cursor = params["offset"] + limit
+    else:
+        next_cursor = (rows[-1][4], rows[-1][5])
+    return [r[:4] for r in rows], next_cursor
+
+# ========== CACHE KẾT QUẢ TÌM KIẾM (LRU, phía client) ==========
+# Gõ lùi / gõ lại cùng từ khóa không chạm DB. Mọi ghi certificate trong process xóa cache;
+# ttl_seconds giới hạn độ cũ khi dữ liệu đổi từ máy khác.
+SEARCH_CACHE_CONFIG = {"maxsize": 128, "ttl_seconds": 30.0}
+
+_SEARCH_CACHE = OrderedDict()   # key -> (thời điểm, (rows, next_cursor))
+_SEARCH_CACHE_LOCK = threading.Lock()
+
+
+def _search_key(keyword, sort, cursor, limit):
+    return keyword.strip().casefold(), sort, cursor, limit   # ILIKE / tsvector 'simple' không phân biệt hoa thường
+
+def search_cache_get(keyword: str = "", sort: str = "created_at", cursor=None, limit: int = 50):
+    """Kết quả đã cache (rows, next_cursor) hoặc None — đủ rẻ để gọi trên Tk thread."""
+    key = _search_key(keyword, sort, cursor, limit)
+    with _SEARCH_CACHE_LOCK:
+        entry = _SEARCH_CACHE.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] > SEARCH_CACHE_CONFIG["ttl_seconds"]:
+            del _SEARCH_CACHE[key]
+            return None
+        _SEARCH_CACHE.move_to_end(key)
+        return entry[1]
+
+def cached_search_certificates(keyword: str = "", sort: str = "created_at", cursor=None, limit: int = 50,
+                               on_cancel=None):
+    """search_certificates qua cache LRU."""
+    result = search_cache_get(keyword, sort, cursor, limit)
+    if result is not None:
+        return result
+    result = search_certificates(keyword, sort, cursor, limit, on_cancel=on_cancel)
+    with _SEARCH_CACHE_LOCK:
+        _SEARCH_CACHE[_search_key(keyword, sort, cursor, limit)] = (time.monotonic(), result)
+        while len(_SEARCH_CACHE) > SEARCH_CACHE_CONFIG["maxsize"]:
+            _SEARCH_CACHE.popitem(last=False)
+    return result
+
+def clear_search_cache():
+    with _SEARCH_CACHE_LOCK:
+        _SEARCH_CACHE.clear()
+
+
+# ========== BACKFILL: message / certificate_text → cột digest ==========
+def backfill_digests(batch_size=500, drop_payload=False):
+    """
+    Điền certificates.digest cho các dòng còn NULL (theo từng lô, keyset theo id, commit mỗi lô).
+    digest = sha256(message), hoặc sha256(certificate_text UTF-8) nếu không có message.
+    drop_payload=True → xóa cleaned_text/message của dòng có chữ ký verify được trên digest.
+    Digest trùng với dòng khác (index unique) → bỏ qua dòng đó và báo lỗi.
+    """
+    import psycopg2
+    from db import connect
+
+    conn = connect(statement_timeout_ms=0)   # migration chạy lâu → kết nối riêng
+    cur = conn.cursor()
+    last_id, filled, dropped, failed = 0, 0, 0, 0
+    while True:
+        cur.execute("""
+            SELECT id, identifier, message, certificate_text, signature, public_key FROM certificates
+            WHERE id > %s AND digest IS NULL
+            ORDER BY id
+            LIMIT %s
+        """, (last_id, batch_size))
+        rows = cur.fetchall()
+        if not rows:
+            break
+        for row_id, identifier, message, certificate_text, signature, public_key in rows:
+            if message is not None:
+                digest = hashlib.sha256(bytes(message)).digest()
+            elif certificate_text is not None:
+                digest = hashlib.sha256(certificate_text.encode("utf-8")).digest()
+            else:
+                failed += 1
+                print(f"[❌] Bỏ qua {identifier}: không có nội dung để băm")
+                continue
+            drop = (drop_payload and signature is not None and public_key is not None
+                    and verify_digest(bytes(public_key), bytes(signature), digest))
+            cur.execute("SAVEPOINT backfill_row")
+            try:
+                if drop:
+                    cur.execute("UPDATE certificates SET digest=%s, cleaned_text=NULL, message=NULL WHERE id=%s",
+                                (digest, row_id))
+                    dropped += 1
+                else:
+                    cur.execute("UPDATE certificates SET digest=%s WHERE id=%s", (digest, row_id))
+                filled += 1
+            except psycopg2.IntegrityError as e:
+                cur.execute("ROLLBACK TO SAVEPOINT backfill_row")
+                failed += 1
+                print(f"[❌] Bỏ qua {identifier}: digest trùng với certificate khác ({e.pgerror or e})")
+        conn.commit()
+        last_id = rows[-1][0]
+        print(f"[ℹ️] Đã điền digest cho {filled} dòng (tới id={last_id})")
+    conn.close()
+    print(f"[✅] Hoàn tất: {filled} dòng có digest, {dropped} dòng đã bỏ message/cleaned_text, {failed} lỗi.")
+    return filled, failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Công cụ bảng certificates")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    bf = sub.add_parser("backfill-digest", help="Điền cột digest (SHA-256) cho các certificate cũ")
+    bf.add_argument("--batch-size", type=int, default=500)
+    bf.add_argument("--drop-payload", action="store_true",
+                    help="xóa message/cleaned_text của dòng đã có digest và chữ ký hợp lệ")
+    args = parser.parse_args()
+
+    if args.cmd == "backfill-digest":
+        backfill_digests(batch_size=args.batch_size, drop_payload=args.drop_payload)
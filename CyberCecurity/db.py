@@ -0,0 +1,101 @@
+import os
+import threading
+from contextlib import contextmanager
+import psycopg2
+import psycopg2.extensions
+from psycopg2.pool import ThreadedConnectionPool
+
+# ================= DATABASE CONFIG (dùng chung cho mọi module) =================
+# Giá trị mặc định; có thể ghi đè bằng biến môi trường chuẩn của libpq (PGHOST, PGUSER, ...)
+DB_CONFIG = {
+    "host": os.environ.get("PGHOST", "127.0.0.1"),
+    "user": os.environ.get("PGUSER", "postgres"),
+    "password": os.environ.get("PGPASSWORD", "huyyuh"),   # đổi theo PostgreSQL của bạn
+    "dbname": os.environ.get("PGDATABASE", "cyber_verify_certificate"),
+    "port": int(os.environ.get("PGPORT", "5432")),
+}
+
+POOL_CONFIG = {
+    "minconn": int(os.environ.get("DB_POOL_MIN", "1")),
+    "maxconn": int(os.environ.get("DB_POOL_MAX", "10")),
+    "statement_timeout_ms": int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", "15000")),   # 0 = không giới hạn
+}
+
+
+def _options(statement_timeout_ms):
+    return f"-c statement_timeout={int(statement_timeout_ms)}"
+
+
+def connect(statement_timeout_ms=None):
+    """
+    Kết nối RIÊNG (không qua pool) — dùng cho LISTEN/NOTIFY hoặc migration chạy lâu.
+    Người gọi tự close().
+    """
+    if statement_timeout_ms is None:
+        statement_timeout_ms = POOL_CONFIG["statement_timeout_ms"]
+    return psycopg2.connect(**DB_CONFIG, options=_options(statement_timeout_ms))
+
+
+# ================= CONNECTION POOL =================
+_POOL = None
+_POOL_SLOTS = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_pool():
+    """ThreadedConnectionPool dùng chung (tạo lần đầu khi cần)."""
+    global _POOL, _POOL_SLOTS
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = ThreadedConnectionPool(POOL_CONFIG["minconn"], POOL_CONFIG["maxconn"],
+                                           options=_options(POOL_CONFIG["statement_timeout_ms"]), **DB_CONFIG)
+            # ThreadedConnectionPool báo lỗi khi hết kết nối → semaphore để thread chờ thay vì lỗi
+            _POOL_SLOTS = threading.BoundedSemaphore(POOL_CONFIG["maxconn"])
+        return _POOL
+
+
+def close_pool():
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is not None:
+            _POOL.closeall()
+            _POOL = None
+
+
+@contextmanager
+def connection():
+    """Mượn một kết nối từ pool; tự rollback phần dang dở và trả lại pool khi ra khỏi khối with."""
+    pool = get_pool()
+    _POOL_SLOTS.acquire()
+    conn = None
+    try:
+        conn = pool.getconn()
+        yield conn
+    finally:
+        if conn is not None:
+            broken = bool(conn.closed)
+            if not broken and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    broken = True
+            pool.putconn(conn, close=broken)
+        _POOL_SLOTS.release()
+
+
+@contextmanager
+def transaction():
+    """
+    Cursor trong một transaction: commit khi khối with kết thúc bình thường, rollback nếu có lỗi.
+
+        with transaction() as cur:
+            cur.execute("...")
+    """
+    with connection() as conn:
+        try:
+            with conn.cursor() as cur:
+                yield cur
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
@@ -0,0 +1,234 @@
+import pickle
+import struct
+import argparse
+import numpy as np
+
+# ========== ĐỊNH DẠNG LƯU EMBEDDING (face_embeddings.embedding) ==========
+# v1: header nhỏ + float32 little-endian thô (thay cho pickle.dumps(np.ndarray))
+#
+#   magic   4B  b"FEMB"
+#   version 1B  1
+#   flags   1B  bit0 = embedding đã L2-normalize
+#   dim     2B  uint16 LE
+#   name_len 1B + model name (ascii)
+#   padding tới bội số 4 byte → phần float32 luôn căn lề để np.frombuffer đọc nhanh
+#   data    dim * 4B  float32 LE
+MAGIC = b"FEMB"
+FORMAT_VERSION = 1
+FLAG_NORMALIZED = 0x01
+DEFAULT_MODEL = "Facenet"
+
+_HEAD = struct.Struct("<4sBBHB")
+
+
+def _header_size(name_len):
+    n = _HEAD.size + name_len
+    return (n + 3) & ~3
+
+
+def encode_embedding(embedding, model_name=DEFAULT_MODEL, normalized=False):
+    """np.ndarray → bytes (định dạng v1) để ghi vào cột BYTEA."""
+    vec = np.asarray(embedding, dtype="<f4").reshape(-1)
+    name = model_name.encode("ascii")
+    flags = FLAG_NORMALIZED if normalized else 0
+    head = _HEAD.pack(MAGIC, FORMAT_VERSION, flags, vec.shape[0], len(name)) + name
+    head += b"\x00" * (_header_size(len(name)) - len(head))
+    return head + vec.tobytes()
+
+
+def is_encoded(blob):
+    return bytes(blob[:4]) == MAGIC
+
+
+def decode_header(blob):
+    """Trả về dict {version, model, dim, normalized, offset} của blob v1."""
+    magic, version, flags, dim, name_len = _HEAD.unpack_from(blob, 0)
+    if magic != MAGIC:
+        raise ValueError("Blob không phải định dạng FEMB.")
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Không hỗ trợ phiên bản embedding {version}.")
+    model = bytes(blob[_HEAD.size:_HEAD.size + name_len]).decode("ascii")
+    return {
+        "version": version,
+        "model": model,
+        "dim": dim,
+        "normalized": bool(flags & FLAG_NORMALIZED),
+        "offset": _header_size(name_len),
+    }
+
+
+def decode_embedding(blob):
+    """
+    bytes/memoryview từ DB → np.ndarray.
+    - v1: view float32 zero-copy (np.frombuffer) trên chính buffer đã fetch
+    - dữ liệu cũ (pickle): vẫn đọc được trong giai đoạn chuyển đổi
+    """
+    if blob is None:
+        return None
+    if is_encoded(blob):
+        meta = decode_header(blob)
+        return np.frombuffer(blob, dtype="<f4", count=meta["dim"], offset=meta["offset"])
+    return np.asarray(pickle.loads(bytes(blob)), dtype=np.float32)
+
+
+def l2_normalize(embedding):
+    """Vector đơn vị float32 (||v|| = 1) → khoảng cách cosine = 1 - tích vô hướng."""
+    vec = np.asarray(embedding, dtype=np.float32).reshape(-1)
+    norm = float(np.linalg.norm(vec))
+    return vec / norm if norm > 0 else vec.copy()
+
+
+def decode_normalized(blob):
+    """decode_embedding + L2-normalize nếu dòng được ghi trước khi chuẩn hóa lúc ghi."""
+    if blob is None:
+        return None
+    if is_encoded(blob) and decode_header(blob)["normalized"]:
+        return decode_embedding(blob)
+    return l2_normalize(decode_embedding(blob))
+
+
+def to_pgvector(embedding):
+    """np.ndarray → literal pgvector '[x1,x2,...]' (dùng với %s::vector)."""
+    vec = np.asarray(embedding, dtype=np.float32).reshape(-1)
+    return "[" + ",".join(f"{x:.7g}" for x in vec.tolist()) + "]"
+
+
+# ========== MIGRATION: pickle → v1 ==========
+def migrate_pickled_rows(batch_size=500, dry_run=False):
+    """
+    Chuyển các dòng face_embeddings còn ở dạng pickle sang định dạng v1, theo từng lô
+    (keyset theo id, commit sau mỗi lô nên có thể dừng/chạy lại an toàn).
+    """
+    from psycopg2.extras import execute_batch
+    from db import connect
+
+    conn = connect(statement_timeout_ms=0)   # migration chạy lâu → kết nối riêng
+    cur = conn.cursor()
+    last_id, converted, failed = 0, 0, 0
+    while True:
+        cur.execute("""
+            SELECT id, embedding FROM face_embeddings
+            WHERE id > %s AND substring(embedding FROM 1 FOR 4) <> %s
+            ORDER BY id
+            LIMIT %s
+        """, (last_id, MAGIC, batch_size))
+        rows = cur.fetchall()
+        if not rows:
+            break
+        updates = []
+        for row_id, blob in rows:
+            try:
+                updates.append((encode_embedding(decode_embedding(blob)), row_id))
+            except Exception as e:
+                failed += 1
+                print(f"[❌] Bỏ qua id={row_id}: {e}")
+        if updates and not dry_run:
+            execute_batch(cur, "UPDATE face_embeddings SET embedding=%s WHERE id=%s", updates)
+            conn.commit()
+        converted += len(updates)
+        last_id = rows[-1][0]
+        print(f"[ℹ️] Đã chuyển {converted} dòng (tới id={last_id})")
+    conn.close()
+    print(f"[✅] Hoàn tất: {converted} dòng chuyển đổi, {failed} lỗi{' (dry-run)' if dry_run else ''}.")
+    return converted, failed
+
+
+# ========== BACKFILL: BYTEA → cột pgvector embedding_vec ==========
+def backfill_vector_column(batch_size=500):
+    """
+    Điền face_embeddings.embedding_vec (vector) từ cột BYTEA cho các dòng còn NULL.
+    Cần đã chạy DDL_FACE_EMB_VECTOR (face_intergration_gui.init_schema).
+    """
+    from psycopg2.extras import execute_batch
+    from db import connect
+
+    conn = connect(statement_timeout_ms=0)   # migration chạy lâu → kết nối riêng
+    cur = conn.cursor()
+    last_id, filled = 0, 0
+    while True:
+        cur.execute("""
+            SELECT id, embedding FROM face_embeddings
+            WHERE id > %s AND embedding_vec IS NULL AND embedding IS NOT NULL
+            ORDER BY id
+            LIMIT %s
+        """, (last_id, batch_size))
+        rows = cur.fetchall()
+        if not rows:
+            break
+        updates = [(to_pgvector(decode_embedding(blob)), row_id) for row_id, blob in rows]
+        execute_batch(cur, "UPDATE face_embeddings SET embedding_vec=%s::vector WHERE id=%s", updates)
+        conn.commit()
+        filled += len(updates)
+        last_id = rows[-1][0]
+        print(f"[ℹ️] Đã điền embedding_vec cho {filled} dòng (tới id={last_id})")
+    conn.close()
+    print(f"[✅] Backfill pgvector hoàn tất: {filled} dòng.")
+    return filled
+
+
+# ========== MIGRATION: L2-normalize các dòng cũ ==========
+def normalize_rows(batch_size=500):
+    """
+    Ghi lại embedding chưa chuẩn hóa (kể cả pickle cũ) thành vector đơn vị, cờ normalized = 1;
+    cập nhật cả embedding_vec nếu bảng có cột pgvector.
+    """
+    from psycopg2.extras import execute_batch
+    from db import connect
+
+    conn = connect(statement_timeout_ms=0)   # migration chạy lâu → kết nối riêng
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'face_embeddings' AND column_name = 'embedding_vec'
+    """)
+    has_vec = cur.fetchone() is not None
+    last_id, done = 0, 0
+    while True:
+        cur.execute("""
+            SELECT id, embedding FROM face_embeddings
+            WHERE id > %s AND embedding IS NOT NULL
+              AND (substring(embedding FROM 1 FOR 4) <> %s OR get_byte(embedding, 5) & 1 = 0)
+            ORDER BY id
+            LIMIT %s
+        """, (last_id, MAGIC, batch_size))
+        rows = cur.fetchall()
+        if not rows:
+            break
+        updates = []
+        for row_id, blob in rows:
+            vec = l2_normalize(decode_embedding(blob))
+            model = decode_header(blob)["model"] if is_encoded(blob) else DEFAULT_MODEL
+            updates.append((encode_embedding(vec, model, normalized=True), to_pgvector(vec), row_id))
+        if has_vec:
+            execute_batch(cur, "UPDATE face_embeddings SET embedding=%s, embedding_vec=%s::vector WHERE id=%s",
+                          updates)
+        else:
+            execute_batch(cur, "UPDATE face_embeddings SET embedding=%s WHERE id=%s",
+                          [(blob, row_id) for blob, _, row_id in updates])
+        conn.commit()
+        done += len(updates)
+        last_id = rows[-1][0]
+        print(f"[ℹ️] Đã chuẩn hóa {done} dòng (tới id={last_id})")
+    conn.close()
+    print(f"[✅] Chuẩn hóa hoàn tất: {done} dòng.")
+    return done
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Công cụ định dạng embedding face_embeddings")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    mig = sub.add_parser("migrate", help="Chuyển embedding pickle cũ sang float32 v1")
+    mig.add_argument("--batch-size", type=int, default=500)
+    mig.add_argument("--dry-run", action="store_true")
+    vec = sub.add_parser("backfill-vector", help="Điền cột pgvector embedding_vec từ BYTEA")
+    vec.add_argument("--batch-size", type=int, default=500)
+    nrm = sub.add_parser("normalize", help="L2-normalize các embedding ghi trước khi chuẩn hóa lúc ghi")
+    nrm.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    if args.cmd == "migrate":
+        migrate_pickled_rows(batch_size=args.batch_size, dry_run=args.dry_run)
+    elif args.cmd == "backfill-vector":
+        backfill_vector_column(batch_size=args.batch_size)
+    elif args.cmd == "normalize":
+        normalize_rows(batch_size=args.batch_size)
@@ -0,0 +1,151 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait
+
+
+# ========== POOL PROCESS TRÍCH XUẤT EMBEDDING (server chỉ có CPU) ==========
+# Mỗi worker giữ một EmbeddingService (model Facenet) nóng riêng; yêu cầu được phân phối
+# qua hàng đợi của ProcessPoolExecutor. Dùng context "spawn" để TensorFlow không bị fork
+# giữa chừng và để giới hạn thread (intra-op) có hiệu lực trước khi TF khởi tạo.
+
+_THREAD_ENV = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "TF_NUM_INTRAOP_THREADS")
+
+_WORKER_SERVICE = None
+
+
+def _init_worker(model_name, detector_backend, intra_op_threads):
+    global _WORKER_SERVICE
+    try:
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+    except Exception:
+        pass   # TF đã khởi tạo hoặc không có → dựa vào biến môi trường
+    from embedding_service import EmbeddingService
+    _WORKER_SERVICE = EmbeddingService(model_name=model_name, detector_backend=detector_backend)
+    _WORKER_SERVICE.warm_up()
+
+
+def _worker_ping():
+    return _WORKER_SERVICE.state
+
+
+def _worker_represent(img):
+    return _WORKER_SERVICE.represent(img)
+
+
+def _worker_represent_batch(images):
+    return _WORKER_SERVICE.represent_batch(images)
+
+
+class EmbeddingPool:
+    """
+    Cùng giao diện với EmbeddingService (represent / represent_batch / warm_up / state)
+    nên dùng thay thế được trong CLI, batch_enroll và ManagementApp.
+    workers          : số process (mặc định = số core)
+    intra_op_threads : số thread TF/BLAS mỗi process (1 → scale gần tuyến tính theo core)
+    """
+
+    def __init__(self, workers=None, intra_op_threads=1, model_name="Facenet", detector_backend="opencv"):
+        self.workers = workers or os.cpu_count() or 1
+        self.intra_op_threads = intra_op_threads
+        saved = {k: os.environ.get(k) for k in _THREAD_ENV + ("TF_NUM_INTEROP_THREADS",)}
+        try:
+            # process con kế thừa môi trường tại thời điểm spawn
+            for k in _THREAD_ENV:
+                os.environ[k] = str(intra_op_threads)
+            os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(model_name, detector_backend, intra_op_threads),
+            )
+            self._warm = [self._executor.submit(_worker_ping) for _ in range(self.workers)]
+        finally:
+            for k, v in saved.items():
+                if v is None:
+                    os.environ.pop(k, None)
+                else:
+                    os.environ[k] = v
+
+    # ---------- trạng thái ----------
+    @property
+    def state(self):
+        if not all(f.done() for f in self._warm):
+            return "warming"
+        if any(f.exception() is not None or f.result() != "ready" for f in self._warm):
+            return "failed"
+        return "ready"
+
+    @property
+    def ready(self):
+        return self.state == "ready"
+
+    def warm_up(self, background=False):
+        """Các worker tự nạp model khi khởi động; background=False → chờ tới khi xong."""
+        if not background:
+            wait(self._warm)
+
+    def wait_ready(self, timeout=None):
+        wait(self._warm, timeout=timeout)
+        return self.ready
+
+    # ---------- trích xuất ----------
+    def submit(self, img):
+        """Future trả về embedding của một ảnh (path hoặc ndarray)."""
+        return self._executor.submit(_worker_represent, img)
+
+    def represent(self, img):
+        return self.submit(img).result()
+
+    def represent_batch(self, images):
+        """Chia lô cho các worker (mỗi worker chạy represent_batch trên phần của mình), giữ thứ tự."""
+        images = list(images)
+        if not images:
+            return []
+        size = -(-len(images) // self.workers)
+        futures = [self._executor.submit(_worker_represent_batch, images[i:i + size])
+                   for i in range(0, len(images), size)]
+        out = []
+        for f in futures:
+            out.extend(f.result())
+        return out
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+
+_POOL = None
+
+def start_embedding_pool(workers=None, intra_op_threads=1):
+    """Bật pool process dùng chung; get_embedding của các module sẽ đi qua pool."""
+    global _POOL
+    if _POOL is None:
+        _POOL = EmbeddingPool(workers=workers, intra_op_threads=intra_op_threads)
+    return _POOL
+
+def start_embedding_pool_from_env():
+    """
+    Bật pool nếu đặt biến môi trường FACE_EMBED_WORKERS (số process, 0 = tắt)
+    và tuỳ chọn FACE_EMBED_THREADS (thread mỗi process). Trả về pool hoặc None.
+    """
+    workers = int(os.environ.get("FACE_EMBED_WORKERS", "0") or 0)
+    if workers <= 0:
+        return None
+    return start_embedding_pool(workers, int(os.environ.get("FACE_EMBED_THREADS", "1") or 1))
+
+def get_embedding_pool():
+    return _POOL
+
+def stop_embedding_pool():
+    global _POOL
+    if _POOL is not None:
+        _POOL.shutdown()
+        _POOL = None
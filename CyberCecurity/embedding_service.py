@@ -0,0 +1,149 @@
+import os
+import threading
+import time
+import cv2
+import numpy as np
+from deepface import DeepFace
+
+
+def to_image(img):
+    """
+    Chuẩn hóa đầu vào cho model, không qua file tạm:
+    - ndarray BGR (khung camera, ảnh đã giải mã) → giữ nguyên
+    - bytes / bytearray / memoryview (JPEG, PNG... đã mã hóa) → giải mã trong RAM (cv2.imdecode)
+    - đường dẫn (str / PathLike) → để DeepFace tự đọc
+    """
+    if isinstance(img, (bytes, bytearray, memoryview)):
+        arr = cv2.imdecode(np.frombuffer(img, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if arr is None:
+            raise ValueError("không giải mã được ảnh từ bytes")
+        return arr
+    if isinstance(img, os.PathLike):
+        return os.fspath(img)
+    return img
+
+
+# ========== EMBEDDING SERVICE (model Facenet nạp một lần, giữ "nóng") ==========
+class EmbeddingService:
+    """
+    Nạp model + detector một lần cho cả process rồi dùng lại cho mọi lần gọi.
+    - DeepFace.build_model() nạp trọng số vào cache model của DeepFace (theo model_name)
+    - warm_up() chạy thử một ảnh giả để khởi tạo detector và graph TensorFlow
+    - state: "cold" → "warming" → "ready" (hoặc "failed")
+    """
+
+    def __init__(self, model_name="Facenet", detector_backend="opencv", enforce_detection=False):
+        self.model_name = model_name
+        self.detector_backend = detector_backend
+        self.enforce_detection = enforce_detection
+        self.model = None
+        self.state = "cold"
+        self.error = None
+        self.warmup_seconds = None
+        self._done = threading.Event()       # set khi warm-up kết thúc (thành công hay lỗi)
+        self._lock = threading.Lock()        # model Keras không an toàn khi predict song song
+        self._warm_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def ready(self):
+        return self.state == "ready"
+
+    def warm_up(self, background=False):
+        """Nạp model/detector. background=True → chạy trong thread, trả về ngay."""
+        if background:
+            if self._thread is None and not self.ready:
+                self._thread = threading.Thread(target=self._warm_up, name="embedding-warmup", daemon=True)
+                self._thread.start()
+            return self._thread
+        self._warm_up()
+        return None
+
+    def _warm_up(self):
+        with self._warm_lock:
+            if self.ready:
+                return
+            self.state = "warming"
+            t0 = time.perf_counter()
+            try:
+                self.model = DeepFace.build_model(self.model_name)
+                dummy = np.zeros((160, 160, 3), dtype=np.uint8)
+                with self._lock:
+                    DeepFace.represent(img_path=dummy, model_name=self.model_name,
+                                       detector_backend=self.detector_backend, enforce_detection=False)
+                self.warmup_seconds = time.perf_counter() - t0
+                self.state = "ready"
+                print(f"[✅] Model {self.model_name} sẵn sàng sau {self.warmup_seconds:.1f}s")
+            except Exception as e:
+                self.state = "failed"
+                self.error = e
+                print(f"[❌] Không thể nạp model {self.model_name}: {e}")
+            finally:
+                self._done.set()
+
+    def wait_ready(self, timeout=None):
+        """Chờ warm-up xong (tự warm-up nếu chưa ai gọi). Trả về True nếu model sẵn sàng."""
+        if not self._done.is_set() and self._thread is None:
+            self._warm_up()
+        self._done.wait(timeout)
+        return self.ready
+
+    def represent(self, img):
+        """Embedding (np.ndarray) của khuôn mặt đầu tiên trong ảnh (path / ndarray / bytes), hoặc None nếu lỗi."""
+        self.wait_ready()
+        try:
+            img = to_image(img)
+            with self._lock:
+                rep = DeepFace.represent(img_path=img, model_name=self.model_name,
+                                         detector_backend=self.detector_backend,
+                                         enforce_detection=self.enforce_detection)
+            return np.array(rep[0]['embedding'])
+        except Exception as e:
+            print(f"[❌] Không thể lấy embedding: {e}")
+            return None
+
+    def represent_batch(self, images):
+        """
+        Embedding cho nhiều ảnh (path, ndarray BGR hoặc bytes đã mã hóa): detect từng ảnh, rồi đưa
+        các khuôn mặt qua model theo MỘT lô. Ảnh lỗi/không có mặt → None.
+        Tiền xử lý giống DeepFace.represent (RGB→BGR, resize_image); nếu bản DeepFace
+        không có các API này thì quay về represent() từng ảnh.
+        """
+        self.wait_ready()
+        try:
+            from deepface.modules import preprocessing
+            keras_model = self.model.model
+            target = self.model.input_shape
+        except Exception:
+            return [self.represent(img) for img in images]
+
+        out = [None] * len(images)
+        faces, slots = [], []
+        for i, img in enumerate(images):
+            if img is None:
+                continue
+            try:
+                objs = DeepFace.extract_faces(img_path=to_image(img), detector_backend=self.detector_backend,
+                                              enforce_detection=self.enforce_detection, align=True)
+                face = objs[0]["face"][:, :, ::-1]
+                faces.append(preprocessing.resize_image(face, (target[1], target[0]))[0])
+                slots.append(i)
+            except Exception as e:
+                print(f"[❌] Không phát hiện được khuôn mặt (ảnh #{i}): {e}")
+        if faces:
+            with self._lock:
+                embs = keras_model.predict(np.stack(faces), verbose=0)
+            for i, emb in zip(slots, embs):
+                out[i] = np.asarray(emb, dtype=np.float64)
+        return out
+
+_SERVICE = None
+_SERVICE_LOCK = threading.Lock()
+
+def get_embedding_service():
+    """EmbeddingService dùng chung trong process."""
+    global _SERVICE
+    with _SERVICE_LOCK:
+        if _SERVICE is None:
+            _SERVICE = EmbeddingService()
+        return _SERVICE
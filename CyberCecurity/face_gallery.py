@@ -0,0 +1,189 @@
+import threading
+import numpy as np
+
+
+# ========== IN-MEMORY FACE GALLERY ==========
+class FaceGallery:
+    """
+    Gallery embeddings giữ trong RAM:
+    - một ma trận float32 liên tục (N x d) chứa toàn bộ embedding
+    - một mảng key_id song song (hàng i của ma trận <-> keys[i])
+    Truy vấn láng giềng gần nhất = MỘT phép tính khoảng cách theo lô (không lặp Python).
+    metric="euclidean": khoảng cách L2; metric="cosine": các hàng là vector đơn vị (đã L2-normalize),
+    khoảng cách = 1 - x.q → đúng một phép nhân ma trận-vector.
+    """
+
+    def __init__(self, dim=None, capacity=1024, metric="euclidean"):
+        if metric not in ("euclidean", "cosine"):
+            raise ValueError(f"metric không hợp lệ: {metric}")
+        self._lock = threading.RLock()
+        self.metric = metric
+        self.dim = dim
+        self._capacity = capacity
+        self._size = 0
+        self._data = None           # ma trận (capacity x dim), chỉ dùng [:_size]
+        self._sq_norms = None       # ||x||^2 của từng hàng, tính sẵn
+        self._keys = []             # key_id theo thứ tự hàng
+        self._row_of = {}           # key_id -> chỉ số hàng
+
+    # ---------- trạng thái ----------
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, key_id):
+        return key_id in self._row_of
+
+    @property
+    def matrix(self):
+        """View (N x d) float32 trên dữ liệu hiện có (không copy)."""
+        if self._data is None:
+            return np.empty((0, self.dim or 0), dtype=np.float32)
+        return self._data[:self._size]
+
+    @property
+    def keys(self):
+        return np.array(self._keys, dtype=object)
+
+    def get(self, key_id):
+        with self._lock:
+            row = self._row_of.get(key_id)
+            return None if row is None else self._data[row].copy()
+
+    # ---------- nạp / cập nhật ----------
+    def _ensure_capacity(self, n):
+        # ma trận mượn từ snapshot mmap (chỉ đọc) → copy sang bộ nhớ riêng ở lần ghi đầu tiên
+        if self._data is not None and n <= self._data.shape[0] and self._data.flags.writeable:
+            return
+        cap = max(n, self._capacity, 2 * (self._data.shape[0] if self._data is not None else 0))
+        data = np.empty((cap, self.dim), dtype=np.float32)
+        norms = np.empty(cap, dtype=np.float32)
+        if self._data is not None and self._size:
+            data[:self._size] = self._data[:self._size]
+            norms[:self._size] = self._sq_norms[:self._size]
+        self._data, self._sq_norms = data, norms
+
+    def _as_vector(self, embedding):
+        vec = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        if self.dim is None:
+            self.dim = vec.shape[0]
+        elif vec.shape[0] != self.dim:
+            raise ValueError(f"Embedding có {vec.shape[0]} chiều, gallery yêu cầu {self.dim}.")
+        return vec
+
+    def load(self, items):
+        """
+        Nạp lại toàn bộ gallery từ dict {key_id: embedding} hoặc iterable (key_id, embedding).
+        """
+        if isinstance(items, dict):
+            items = items.items()
+        keys, vecs = [], []
+        for key_id, emb in items:
+            keys.append(key_id)
+            vecs.append(np.asarray(emb, dtype=np.float32).reshape(-1))
+
+        with self._lock:
+            self._size = 0
+            self._data = self._sq_norms = None
+            self._keys, self._row_of = [], {}
+            if not keys:
+                return self
+            mat = np.ascontiguousarray(np.vstack(vecs), dtype=np.float32)
+            if self.dim is None:
+                self.dim = mat.shape[1]
+            elif mat.shape[1] != self.dim:
+                raise ValueError(f"Embedding có {mat.shape[1]} chiều, gallery yêu cầu {self.dim}.")
+            self._ensure_capacity(len(keys))
+            self._data[:len(keys)] = mat
+            self._sq_norms[:len(keys)] = np.einsum("ij,ij->i", mat, mat)
+            self._size = len(keys)
+            self._keys = keys
+            self._row_of = {k: i for i, k in enumerate(keys)}
+        return self
+
+    def load_arrays(self, keys, matrix):
+        """
+        Nạp gallery từ ma trận (N x d) float32 có sẵn KHÔNG copy — vd. np.memmap của gallery_snapshot.
+        Ma trận chỉ-đọc được dùng chung tới khi upsert/remove đầu tiên.
+        """
+        keys = list(keys)
+        matrix = np.asarray(matrix)
+        if matrix.dtype != np.float32 or matrix.ndim != 2 or matrix.shape[0] != len(keys):
+            raise ValueError("Cần ma trận float32 (N x d) khớp với danh sách key_id.")
+        with self._lock:
+            if self.dim is not None and len(keys) and matrix.shape[1] != self.dim:
+                raise ValueError(f"Embedding có {matrix.shape[1]} chiều, gallery yêu cầu {self.dim}.")
+            self.dim = matrix.shape[1] if self.dim is None else self.dim
+            self._data = matrix if len(keys) else None
+            self._sq_norms = np.einsum("ij,ij->i", matrix, matrix) if len(keys) else None
+            self._size = len(keys)
+            self._keys = keys
+            self._row_of = {k: i for i, k in enumerate(keys)}
+        return self
+
+    def upsert(self, key_id, embedding):
+        """Thêm mới hoặc thay vector của key_id tại chỗ (không nạp lại cả gallery)."""
+        vec = self._as_vector(embedding)
+        with self._lock:
+            row = self._row_of.get(key_id)
+            if row is not None:
+                self._ensure_capacity(self._size)   # ghi tại chỗ: không ghi vào mmap chỉ-đọc
+            else:
+                self._ensure_capacity(self._size + 1)
+                row = self._size
+                self._size += 1
+                self._keys.append(key_id)
+                self._row_of[key_id] = row
+            self._data[row] = vec
+            self._sq_norms[row] = float(vec @ vec)
+
+    def remove(self, key_id):
+        """Xóa key_id: đưa hàng cuối vào chỗ trống để ma trận luôn liên tục."""
+        with self._lock:
+            row = self._row_of.pop(key_id, None)
+            if row is None:
+                return False
+            last = self._size - 1
+            self._ensure_capacity(self._size)
+            if row != last:
+                moved = self._keys[last]
+                self._data[row] = self._data[last]
+                self._sq_norms[row] = self._sq_norms[last]
+                self._keys[row] = moved
+                self._row_of[moved] = row
+            self._keys.pop()
+            self._size -= 1
+            return True
+
+    # ---------- truy vấn ----------
+    def distances(self, query):
+        """Khoảng cách (Euclidean hoặc cosine theo metric) từ query tới mọi embedding (vector độ dài N)."""
+        q = self._as_vector(query)
+        with self._lock:
+            if not self._size:
+                return np.empty(0, dtype=np.float32)
+            if self.metric == "cosine":
+                norm = float(np.linalg.norm(q))
+                d = 1.0 - self._data[:self._size] @ (q / norm if norm > 0 else q)
+                return np.maximum(d, 0.0, out=d)
+            # ||x - q||^2 = ||x||^2 - 2 x.q + ||q||^2  -> một phép nhân ma trận-vector
+            d2 = self._sq_norms[:self._size] - 2.0 * (self._data[:self._size] @ q) + float(q @ q)
+        np.maximum(d2, 0.0, out=d2)
+        return np.sqrt(d2)
+
+    def search(self, query, k=1):
+        """
+        Trả về top-k [(key_id, distance), ...] sắp xếp theo khoảng cách tăng dần.
+        Dùng argpartition (O(N)) rồi chỉ sort k phần tử.
+        """
+        with self._lock:
+            dists = self.distances(query)
+            n = dists.shape[0]
+            if n == 0 or k <= 0:
+                return []
+            k = min(k, n)
+            if k == 1:
+                idx = np.array([int(np.argmin(dists))])
+            else:
+                idx = np.argpartition(dists, k - 1)[:k]
+                idx = idx[np.argsort(dists[idx], kind="stable")]
+            return [(self._keys[i], float(dists[i])) for i in idx]
@@ -9,25 +9,29 @@ import re
 
 # ====== IMPORT các module do bạn đã viết (từ file đã upload) ======
 # Đăng ký khuôn mặt + chọn file/camera
-from face_register_pg import get_embedding, insert_embedding, check_existing, capture_image, select_file  # :contentReference[oaicite:3]{index=3}
+from face_register_pg import get_embedding, insert_embedding, check_existing, capture_frame, select_file  # :contentReference[oaicite:3]{index=3}
 # Xác thực khuôn mặt
-from face_verify_pg import verify_person  # :contentReference[oaicite:4]{index=4}
+from face_verify_pg import gallery_upsert, NotEnrolledError  # :contentReference[oaicite:4]{index=4}
+# Xác thực trực tiếp từ camera (dừng khi đủ số khung liên tiếp cùng khớp)
+from live_verify import verify_live
 # Xác thực RSA certificate
-from rsq_mappingid import get_clean_content, verify_signature  # :contentReference[oaicite:5]{index=5}
+from rsq_mappingid import verify_file  # :contentReference[oaicite:5]{index=5}
+# Lưu/tìm/phát hành certificate (CSDL)
+from certificate_store import issue_certificate, delete_certificate, identify_certificate, \
+    cached_search_certificates, search_cache_get, DuplicateCertificateError
+# Xác thực certificate hàng loạt (bảng kết quả CSV/JSON)
+from batch_verify import read_manifest, verify_batch, write_results
+# Model khuôn mặt nạp nền khi mở app
+from embedding_service import get_embedding_service
+from embedding_pool import start_embedding_pool_from_env
+# Cặp khóa RSA sinh sẵn cho phát hành certificate
+from key_pool import start_key_pool_from_env, stop_key_pool, get_key_pool, print_stats as print_key_pool_stats
+# Tác vụ nền cho giao diện (không chặn Tk main loop)
+from task_runner import TaskRunner
 
 
-# ====== CẤU HÌNH CSDL (đồng bộ với các module đã có) ======
-DB_CONFIG = {
-    "host": "127.0.0.1",
-    "user": "user",
-    "password": "password",
-    "dbname": "database",
-    "port": 0000
-}
-
-
-def get_conn():
-    return psycopg2.connect(**DB_CONFIG)
+# ====== CSDL: cấu hình + pool kết nối dùng chung (db.py) ======
+from db import transaction
 
 
 # ====== KHỞI TẠO SCHEMA ======
@@ -68,7 +72,8 @@ CREATE TABLE IF NOT EXISTS certificates (
     student_id TEXT,
     certificate_text TEXT,            -- bản gốc (hiển thị)
     cleaned_text TEXT,                -- clean để chuẩn hóa verify
-    message BYTEA,                    -- bytes để ký/verify
+    message BYTEA,                    -- bytes để ký/verify (NULL khi CERT_STORAGE=digest)
+    digest BYTEA,                     -- SHA-256 của message; chữ ký là RSA-PSS trên digest này
     signature BYTEA,                  -- chữ ký số
     public_key BYTEA,                 -- PEM của người ký (nhà trường/GV)
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
@@ -86,21 +91,85 @@ CREATE TABLE IF NOT EXISTS face_embeddings (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 """
+# Tuỳ chọn: pgvector cho so khớp phía server (face_verify_pg.ANN_CONFIG["engine"] = "pgvector")
+# Sau khi thêm cột, chạy: python embedding_codec.py backfill-vector
+DDL_FACE_EMB_VECTOR = """
+CREATE EXTENSION IF NOT EXISTS vector;
+ALTER TABLE face_embeddings ADD COLUMN IF NOT EXISTS embedding_vec vector(128);
+CREATE INDEX IF NOT EXISTS idx_face_embeddings_vec ON face_embeddings USING hnsw (embedding_vec vector_l2_ops);
+"""
+# NOTIFY mỗi khi face_embeddings thay đổi → gallery của verify tự cập nhật (face_verify_pg.GallerySync)
+DDL_FACE_EMB_NOTIFY = """
+CREATE OR REPLACE FUNCTION notify_face_embeddings_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('face_embeddings_changed', 'DELETE:' || OLD.key_id);
+        RETURN OLD;
+    END IF;
+    PERFORM pg_notify('face_embeddings_changed', TG_OP || ':' || NEW.key_id);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS trg_face_embeddings_notify ON face_embeddings;
+CREATE TRIGGER trg_face_embeddings_notify
+AFTER INSERT OR UPDATE OR DELETE ON face_embeddings
+FOR EACH ROW EXECUTE FUNCTION notify_face_embeddings_changed();
+"""
+# Bảng cũ: thêm cột digest; sau đó chạy: python certificate_store.py backfill-digest
+DDL_CERT_DIGEST = """
+ALTER TABLE certificates ADD COLUMN IF NOT EXISTS digest BYTEA;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_certificates_digest ON certificates(digest);
+"""
+# Tìm kiếm certificate (certificate_store.search_certificates):
+# full-text trên nội dung (cột tsvector sinh tự động + GIN) — có sẵn trong PostgreSQL 12+
+DDL_CERT_FTS = """
+ALTER TABLE certificates ADD COLUMN IF NOT EXISTS search_tsv tsvector
+    GENERATED ALWAYS AS (to_tsvector('simple', coalesce(certificate_text, ''))) STORED;
+CREATE INDEX IF NOT EXISTS idx_cert_search_tsv ON certificates USING gin (search_tsv);
+"""
+# trigram cho ILIKE '%kw%' trên mã — cần extension pg_trgm
+DDL_CERT_TRGM = """
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX IF NOT EXISTS idx_cert_identifier_trgm ON certificates USING gin (identifier gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_cert_student_trgm ON certificates USING gin (student_id gin_trgm_ops);
+"""
 # Index giúp search nhanh
 DDL_INDEXES = """
 CREATE INDEX IF NOT EXISTS idx_face_embeddings_key ON face_embeddings(key_id);
+CREATE INDEX IF NOT EXISTS idx_face_embeddings_created ON face_embeddings(created_at, id);
 CREATE INDEX IF NOT EXISTS idx_students_facekey ON students(face_key);
 CREATE INDEX IF NOT EXISTS idx_cert_identifier ON certificates(identifier);
+CREATE INDEX IF NOT EXISTS idx_cert_created ON certificates(created_at, id);
+-- sắp theo mã SV / mã trường dùng COALESCE(cột, '') (certificate_store._SORT_EXPR) để không mất dòng NULL
+DROP INDEX IF EXISTS idx_cert_student_sort;
+DROP INDEX IF EXISTS idx_cert_school_sort;
+CREATE INDEX IF NOT EXISTS idx_cert_student_coalesce_sort ON certificates((COALESCE(student_id, '')), id);
+CREATE INDEX IF NOT EXISTS idx_cert_school_coalesce_sort ON certificates((COALESCE(school_code, '')), id);
+CREATE INDEX IF NOT EXISTS idx_cert_identifier_sort ON certificates(identifier, id);
 """
 
 def init_schema():
-    conn = get_conn(); cur = conn.cursor()
-    cur.execute(DDL_STUDENTS)
-    cur.execute(DDL_TEACHERS)
-    cur.execute(DDL_FACE_EMB)
-    cur.execute(DDL_CERTIFICATES)   # NEW
-    cur.execute(DDL_INDEXES)        # NEW
-    conn.commit(); conn.close()
+    with transaction() as cur:
+        cur.execute(DDL_STUDENTS)
+        cur.execute(DDL_TEACHERS)
+        cur.execute(DDL_FACE_EMB)
+        cur.execute(DDL_CERTIFICATES)   # NEW
+        cur.execute(DDL_CERT_DIGEST)
+        cur.execute(DDL_CERT_FTS)
+        cur.execute(DDL_INDEXES)        # NEW
+        cur.execute(DDL_FACE_EMB_NOTIFY)
+    # pgvector có thể chưa cài trên server → bỏ qua, verify dùng so khớp trong process
+    try:
+        with transaction() as cur:
+            cur.execute(DDL_FACE_EMB_VECTOR)
+    except psycopg2.Error as e:
+        print(f"[⚠️] Bỏ qua pgvector: {e}")
+    # thiếu pg_trgm → tìm theo mã vẫn chạy (ILIKE), chỉ không có index
+    try:
+        with transaction() as cur:
+            cur.execute(DDL_CERT_TRGM)
+    except psycopg2.Error as e:
+        print(f"[⚠️] Bỏ qua pg_trgm: {e}")
 
 
 
@@ -111,39 +180,36 @@ def sha256(text: str) -> str:
 EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
 
 def create_user(role: str, username: str, email: str, school_code: str, person_id: str, password_hash: str, advisor_teacher_id: str | None = None):
-    conn = get_conn(); cur = conn.cursor()
-    if role == "Học sinh":
-        face_key = f"{school_code}_{person_id}"
-        cur.execute("""
-            INSERT INTO students (student_id, school_code, username, email, password_hash, face_key, advisor_teacher_id)
-            VALUES (%s,%s,%s,%s,%s,%s,%s)
-            ON CONFLICT (username) DO NOTHING
-            RETURNING id;
-        """, (person_id, school_code, username, email, password_hash, face_key, advisor_teacher_id))
-    else:
-        cur.execute("""
-            INSERT INTO teachers (teacher_id, school_code, username, email, password_hash)
-            VALUES (%s,%s,%s,%s,%s)
-            ON CONFLICT (username) DO NOTHING
-            RETURNING id;
-        """, (person_id, school_code, username, email, password_hash))
-    row = cur.fetchone()
-    conn.commit(); conn.close()
+    with transaction() as cur:
+        if role == "Học sinh":
+            face_key = f"{school_code}_{person_id}"
+            cur.execute("""
+                INSERT INTO students (student_id, school_code, username, email, password_hash, face_key, advisor_teacher_id)
+                VALUES (%s,%s,%s,%s,%s,%s,%s)
+                ON CONFLICT (username) DO NOTHING
+                RETURNING id;
+            """, (person_id, school_code, username, email, password_hash, face_key, advisor_teacher_id))
+        else:
+            cur.execute("""
+                INSERT INTO teachers (teacher_id, school_code, username, email, password_hash)
+                VALUES (%s,%s,%s,%s,%s)
+                ON CONFLICT (username) DO NOTHING
+                RETURNING id;
+            """, (person_id, school_code, username, email, password_hash))
+        row = cur.fetchone()
     return row is not None
 
 def find_user(role: str, username: str):
     """Trả về (row_dict or None, table_name)"""
-    conn = get_conn()
-    cur = conn.cursor()
-    if role == "Học sinh":
-        cur.execute("SELECT id, student_id, school_code, username, email, password_hash, face_key, public_key FROM students WHERE username=%s", (username,))
-        row = cur.fetchone()
-        table = "students"
-    else:
-        cur.execute("SELECT id, teacher_id, school_code, username, email, password_hash, public_key FROM teachers WHERE username=%s", (username,))
-        row = cur.fetchone()
-        table = "teachers"
-    conn.close()
+    with transaction() as cur:
+        if role == "Học sinh":
+            cur.execute("SELECT id, student_id, school_code, username, email, password_hash, face_key, public_key FROM students WHERE username=%s", (username,))
+            row = cur.fetchone()
+            table = "students"
+        else:
+            cur.execute("SELECT id, teacher_id, school_code, username, email, password_hash, public_key FROM teachers WHERE username=%s", (username,))
+            row = cur.fetchone()
+            table = "teachers"
     if not row:
         return None, table
     cols = ["id","person_id","school_code","username","email","password_hash","face_key","public_key"] if table=="students" \
@@ -151,17 +217,17 @@ def find_user(role: str, username: str):
     data = dict(zip(cols, row))
     return data, table
 
+def face_key_of(user: dict) -> str:
+    """key_id trong face_embeddings của tài khoản: students.face_key, giáo viên theo quy ước {school_code}_{id}."""
+    return user.get("face_key") or f"{user['school_code']}_{user['person_id']}"
 
 
 def update_public_key(role: str, username: str, public_key_pem: bytes):
-    conn = get_conn()
-    cur = conn.cursor()
-    if role == "Học sinh":
-        cur.execute("UPDATE students SET public_key=%s WHERE username=%s", (public_key_pem, username))
-    else:
-        cur.execute("UPDATE teachers SET public_key=%s WHERE username=%s", (public_key_pem, username))
-    conn.commit()
-    conn.close()
+    with transaction() as cur:
+        if role == "Học sinh":
+            cur.execute("UPDATE students SET public_key=%s WHERE username=%s", (public_key_pem, username))
+        else:
+            cur.execute("UPDATE teachers SET public_key=%s WHERE username=%s", (public_key_pem, username))
 
 
 # ====== 2FA đơn giản ======
@@ -172,48 +238,6 @@ def send_otp_simulated(email: str) -> str:
     return otp
 
 
-def upsert_certificate(identifier: str, school_code: str, student_id: str,
-                       certificate_text: str, cleaned_text: str, message_bytes: bytes,
-                       signature: bytes, public_key_pem: bytes):
-    conn = get_conn(); cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO certificates (identifier, school_code, student_id, certificate_text, cleaned_text, message, signature, public_key)
-        VALUES (%s,%s,%s,%s,%s,%s,%s,%s)
-        ON CONFLICT (identifier) DO UPDATE SET
-            certificate_text=EXCLUDED.certificate_text,
-            cleaned_text=EXCLUDED.cleaned_text,
-            message=EXCLUDED.message,
-            signature=EXCLUDED.signature,
-            public_key=EXCLUDED.public_key,
-            created_at=CURRENT_TIMESTAMP;
-    """, (identifier, school_code, student_id, certificate_text, cleaned_text, message_bytes, signature, public_key_pem))
-    conn.commit(); conn.close()
-
-def delete_certificate(identifier: str):
-    conn = get_conn(); cur = conn.cursor()
-    cur.execute("DELETE FROM certificates WHERE identifier=%s", (identifier,))
-    conn.commit(); conn.close()
-
-def search_certificates(keyword: str):
-    kw = f"%{keyword}%"
-    conn = get_conn(); cur = conn.cursor()
-    cur.execute("""
-        SELECT identifier, school_code, student_id, LEFT(certificate_text,120)
-        FROM certificates
-        WHERE identifier ILIKE %s OR student_id ILIKE %s OR school_code ILIKE %s OR certificate_text ILIKE %s
-        ORDER BY created_at DESC
-        LIMIT 200
-    """, (kw, kw, kw, kw))
-    rows = cur.fetchall()
-    conn.close()
-    return rows
-
-
-
-
-
-
-
 # ====================================================================================================================================
 
 # ====== GIAO DIỆN ======
@@ -226,7 +250,17 @@ class ManagementApp(tk.Tk):
         super().__init__()
         self.title("Phần Mềm Quản Lý Tài Liệu Số")
         self.geometry("900x650")
+        # Thread pool cho camera/embedding/DB/RSA — kết quả trả về qua after()
+        self.tasks = TaskRunner(self)
+        self.protocol("WM_DELETE_WINDOW", self._on_close)
         init_schema()
+        # Đăng nhập xác thực 1:1 theo face_key (verify_live claim=...) → không cần nạp gallery lúc khởi động
+        # FACE_EMBED_WORKERS=N → pool process (mỗi worker một model), ngược lại model trong process
+        self.embedding_service = start_embedding_pool_from_env() or get_embedding_service()
+        self.embedding_service.warm_up(background=True)   # tránh chờ nạp model ở lần đăng nhập đầu
+        # RSA_KEY_POOL_SIZE=N cặp khóa sinh sẵn bởi process nền (mặc định 0 = sinh tại chỗ khi phát hành;
+        # mỗi worker spawn nạp lại module GUI cùng DeepFace nên chỉ bật khi cần)
+        start_key_pool_from_env()
 
         container = tk.Frame(self)
         container.pack(side="top", fill="both", expand=True)
@@ -241,6 +275,24 @@ class ManagementApp(tk.Tk):
             self.frames[F] = frame
             frame.grid(row=0, column=0, sticky="nsew")
         self.show_frame(StartPage)
+        self._poll_model_state()
+
+    def _poll_model_state(self):
+        """Hiển thị trạng thái nạp model khuôn mặt trên thanh tiêu đề."""
+        base = "Phần Mềm Quản Lý Tài Liệu Số"
+        state = self.embedding_service.state
+        if state in ("cold", "warming"):
+            self.title(f"{base} (đang nạp mô hình khuôn mặt...)")
+            self.after(500, self._poll_model_state)
+        elif state == "failed":
+            self.title(f"{base} (lỗi nạp mô hình khuôn mặt)")
+        else:
+            self.title(base)
+
+    def _on_close(self):
+        self.tasks.shutdown()
+        stop_key_pool()
+        self.destroy()
 
     def show_frame(self, cont):
         frame = self.frames[cont]
@@ -272,13 +324,14 @@ class VerificationPage(tk.Frame):
         # self.pkey_entry.pack(side="left", expand=True, fill="x")
 
         ttk.Button(self, text="Tra cứu", command=self.search_document).pack(pady=10)
+        ttk.Button(self, text="Xác thực hàng loạt (CSV)", command=self.bulk_verify).pack(pady=(0, 10))
 
         up_frame = ttk.Frame(self); up_frame.pack(pady=20, padx=20, fill="x")
         ttk.Label(up_frame, text="Chọn file cần xác thực:", font=NORMAL_FONT).pack(side="left", padx=5)
         ttk.Button(up_frame, text="Tải file từ máy", command=self.upload_file).pack(side="left", padx=10)
         id_frame = ttk.Frame(self);
         id_frame.pack(pady=10, padx=20, fill="x")
-        ttk.Label(id_frame, text="Nhập Identifier :", font=NORMAL_FONT) \
+        ttk.Label(id_frame, text="Nhập Identifier (bỏ trống = tìm theo nội dung file):", font=NORMAL_FONT) \
             .pack(side="left", padx=5)
         self.identifier_entry = ttk.Entry(id_frame, font=NORMAL_FONT, width=40)
         self.identifier_entry.pack(side="left", expand=True, fill="x")
@@ -303,26 +356,23 @@ class VerificationPage(tk.Frame):
 
     def search_document(self):
         identifier = self.identifier_entry.get().strip()
-        if not identifier:
-            messagebox.showwarning("Thiếu thông tin", "Vui lòng nhập Identifier.")
-            return
         if not self.selected_file:
             messagebox.showwarning("Thiếu file", "Vui lòng chọn một file để xác thực.")
             return
+        if not identifier:
+            self._identify_document()
+            return
 
         try:
-            cleaned_text, message = get_clean_content(self.selected_file)  # rsq_mappingid
             # Lấy public_key & signature từ DB theo identifier
-            conn = get_conn();
-            cur = conn.cursor()
-            cur.execute("SELECT public_key, signature FROM certificates WHERE identifier=%s", (identifier,))
-            row = cur.fetchone();
-            conn.close()
+            with transaction() as cur:
+                cur.execute("SELECT public_key, signature FROM certificates WHERE identifier=%s", (identifier,))
+                row = cur.fetchone()
             if not row:
                 messagebox.showerror("Không có dữ liệu", "Chưa phát hành certificate cho Identifier này.")
                 return
             public_key_pem, signature = row
-            ok = verify_signature(public_key_pem, signature, message)
+            ok = verify_file(public_key_pem, signature, self.selected_file)  # băm SHA-256 theo luồng
             if ok:
                 messagebox.showinfo("✅ Hợp lệ", "Chứng chỉ hợp lệ, nội dung đúng với chữ ký.")
             else:
@@ -330,6 +380,48 @@ class VerificationPage(tk.Frame):
         except Exception as e:
             messagebox.showerror("Lỗi", f"Lỗi xác thực: {str(e)}")
 
+    def _identify_document(self):
+        """Không nhập Identifier → tìm certificate theo digest SHA-256 của file (index unique)."""
+        def on_done(result):
+            identifier, ok = result
+            if identifier is None:
+                messagebox.showerror("Không có dữ liệu", "Không có certificate nào trùng khớp với nội dung file này.")
+            elif ok:
+                messagebox.showinfo("✅ Hợp lệ", f"File là certificate {identifier}, nội dung đúng với chữ ký.")
+            else:
+                messagebox.showerror("❌ Sai", f"File khớp certificate {identifier} nhưng chữ ký không hợp lệ.")
+
+        self.controller.tasks.submit(identify_certificate, self.selected_file, on_done=on_done,
+                                     on_error=lambda e: messagebox.showerror("Lỗi", f"Lỗi xác thực: {e}"))
+
+    def bulk_verify(self):
+        """Xác thực nhiều (identifier, file) từ CSV; ghi bảng kết quả ra CSV/JSON."""
+        manifest = filedialog.askopenfilename(title="Chọn CSV (identifier, path)",
+                                              filetypes=[("CSV", "*.csv"), ("Tất cả", "*.*")])
+        if not manifest:
+            return
+        out_path = filedialog.asksaveasfilename(title="Lưu kết quả", defaultextension=".csv",
+                                                filetypes=[("CSV", "*.csv"), ("JSON", "*.json")])
+        if not out_path:
+            return
+
+        def run():
+            items = read_manifest(manifest)
+            # processes=1: process "spawn" con sẽ nạp lại cả module GUI (DeepFace) → chạy tại chỗ trên thread nền
+            results, stats = verify_batch(items, processes=1)
+            write_results(results, stats, out_path)
+            return stats
+
+        def on_done(stats):
+            verdicts = ", ".join(f"{k}: {v}" for k, v in sorted(stats["verdicts"].items())) or "không có dòng nào"
+            messagebox.showinfo("Kết quả", f"Đã xác thực {stats['total']} file ({verdicts}) "
+                                            f"trong {stats['seconds']:.1f}s.\nĐã lưu: {out_path}")
+
+        self.controller.tasks.submit(run, on_done=on_done, busy="Đang xác thực hàng loạt...")
+
+
+FACE_NOT_ENROLLED = "not_enrolled"   # kết quả xác thực khuôn mặt: claim chưa có embedding (≠ hủy / không khớp)
+
 
 class LoginPage(tk.Frame):
     def __init__(self, parent, controller):
@@ -363,30 +455,58 @@ class LoginPage(tk.Frame):
         password = self.pass_entry.get().strip()
         role = self.role_var.get()
 
-        user, table = find_user(role, username)
-        if not user:
-            messagebox.showerror("Sai thông tin", "Tài khoản không tồn tại.")
-            return
+        # DB / camera / verify chạy nền (TaskRunner), kết quả quay lại Tk main loop
+        def on_user(result):
+            user, table = result
+            if not user:
+                messagebox.showerror("Sai thông tin", "Tài khoản không tồn tại.")
+                return
 
-        if sha256(password) != user["password_hash"]:
-            messagebox.showerror("Sai thông tin", "Mật khẩu không đúng.")
-            return
+            if sha256(password) != user["password_hash"]:
+                messagebox.showerror("Sai thông tin", "Mật khẩu không đúng.")
+                return
 
-        # Đề nghị xác thực khuôn mặt
-        use_face = messagebox.askyesno("Xác thực khuôn mặt", "Bạn có muốn đăng nhập bằng khuôn mặt?")
-        if use_face:
-            # Chụp ảnh nhanh, xác thực qua verify_person (DeepFace):contentReference[oaicite:8]{index=8}
-            img_path = capture_image()  # dùng lại tiện ích từ face_register_pg:contentReference[oaicite:9]{index=9}
-            if img_path:
-                matched, dist = verify_person(img_path, threshold=10)  # :contentReference[oaicite:10]{index=10}
-                # Nếu là học sinh thì matched nên bằng face_key
-                if matched and (role != "Học sinh" or matched == user.get("face_key")):
-                    messagebox.showinfo("Thành công", f"Đăng nhập bằng khuôn mặt thành công ({matched})")
-                    self._go_dashboard(role)
-                    return
-                else:
-                    messagebox.showwarning("Không khớp", "Không nhận diện được khuôn mặt của bạn.")
+            # Đề nghị xác thực khuôn mặt
+            use_face = messagebox.askyesno("Xác thực khuôn mặt", "Bạn có muốn đăng nhập bằng khuôn mặt?")
+            if use_face:
+                claim = face_key_of(user)
+                self.controller.tasks.submit_camera(self._capture_and_verify, claim, title="Xác thực khuôn mặt",
+                                                    on_done=lambda res: self._after_face(res, role, user))
+            else:
+                self._fallback_2fa(role, user)
+
+        self.controller.tasks.submit(find_user, role, username, on_done=on_user)
+
+    @staticmethod
+    def _capture_and_verify(task, preview, claim):
+        # Luồng camera → phát hiện mặt → cổng chất lượng → embedding trong RAM, không cần nhấn 's';
+        # so 1:1 với embedding của claim (một dòng qua idx_face_embeddings_key).
+        # Xem trước vẽ bằng Tk (preview), không dùng cv2.imshow trên thread nền.
+        try:
+            matched, dist = verify_live(cancel=task.cancelled, on_progress=task.report, claim=claim,
+                                        show=False, on_frame=preview.push)
+        except NotEnrolledError:
+            return FACE_NOT_ENROLLED
+        if matched is None and dist is None:
+            return None   # hủy / không mở được camera
+        return matched, dist
+
+    def _after_face(self, result, role, user):
+        if result == FACE_NOT_ENROLLED:
+            messagebox.showwarning("Chưa đăng ký khuôn mặt",
+                                   f"Tài khoản chưa đăng ký khuôn mặt ({face_key_of(user)}).")
+        elif result is not None:
+            matched, dist = result
+            # verify_live chỉ trả về key_id đã claim khi khớp
+            if matched:
+                messagebox.showinfo("Thành công", f"Đăng nhập bằng khuôn mặt thành công ({matched})")
+                self._go_dashboard(role)
+                return
+            else:
+                messagebox.showwarning("Không khớp", "Không nhận diện được khuôn mặt của bạn.")
+        self._fallback_2fa(role, user)
 
+    def _fallback_2fa(self, role, user):
         # Fallback 2FA
         go_2fa = messagebox.askyesno("2FA", "Dùng xác thực 2 bước (OTP) thay thế?")
         if go_2fa:
@@ -448,29 +568,59 @@ class RegisterPage(tk.Frame):
             messagebox.showwarning("Thiếu thông tin", "Vui lòng nhập Mã Trường và Mã SV/GV trước.")
             return
         key_id = f"{school_code}_{person_id}"
+        tasks = self.controller.tasks
 
-        if check_existing(key_id):  # :contentReference[oaicite:11]{index=11}
-            if not messagebox.askyesno("Đã tồn tại", f"Khuôn mặt {key_id} đã đăng ký. Cập nhật lại?"):
-                return
-
-        # Cho phép chọn camera hay file
-        if messagebox.askyesno("Nguồn ảnh", "Chụp bằng camera? (No = chọn file)"):
-            img_path = capture_image()  # :contentReference[oaicite:12]{index=12}
-        else:
-            img_path = select_file()    # :contentReference[oaicite:13]{index=13}
+        def on_checked(exists):
+            if exists:
+                if not messagebox.askyesno("Đã tồn tại", f"Khuôn mặt {key_id} đã đăng ký. Cập nhật lại?"):
+                    return
 
-        if not img_path:
-            messagebox.showwarning("Không có ảnh", "Bạn chưa cung cấp ảnh.")
-            return
+            # Cho phép chọn camera hay file (hộp thoại file phải ở main thread)
+            if messagebox.askyesno("Nguồn ảnh", "Chụp bằng camera? (No = chọn file)"):
+                tasks.submit_camera(self._enroll, school_code, person_id, key_id, None,
+                                    title="Đăng ký khuôn mặt", capture_label="Chụp", on_done=on_enrolled)
+            else:
+                img_path = select_file()    # :contentReference[oaicite:13]{index=13}
+                if not img_path:
+                    messagebox.showwarning("Không có ảnh", "Bạn chưa cung cấp ảnh.")
+                    return
+                tasks.submit(self._enroll, None, school_code, person_id, key_id, img_path, with_task=True,
+                             on_done=on_enrolled, busy="Đang trích xuất embedding...")
 
-        emb = get_embedding(img_path)   # :contentReference[oaicite:14]{index=14}
+        def on_enrolled(status):
+            if status == "cancelled":
+                return
+            if status == "no_image":
+                messagebox.showwarning("Không có ảnh", "Bạn chưa cung cấp ảnh.")
+            elif status == "no_embedding":
+                messagebox.showerror("Thất bại", "Không thể trích xuất embedding từ ảnh.")
+            else:
+                messagebox.showinfo("Thành công", f"Đã lưu/cập nhật khuôn mặt: {key_id}")
+
+        tasks.submit(check_existing, key_id, on_done=on_checked)  # :contentReference[oaicite:11]{index=11}
+
+    @staticmethod
+    def _enroll(task, preview, school_code, person_id, key_id, img_path):
+        """Chạy nền: (chụp ảnh) → embedding → lưu DB. Trả về trạng thái cho giao diện."""
+        image = img_path
+        if img_path is None:
+            # khung hình giữ trong RAM, không ghi file tạm; xem trước + nút "Chụp" nằm trong preview (Tk)
+            image = capture_frame(show=False, on_frame=preview.push, capture=preview.capture,
+                                  cancel=task.cancelled)
+            if image is None:
+                return "cancelled" if task.cancelled.is_set() else "no_image"
+            task.report("Đang trích xuất embedding...")
+
+        emb = get_embedding(image)   # :contentReference[oaicite:14]{index=14}
         if emb is None:
-            messagebox.showerror("Thất bại", "Không thể trích xuất embedding từ ảnh.")
-            return
+            return "no_embedding"
+        if task.cancelled.is_set():
+            return "cancelled"
 
         # Lưu embedding vào bảng face_embeddings
         insert_embedding(school_code, person_id, key_id, emb, img_path)  # :contentReference[oaicite:15]{index=15}
-        messagebox.showinfo("Thành công", f"Đã lưu/cập nhật khuôn mặt: {key_id}")
+        gallery_upsert(key_id, emb)  # đồng bộ gallery trong RAM của verify
+        return "ok"
 
     def handle_register(self):
         role = self.role_var.get()
@@ -504,23 +654,21 @@ class RegisterPage(tk.Frame):
                 messagebox.showwarning("Thiếu GV", "Học sinh phải chọn Mã Giáo viên quản lý.")
                 return
 
-            # 1) Check GV tồn tại
-            conn = get_conn();
-            cur = conn.cursor()
-            cur.execute("SELECT 1 FROM teachers WHERE teacher_id=%s", (advisor_teacher_id,))
-            if cur.fetchone() is None:
-                conn.close()
+            # 1) Check GV tồn tại + 2) Check face key_id đã có — cùng một kết nối từ pool
+            key_id = f"{school_code}_{person_id}"
+            with transaction() as cur:
+                cur.execute("SELECT 1 FROM teachers WHERE teacher_id=%s", (advisor_teacher_id,))
+                teacher_ok = cur.fetchone() is not None
+                face_ok = False
+                if teacher_ok:
+                    cur.execute("SELECT 1 FROM face_embeddings WHERE key_id=%s", (key_id,))
+                    face_ok = cur.fetchone() is not None
+            if not teacher_ok:
                 messagebox.showerror("Sai Mã GV", "Mã Giáo viên không tồn tại.")
                 return
-
-            # 2) Check face key_id đã có
-            key_id = f"{school_code}_{person_id}"
-            cur.execute("SELECT 1 FROM face_embeddings WHERE key_id=%s", (key_id,))
-            if cur.fetchone() is None:
-                conn.close()
+            if not face_ok:
                 messagebox.showerror("Chưa có khuôn mặt", "Vui lòng đăng ký khuôn mặt trước (face key chưa tồn tại).")
                 return
-            conn.close()
 
         # 3) TẤT CẢ điều kiện OK -> mới tạo user
         ok = create_user(role, username, email, school_code, person_id, sha256(p1), advisor_teacher_id)
@@ -548,26 +696,24 @@ class StudentDashboard(tk.Frame):
         if not username:
             return
 
-        # Tìm student
-        conn = get_conn();
-        cur = conn.cursor()
-        cur.execute("SELECT student_id, school_code FROM students WHERE username=%s", (username,))
-        row = cur.fetchone()
+        with transaction() as cur:
+            # Tìm student
+            cur.execute("SELECT student_id, school_code FROM students WHERE username=%s", (username,))
+            row = cur.fetchone()
+            if row:
+                student_id, school_code = row
+                identifier = f"{school_code}_{student_id}"
+
+                # Lấy certificate + khóa/ chữ ký
+                cur.execute("""
+                            SELECT certificate_text, public_key, signature
+                            FROM certificates
+                            WHERE identifier = %s
+                            """, (identifier,))
+                row2 = cur.fetchone()
         if not row:
-            conn.close()
             messagebox.showerror("Không thấy", "Không tìm thấy học sinh.")
             return
-        student_id, school_code = row
-        identifier = f"{school_code}_{student_id}"
-
-        # Lấy certificate + khóa/ chữ ký
-        cur.execute("""
-                    SELECT certificate_text, public_key, signature
-                    FROM certificates
-                    WHERE identifier = %s
-                    """, (identifier,))
-        row2 = cur.fetchone()
-        conn.close()
 
         self.info.delete("1.0", "end")
 
@@ -608,9 +754,22 @@ class TeacherDashboard(tk.Frame):
 
 
 class TeacherActionsPage(tk.Frame):
+    PAGE_SIZE = 100
+    SEARCH_DEBOUNCE_MS = 250
+    # lựa chọn "Sắp xếp theo" → cột ORDER BY trong certificate_store.search_certificates
+    SORT_OPTIONS = {"Ngày cấp": "created_at", "Mã sinh viên": "student_id", "Mã trường": "school_code",
+                    "Identifier": "identifier", "Liên quan": "relevance"}
+
     def __init__(self, parent, controller):
         super().__init__(parent, bg=PRIMARY_COLOR)
         self.controller = controller
+        self._generation = 0      # tăng mỗi lần tải lại → bỏ kết quả của truy vấn cũ
+        self._query = ("", "created_at")
+        self._cursor = None
+        self._has_more = False
+        self._loading = False
+        self._search_task = None   # truy vấn trang đang chạy (hủy khi có truy vấn mới)
+        self._debounce_id = None
         self.columnconfigure(0, weight=1); self.columnconfigure(1, weight=3)
         self.rowconfigure(1, weight=1)
 
@@ -636,11 +795,12 @@ class TeacherActionsPage(tk.Frame):
 
         sort = ttk.Frame(right, padding="5"); sort.grid(row=1, column=0, sticky="ew")
         ttk.Label(sort, text="Sắp xếp theo:", font=NORMAL_FONT).pack(side="left", padx=(0,5))
-        self.sort_var = tk.StringVar(value="Mã sinh viên")
+        self.sort_var = tk.StringVar(value="Ngày cấp")
         cbx = ttk.Combobox(sort, textvariable=self.sort_var, state="readonly", font=NORMAL_FONT, width=15)
-        cbx["values"] = ("Mã sinh viên", "Tên sinh viên", "Ngày cấp", "Loại tài liệu")
+        cbx["values"] = tuple(self.SORT_OPTIONS)
         cbx.pack(side="left", padx=5)
-        ttk.Button(sort, text="Áp dụng Sắp xếp", command=lambda: self._msg(f"Sắp xếp: {self.sort_var.get()}")).pack(side="left", padx=5)
+        ttk.Button(sort, text="Áp dụng Sắp xếp",
+                   command=lambda: self.reload_table(self.search_entry.get().strip())).pack(side="left", padx=5)
 
         disp = ttk.Frame(right, relief=tk.FLAT, padding="10"); disp.grid(row=2, column=0, sticky="nsew", padx=10, pady=10)
         disp.columnconfigure(0, weight=1); disp.rowconfigure(0, weight=1)
@@ -652,7 +812,11 @@ class TeacherActionsPage(tk.Frame):
         for c, w in [("identifier", 180), ("school", 100), ("student", 120), ("preview", 400)]:
             self.tree.heading(c, text=c)
             self.tree.column(c, width=w, anchor="w")
-        self.tree.grid(row=2, column=0, sticky="nsew", padx=10, pady=10)
+        self.tree.grid(row=2, column=0, sticky="nsew", padx=(10, 0), pady=10)
+        # chỉ nạp trang kế khi cuộn gần cuối danh sách
+        self.tree_scroll = ttk.Scrollbar(right, orient="vertical", command=self.tree.yview)
+        self.tree_scroll.grid(row=2, column=1, sticky="ns", padx=(0, 10), pady=10)
+        self.tree.configure(yscrollcommand=self._on_tree_scroll)
 
         btnbar = ttk.Frame(right);
         btnbar.grid(row=3, column=0, sticky="ew", padx=10, pady=(0, 10))
@@ -661,19 +825,88 @@ class TeacherActionsPage(tk.Frame):
         ttk.Button(btnbar, text="Xóa chứng chỉ", command=self.delete_selected_certificate).pack(side="left", padx=5)
         ttk.Button(btnbar, text="Tải danh sách", command=self.reload_table).pack(side="left", padx=5)
 
-        # Sự kiện search
-        def do_search():
+        # Sự kiện search: gõ tới đâu tìm tới đó (debounce), Enter / "Tìm" tìm ngay
+        def do_search(_event=None):
+            self._cancel_debounce()
             kw = self.search_entry.get().strip()
             self.reload_table(kw)
 
         ttk.Button(top, text="Tìm", command=do_search).grid(row=0, column=2, padx=(5, 0), pady=5)
+        self.search_entry.bind("<Return>", do_search)
+        self.search_entry.bind("<KeyRelease>", self._on_search_key)
+
+    def _cancel_debounce(self):
+        if self._debounce_id is not None:
+            self.after_cancel(self._debounce_id)
+            self._debounce_id = None
+
+    def _on_search_key(self, event):
+        if event.keysym in ("Return", "KP_Enter"):
+            return
+        kw = self.search_entry.get().strip()
+        if kw == self._query[0]:
+            return   # phím điều hướng / Shift... không đổi từ khóa
+        self._cancel_debounce()
+        self._debounce_id = self.after(self.SEARCH_DEBOUNCE_MS, self._run_debounced_search)
+
+    def _run_debounced_search(self):
+        self._debounce_id = None
+        kw = self.search_entry.get().strip()
+        if kw != self._query[0]:
+            self.reload_table(kw)
 
     def reload_table(self, keyword: str = ""):
-        for i in self.tree.get_children():
-            self.tree.delete(i)
-        rows = search_certificates(keyword)
-        for (iden, sch, st, pv) in rows:
-            self.tree.insert("", "end", values=(iden, sch, st, pv))
+        """Xóa bảng và nạp trang đầu; các trang sau nạp dần khi cuộn (keyset, chạy nền)."""
+        self._generation += 1
+        if self._search_task is not None:
+            self._search_task.cancel()   # hủy truy vấn cũ (kể cả đang chạy trên server)
+            self._search_task = None
+        self._query = (keyword, self.SORT_OPTIONS.get(self.sort_var.get(), "created_at"))
+        self._cursor = None
+        self._has_more = True
+        self._loading = False
+        self.tree.delete(*self.tree.get_children())
+        self._load_next_page()
+
+    def _load_next_page(self):
+        if self._loading or not self._has_more:
+            return
+        self._loading = True
+        generation = self._generation
+        keyword, sort = self._query
+        cursor = self._cursor
+
+        def on_done(result):
+            if generation != self._generation:
+                return
+            self._search_task = None
+            rows, self._cursor = result
+            self._has_more = self._cursor is not None
+            self._loading = False
+            for (iden, sch, st, pv) in rows:
+                self.tree.insert("", "end", values=(iden, sch, st, pv))
+
+        def on_error(e):
+            if generation == self._generation:
+                self._search_task = None
+                self._loading = False
+                self._has_more = False
+                messagebox.showerror("Lỗi", f"Không tải được danh sách: {e}")
+
+        # gõ lùi / gõ lại: kết quả có trong cache LRU → hiển thị ngay, không chạm DB
+        cached = search_cache_get(keyword, sort, cursor, self.PAGE_SIZE)
+        if cached is not None:
+            on_done(cached)
+            return
+        self._search_task = self.controller.tasks.submit(
+            lambda task: cached_search_certificates(keyword, sort, cursor, self.PAGE_SIZE, on_cancel=task.on_cancel),
+            with_task=True, on_done=on_done, on_error=on_error)
+
+    def _on_tree_scroll(self, first, last):
+        self.tree_scroll.set(first, last)
+        # bảng chưa hiển thị thì yview luôn là (0, 1) → không tự nạp hết mọi trang
+        if float(last) > 0.9 and self.tree.winfo_ismapped():
+            self._load_next_page()
 
     def delete_selected_certificate(self):
         item = self.tree.selection()
@@ -699,44 +932,21 @@ class TeacherActionsPage(tk.Frame):
         if not path:
             return
 
-        # Lấy nội dung sạch & message theo rsq_mappingid
-        cleaned_text, message = get_clean_content(path)  # từ rsq_mappingid.py
-        with open(path, "r", encoding="utf-8", errors="ignore") as f:
-            certificate_text = f.read()
+        def on_done(_):
+            if get_key_pool() is not None:
+                print_key_pool_stats(get_key_pool().stats())   # depth / tốc độ bù của key pool
+            messagebox.showinfo("OK", f"Đã phát hành/ cập nhật certificate cho {identifier}")
+            self.reload_table()
 
-        # Tạo/có public key của Nhà trường/GV ký (demo: ký theo identifier)
-        # - Private key lưu local, public key lưu DB
-        # Nếu chưa có private, generate:
-        try:
-            # generate nếu chưa có, trả về (identifier, pem)
-            from rsq_mappingid import generate_keys, sign_message
-            _, pem_public = generate_keys(school_code, student_id)  # private lưu ./keys
-        except Exception:
-            # nếu đã có khóa thì chỉ cần đọc public == sẽ ký phía dưới
-            from rsq_mappingid import sign_message
-            with open(os.path.join("keys", f"{identifier}_private.pem"), "rb") as _:
-                pass
-            # Lấy public_key hiện có từ teachers (ưu tiên) hay students
-            conn = get_conn();
-            cur = conn.cursor()
-            cur.execute("SELECT public_key FROM teachers WHERE teacher_id=%s", (school_code,))  # tuỳ chính sách
-            row = cur.fetchone()
-            if row and row[0]:
-                pem_public = row[0]
+        def on_error(e):
+            if isinstance(e, DuplicateCertificateError):
+                messagebox.showwarning("Trùng văn bằng", str(e))
             else:
-                # fallback: không có — có thể lấy từ students hoặc generate lại
-                from rsq_mappingid import generate_keys as gen2
-                _, pem_public = gen2(school_code, student_id)
-            conn.close()
-
-        # Ký digital
-        signature = sign_message(identifier, message)
-
-        # Lưu certificates
-        upsert_certificate(identifier, school_code, student_id, certificate_text, cleaned_text, message, signature,
-                           pem_public)
-        messagebox.showinfo("OK", f"Đã phát hành/ cập nhật certificate cho {identifier}")
-        self.reload_table()
+                messagebox.showerror("Lỗi", f"Không phát hành được certificate: {e}")
+
+        # Đọc file + sinh khóa RSA + ký + lưu DB chạy nền
+        self.controller.tasks.submit(issue_certificate, school_code, student_id, path, on_done=on_done,
+                                     on_error=on_error, busy=f"Đang phát hành certificate cho {identifier}...")
 
     def _msg(self, text):
         messagebox.showinfo("Thông báo", f"Chức năng '{text}' đang được phát triển.")
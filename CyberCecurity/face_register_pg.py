@@ -1,85 +1,151 @@
 import os
-import pickle
-import psycopg2
-import numpy as np
 import cv2
-from deepface import DeepFace
+from embedding_service import get_embedding_service
+from embedding_pool import get_embedding_pool, start_embedding_pool_from_env
+from embedding_codec import encode_embedding, decode_normalized, to_pgvector, l2_normalize
+from db import transaction   # pool kết nối + DB_CONFIG dùng chung
 import tkinter as tk
 from tkinter import filedialog, Tk, messagebox
 import threading
 import traceback
 import os
 
-# ================= DATABASE CONFIG =================
-DB_CONFIG = {
-    "host": "127.0.0.1",
-    "user": "postgres",
-    "password": "huyyuh",   # đổi theo PostgreSQL của bạn
-    "dbname": "cyber_verify_certificate",
-    "port": 5432
-}
-
-def get_conn():
-    return psycopg2.connect(**DB_CONFIG)
-
 # ================= EMBEDDING FUNCTIONS =================
-def get_embedding(image_path):
-    try:
-        rep = DeepFace.represent(img_path=image_path, model_name="Facenet", enforce_detection=False)
-        return np.array(rep[0]['embedding'])
-    except Exception as e:
-        print(f"[❌] Không thể lấy embedding: {e}")
-        return None
+def get_embedding(image):
+    # image: đường dẫn, khung hình ndarray (BGR) hoặc bytes ảnh đã mã hóa — không cần file tạm.
+    # Model Facenet + detector được nạp một lần và dùng lại (embedding_service);
+    # nếu đã bật pool process (embedding_pool) thì chuyển sang worker
+    pool = get_embedding_pool()
+    return (pool or get_embedding_service()).represent(image)
 
 def check_existing(key_id):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT 1 FROM face_embeddings WHERE key_id=%s", (key_id,))
-    exists = cur.fetchone() is not None
-    conn.close()
-    return exists
+    with transaction() as cur:
+        cur.execute("SELECT 1 FROM face_embeddings WHERE key_id=%s", (key_id,))
+        return cur.fetchone() is not None
+
+_HAS_VECTOR_COLUMN = None
+
+def has_vector_column(cur):
+    """face_embeddings có cột pgvector embedding_vec không (kiểm tra một lần/process)."""
+    global _HAS_VECTOR_COLUMN
+    if _HAS_VECTOR_COLUMN is None:
+        cur.execute("""
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name = 'face_embeddings' AND column_name = 'embedding_vec'
+        """)
+        _HAS_VECTOR_COLUMN = cur.fetchone() is not None
+    return _HAS_VECTOR_COLUMN
 
 def insert_embedding(ma_truong, ma_sv, key_id, embedding, image_path):
-    conn = get_conn()
-    cur = conn.cursor()
-    emb_blob = pickle.dumps(embedding)
-    cur.execute("""
-        INSERT INTO face_embeddings (ma_truong, ma_sv, key_id, embedding, image_path)
-        VALUES (%s, %s, %s, %s, %s)
-        ON CONFLICT (key_id) DO UPDATE 
-        SET embedding = EXCLUDED.embedding, image_path = EXCLUDED.image_path, created_at = CURRENT_TIMESTAMP;
-    """, (ma_truong, ma_sv, key_id, emb_blob, image_path))
-    conn.commit()
-    conn.close()
+    embedding = l2_normalize(embedding)      # lưu vector đơn vị → so khớp bằng tích vô hướng
+    emb_blob = encode_embedding(embedding, normalized=True)   # float32 + header, xem embedding_codec
+    with transaction() as cur:
+        if has_vector_column(cur):
+            cur.execute("""
+                INSERT INTO face_embeddings (ma_truong, ma_sv, key_id, embedding, embedding_vec, image_path)
+                VALUES (%s, %s, %s, %s, %s::vector, %s)
+                ON CONFLICT (key_id) DO UPDATE 
+                SET embedding = EXCLUDED.embedding, embedding_vec = EXCLUDED.embedding_vec,
+                    image_path = EXCLUDED.image_path, created_at = CURRENT_TIMESTAMP;
+            """, (ma_truong, ma_sv, key_id, emb_blob, to_pgvector(embedding), image_path))
+        else:
+            cur.execute("""
+                INSERT INTO face_embeddings (ma_truong, ma_sv, key_id, embedding, image_path)
+                VALUES (%s, %s, %s, %s, %s)
+                ON CONFLICT (key_id) DO UPDATE 
+                SET embedding = EXCLUDED.embedding, image_path = EXCLUDED.image_path, created_at = CURRENT_TIMESTAMP;
+            """, (ma_truong, ma_sv, key_id, emb_blob, image_path))
     print(f"[✅] Đã lưu hoặc cập nhật embedding cho {key_id}")
 
-def load_all_embeddings():
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT key_id, embedding FROM face_embeddings")
-    data = {k: pickle.loads(v) for k, v in cur.fetchall()}
-    conn.close()
-    return data
+def insert_embeddings_batch(rows):
+    """
+    Ghi nhiều embedding bằng MỘT câu execute_values (một round trip/lô).
+    rows: [(ma_truong, ma_sv, key_id, embedding, image_path)]
+    """
+    from psycopg2.extras import execute_values
+    # ON CONFLICT không cho phép cùng key_id hai lần trong một câu → giữ bản cuối
+    rows = [(mt, sv, key, l2_normalize(emb), path) for mt, sv, key, emb, path in {r[2]: r for r in rows}.values()]
+    if not rows:
+        return 0
+    with transaction() as cur:
+        if has_vector_column(cur):
+            values = [(mt, sv, key, encode_embedding(emb, normalized=True), to_pgvector(emb), path)
+                      for mt, sv, key, emb, path in rows]
+            execute_values(cur, """
+                INSERT INTO face_embeddings (ma_truong, ma_sv, key_id, embedding, embedding_vec, image_path)
+                VALUES %s
+                ON CONFLICT (key_id) DO UPDATE
+                SET embedding = EXCLUDED.embedding, embedding_vec = EXCLUDED.embedding_vec,
+                    image_path = EXCLUDED.image_path, created_at = CURRENT_TIMESTAMP;
+            """, values, template="(%s, %s, %s, %s, %s::vector, %s)", page_size=len(values))
+        else:
+            values = [(mt, sv, key, encode_embedding(emb, normalized=True), path) for mt, sv, key, emb, path in rows]
+            execute_values(cur, """
+                INSERT INTO face_embeddings (ma_truong, ma_sv, key_id, embedding, image_path)
+                VALUES %s
+                ON CONFLICT (key_id) DO UPDATE
+                SET embedding = EXCLUDED.embedding, image_path = EXCLUDED.image_path, created_at = CURRENT_TIMESTAMP;
+            """, values, page_size=len(values))
+    return len(rows)
+
+def load_all_embeddings(since=None):
+    """since: chỉ lấy các dòng có created_at >= since (None = toàn bộ)."""
+    with transaction() as cur:
+        if since is None:
+            cur.execute("SELECT key_id, embedding FROM face_embeddings")
+        else:
+            cur.execute("SELECT key_id, embedding FROM face_embeddings WHERE created_at >= %s", (since,))
+        return {k: decode_normalized(v) for k, v in cur.fetchall()}
 
 # ================= IMAGE CAPTURE =================
-def capture_image(save_path="temp_capture.jpg"):
+def capture_frame(show=None, on_frame=None, capture=None, cancel=None):
+    """
+    Khung hình BGR (ndarray), không ghi file.
+    - show=True (mặc định khi chạy ở main thread): cửa sổ cv2, nhấn 's' để chụp, 'q' để thoát
+    - show=False (mặc định ở thread nền — HighGUI không an toàn ngoài main thread): mỗi khung được đưa cho
+      on_frame(frame) (vd. task_runner.CameraPreview.push); chụp khi sự kiện `capture` được set,
+      trả về None khi `cancel` được set
+    """
+    if show is None:
+        show = threading.current_thread() is threading.main_thread()
+    if not show and capture is None:
+        raise ValueError("capture_frame ngoài main thread cần sự kiện capture (không có cửa sổ cv2).")
     cap = cv2.VideoCapture(0)
-    print("Nhấn 's' để chụp, 'q' để thoát.")
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            continue
-        cv2.imshow("Camera", frame)
-        key = cv2.waitKey(1) & 0xFF
-        if key == ord('s'):
-            cv2.imwrite(save_path, frame)
-            print(f"[📸] Đã lưu ảnh tạm tại {save_path}")
-            break
-        elif key == ord('q'):
-            save_path = None
-            break
-    cap.release()
-    cv2.destroyAllWindows()
+    if show:
+        print("Nhấn 's' để chụp, 'q' để thoát.")
+    captured = None
+    try:
+        while cancel is None or not cancel.is_set():
+            ret, frame = cap.read()
+            if not ret:
+                continue
+            if on_frame is not None:
+                on_frame(frame)
+            if show:
+                cv2.imshow("Camera", frame)
+                key = cv2.waitKey(1) & 0xFF
+                if key == ord('s'):
+                    captured = frame
+                elif key == ord('q'):
+                    break
+            elif capture.is_set():
+                captured = frame
+            if captured is not None:
+                print("[📸] Đã chụp ảnh")
+                break
+    finally:
+        cap.release()
+        if show:
+            cv2.destroyAllWindows()
+    return captured
+
+def capture_image(save_path="temp_capture.jpg"):
+    """Như capture_frame nhưng ghi ảnh ra file và trả về đường dẫn (khi cần giữ lại ảnh)."""
+    frame = capture_frame()
+    if frame is None:
+        return None
+    cv2.imwrite(save_path, frame)
+    print(f"[📸] Đã lưu ảnh tại {save_path}")
     return save_path
 
 def select_file():
@@ -122,6 +188,7 @@ def select_file():
 # ================= MAIN MENU =================
 if __name__ == "__main__":
     print("=== ĐĂNG KÝ KHUÔN MẶT SINH VIÊN ===")
+    start_embedding_pool_from_env()   # FACE_EMBED_WORKERS=N → dùng pool process
     ma_truong = input("Nhập mã trường: ").strip()
     ma_sv = input("Nhập mã sinh viên: ").strip()
     key_id = f"{ma_truong}_{ma_sv}"
@@ -137,10 +204,11 @@ if __name__ == "__main__":
     print("2. Tải ảnh từ máy tính")
     option = input("Lựa chọn (1/2): ").strip()
 
+    image_path = None
     if option == "1":
-        image_path = capture_image()
+        image = capture_frame()      # khung hình đi thẳng vào model, không ghi file
     elif option == "2":
-        image_path = select_file()
+        image = image_path = select_file()
         if image_path:
             print(f"Bạn đã chọn file: {image_path}")
         else:
@@ -149,7 +217,10 @@ if __name__ == "__main__":
         print("❌ Lựa chọn không hợp lệ.")
         exit()
 
-    embedding = get_embedding(image_path)
+    if image is None:
+        print("❌ Không có ảnh.")
+        exit()
+    embedding = get_embedding(image)
     if embedding is not None:
         insert_embedding(ma_truong, ma_sv, key_id, embedding, image_path)
     else:
@@ -1,67 +1,621 @@
 import psycopg2
-import pickle
+import psycopg2.errors
+import psycopg2.extensions
 import numpy as np
 import cv2
 import os
-from deepface import DeepFace
-
-# ========== DATABASE CONFIG ==========
-DB_CONFIG = {
-    "host": "127.0.0.1",
-    "user": "postgres",
-    "password": "huyyuh",   # đổi theo PostgreSQL của bạn
-    "dbname": "cyber_verify_certificate",
-    "port": 5432
+import json
+import time
+import select
+import threading
+from datetime import timedelta
+from embedding_service import get_embedding_service
+from embedding_pool import get_embedding_pool, start_embedding_pool_from_env
+from face_gallery import FaceGallery
+from gallery_snapshot import read_header, read_snapshot, write_snapshot
+from ann_index import build_index, load_index, INDEX_TYPES
+from embedding_codec import decode_normalized, l2_normalize, to_pgvector, DEFAULT_MODEL
+from db import transaction, connect   # pool kết nối + DB_CONFIG dùng chung
+
+# ========== EMBEDDING UTILS ==========
+def get_embedding(image):
+    # image: đường dẫn, khung hình ndarray (BGR) hoặc bytes ảnh đã mã hóa — không cần file tạm.
+    # Model Facenet + detector được nạp một lần và dùng lại (embedding_service);
+    # nếu đã bật pool process (embedding_pool) thì chuyển sang worker
+    pool = get_embedding_pool()
+    return (pool or get_embedding_service()).represent(image)
+
+def load_embeddings_from_db():
+    with transaction() as cur:
+        cur.execute("SELECT key_id, embedding FROM face_embeddings")
+        return {key: decode_normalized(emb) for key, emb in cur.fetchall()}
+
+def load_embeddings_since(since=None):
+    """
+    Trả về [(key_id, embedding đã L2-normalize, created_at)] theo thứ tự (created_at, id).
+    since=None → toàn bộ bảng; ngược lại chỉ các dòng thêm/cập nhật từ mốc since
+    (upsert đặt lại created_at nên bản cập nhật cũng được lấy; dùng idx_face_embeddings_created).
+    """
+    with transaction() as cur:
+        if since is None:
+            cur.execute("SELECT key_id, embedding, created_at FROM face_embeddings ORDER BY created_at, id")
+        else:
+            cur.execute("""
+                SELECT key_id, embedding, created_at FROM face_embeddings
+                WHERE created_at >= %s
+                ORDER BY created_at, id
+            """, (since,))
+        return [(key, decode_normalized(emb), ts) for key, emb, ts in cur.fetchall()]
+
+def iter_embedding_chunks(chunk=5000):
+    """
+    Duyệt toàn bảng theo khối qua server-side cursor: mỗi khối là (keys, ma trận vector đơn vị,
+    created_at lớn nhất) — chỉ một khối nằm trong RAM (nạp index lượng tử hóa cho hàng triệu dòng).
+    """
+    conn = connect(statement_timeout_ms=0)   # duyệt lâu → kết nối riêng
+    try:
+        with conn.cursor(name="face_embeddings_stream") as cur:
+            cur.itersize = chunk
+            cur.execute("SELECT key_id, embedding, created_at FROM face_embeddings ORDER BY created_at, id")
+            while True:
+                rows = cur.fetchmany(chunk)
+                if not rows:
+                    break
+                matrix = np.vstack([decode_normalized(emb) for _, emb, _ in rows]).astype(np.float32, copy=False)
+                yield ([key for key, _, _ in rows], matrix,
+                       max((ts for _, _, ts in rows if ts is not None), default=None))
+    finally:
+        conn.close()
+
+def sample_embeddings(limit):
+    """Tối đa limit vector đơn vị lấy ngẫu nhiên trên server — train codebook mà không tải cả bảng."""
+    with transaction() as cur:
+        cur.execute("SELECT embedding FROM face_embeddings ORDER BY random() LIMIT %s", (limit,))
+        rows = cur.fetchall()
+    if not rows:
+        return None
+    return np.vstack([decode_normalized(emb) for emb, in rows]).astype(np.float32, copy=False)
+
+def fetch_embedding(key_id):
+    """Vector đơn vị của đúng một key_id (một dòng qua idx_face_embeddings_key), None nếu chưa đăng ký."""
+    with transaction() as cur:
+        cur.execute("SELECT embedding FROM face_embeddings WHERE key_id = %s", (key_id,))
+        row = cur.fetchone()
+    return decode_normalized(row[0]) if row else None
+
+def fetch_embeddings(key_ids):
+    """{key_id: vector đơn vị} chỉ cho các key_id yêu cầu (idx_face_embeddings_key) — dùng để re-rank."""
+    key_ids = list(key_ids)
+    if not key_ids:
+        return {}
+    with transaction() as cur:
+        cur.execute("SELECT key_id, embedding FROM face_embeddings WHERE key_id = ANY(%s)", (key_ids,))
+        return {key: decode_normalized(emb) for key, emb in cur.fetchall()}
+
+def get_db_watermark():
+    """(created_at lớn nhất, số dòng) của face_embeddings — kiểm tra snapshot còn mới không."""
+    with transaction() as cur:
+        cur.execute("SELECT max(created_at), count(*) FROM face_embeddings")
+        return cur.fetchone()
+
+# ========== GALLERY (giữ trong RAM giữa các lần verify) ==========
+NOTIFY_CHANNEL = "face_embeddings_changed"   # trùng với trigger trong face_intergration_gui.DDL_FACE_EMB_NOTIFY
+# Lùi mốc high-water một chút: created_at = thời điểm BẮT ĐẦU transaction,
+# nên một transaction commit muộn có thể mang timestamp cũ hơn mốc đã thấy.
+SYNC_OVERLAP = timedelta(seconds=5)
+# Không LISTEN: delta theo created_at không thấy DELETE → định kỳ so số dòng với DB, lệch thì nạp lại.
+DELETE_CHECK_INTERVAL = float(os.environ.get("FACE_GALLERY_DELETE_CHECK_S", "30"))
+# Snapshot mmap (gallery_snapshot): khởi động = mmap file + delta từ DB thay vì tải cả bảng.
+# FACE_GALLERY_SNAPSHOT="" → tắt.
+GALLERY_SNAPSHOT = os.environ.get("FACE_GALLERY_SNAPSHOT", "face_gallery.snap")
+
+class GallerySync:
+    """
+    Giữ FaceGallery đồng bộ với bảng face_embeddings:
+    - lần đầu: nạp toàn bộ
+    - sau đó: delta theo high-water mark created_at (upsert tại chỗ)
+    - tuỳ chọn: LISTEN/NOTIFY để tự cập nhật mà không cần poll
+    - tuỳ chọn: snapshot_path → khởi động từ snapshot mmap, ghi lại snapshot sau mỗi lần nạp toàn bộ
+    - tuỳ chọn: gallery = index lượng tử hóa (ann_index sq8/pq) thay cho ma trận float
+    """
+
+    def __init__(self, snapshot_path=None, gallery=None):
+        # mặc định: vector đơn vị float32 → khoảng cách = 1 - x.q
+        self.gallery = gallery if gallery is not None else FaceGallery(metric="cosine")
+        self.high_water = None
+        self.snapshot_path = snapshot_path
+        self._loaded = False
+        self._lock = threading.RLock()   # refresh() giữ lock khi gọi upsert()
+        self._stop = threading.Event()
+        self._listener = None
+        self._last_check = time.monotonic()
+        self.indexes = []           # index phụ (ann_index) được cập nhật cùng gallery
+        self._pending = {}          # upsert khi index lượng tử hóa chưa có codebook → áp dụng sau lần nạp toàn bộ
+
+    @property
+    def listening(self):
+        return self._listener is not None and self._listener.is_alive()
+
+    def full_reload(self, retrain=False):
+        """retrain=True: index lượng tử hóa train lại codebook từ mẫu mới của bảng."""
+        if hasattr(self.gallery, "load_chunks"):
+            return self._stream_reload(retrain)
+        rows = load_embeddings_since(None)
+        with self._lock:
+            self.gallery.load((key, emb) for key, emb, _ in rows)
+            self.high_water = max((ts for _, _, ts in rows if ts is not None), default=None)
+            self._loaded = True
+            self._last_check = time.monotonic()
+            for index in self.indexes:
+                index.refill(self.gallery.keys.tolist(), self.gallery.matrix)
+        if self.snapshot_path:
+            self.save_snapshot(self.snapshot_path)
+        return len(rows)
+
+    def _stream_reload(self, retrain=False):
+        """
+        Index lượng tử hóa: mã hóa từng khối từ server-side cursor, không dựng ma trận float của cả bảng.
+        Codebook train từ mẫu ngẫu nhiên khi chưa có, khi còn dưới min_train dòng mà bảng đã lớn hơn,
+        hoặc khi retrain=True.
+        """
+        _, db_count = get_db_watermark()
+        sample = None
+        if retrain or _needs_codebook(self.gallery, db_count):
+            sample = sample_embeddings(ANN_CONFIG["train_sample"])
+        high_water = None
+
+        def chunks():
+            nonlocal high_water
+            for keys, matrix, ts in iter_embedding_chunks(ANN_CONFIG["stream_chunk"]):
+                if ts is not None and (high_water is None or ts > high_water):
+                    high_water = ts
+                yield keys, matrix
+
+        count = self.gallery.load_chunks(chunks(), sample=sample)
+        with self._lock:
+            self.high_water = high_water
+            self._loaded = True
+            self._last_check = time.monotonic()
+            pending, self._pending = self._pending, {}
+        if sample is not None:
+            _save_codebook(self.gallery)
+        for key_id, embedding in pending.items():
+            self.upsert(key_id, embedding)
+        return count
+
+    # ---------- snapshot mmap ----------
+    def save_snapshot(self, path):
+        with self._lock:
+            keys = list(self.gallery.keys)
+            matrix = self.gallery.matrix.copy()
+            high_water = self.high_water
+        try:
+            write_snapshot(path, keys, matrix, high_water, normalized=True)
+        except OSError as e:
+            print(f"[⚠️] Không ghi được snapshot gallery {path}: {e}")
+
+    def load_snapshot(self, path):
+        """
+        Nạp gallery bằng mmap snapshot rồi kiểm tra độ mới với DB:
+        - cùng high-water mark và số dòng → dùng luôn
+        - chỉ có dòng mới/cập nhật → delta theo high-water mark
+        - số dòng vẫn lệch sau delta (có dòng bị xóa) hoặc snapshot cũ chưa normalize → nạp toàn bộ
+        Trả về số dòng đã áp dụng từ DB.
+        """
+        if not read_header(path)["normalized"]:
+            print(f"[ℹ️] Snapshot {path} chứa embedding chưa chuẩn hóa, nạp lại từ DB")
+            return self.full_reload()
+        keys, matrix, high_water = read_snapshot(path)
+        with self._lock:
+            self.gallery.load_arrays(keys, matrix)
+            self.high_water = high_water
+            self._loaded = True
+            for index in self.indexes:
+                index.refill(self.gallery.keys.tolist(), self.gallery.matrix)
+        db_high, db_count = get_db_watermark()
+        if high_water is None and db_count:
+            return self.full_reload()
+        if db_high == high_water and db_count == len(keys):
+            print(f"[✅] Gallery nạp từ snapshot {path} ({len(keys)} embedding, không có thay đổi)")
+            return 0
+        applied = self.refresh()
+        if len(self.gallery) != db_count:
+            return self.full_reload()
+        print(f"[✅] Gallery nạp từ snapshot {path} + {applied} dòng thay đổi")
+        self.save_snapshot(path)
+        return applied
+
+    def attach_index(self, index):
+        with self._lock:
+            self.indexes.append(index)
+
+    def upsert(self, key_id, embedding):
+        embedding = l2_normalize(embedding)
+        with self._lock:
+            if not getattr(self.gallery, "trained", True):
+                # index lượng tử hóa chưa có codebook (bảng rỗng lúc nạp) → giữ lại tới lần nạp toàn bộ kế tiếp
+                self._pending[key_id] = embedding
+                print(f"[ℹ️] Index {self.gallery.kind} chưa train, tạm giữ embedding {key_id} "
+                      f"({len(self._pending)} đang chờ)")
+                return
+            self.gallery.upsert(key_id, embedding)
+            for index in self.indexes:
+                index.upsert(key_id, embedding)
+
+    def remove(self, key_id):
+        with self._lock:
+            self._pending.pop(key_id, None)
+            self.gallery.remove(key_id)
+            for index in self.indexes:
+                index.remove(key_id)
+
+    def refresh(self):
+        """Chỉ lấy các dòng mới/cập nhật kể từ high-water mark. Trả về số dòng đã áp dụng."""
+        if not self._loaded and self.snapshot_path and os.path.exists(self.snapshot_path):
+            try:
+                return self.load_snapshot(self.snapshot_path)
+            except (OSError, ValueError) as e:
+                print(f"[⚠️] Bỏ qua snapshot gallery {self.snapshot_path}: {e}")
+        if not self._loaded or self.high_water is None:
+            return self.full_reload()
+        rows = load_embeddings_since(self.high_water - SYNC_OVERLAP)
+        with self._lock:
+            for key, emb, ts in rows:
+                self.upsert(key, emb)
+                if ts is not None and ts > self.high_water:
+                    self.high_water = ts
+        if hasattr(self.gallery, "load_chunks") and _needs_codebook(self.gallery, len(self.gallery)):
+            return self.full_reload()   # codebook train trên quá ít dòng so với gallery hiện tại
+        if not self.listening and time.monotonic() - self._last_check >= DELETE_CHECK_INTERVAL:
+            return self.check_deletes() or len(rows)
+        return len(rows)
+
+    def check_deletes(self):
+        """
+        Sau delta, gallery chứa mọi dòng của DB (kể cả dòng mới) → số phần tử lớn hơn số dòng DB
+        nghĩa là có dòng đã bị xóa: nạp lại toàn bộ. Trả về số dòng nạp lại (0 nếu không lệch).
+        """
+        self._last_check = time.monotonic()
+        _, db_count = get_db_watermark()
+        if db_count == len(self.gallery):
+            return 0
+        print(f"[ℹ️] Gallery có {len(self.gallery)} embedding, DB còn {db_count} → nạp lại để bỏ dòng đã xóa")
+        return self.full_reload()
+
+    # ---------- LISTEN / NOTIFY ----------
+    def start_listener(self):
+        if self.listening:
+            return
+        self._stop.clear()
+        self._listener = threading.Thread(target=self._listen_loop, name="gallery-listener", daemon=True)
+        self._listener.start()
+
+    def stop_listener(self):
+        self._stop.set()
+        if self._listener is not None:
+            self._listener.join(timeout=2)
+        self._listener = None
+
+    def _listen_loop(self):
+        try:
+            conn = connect(statement_timeout_ms=0)   # kết nối riêng, giữ suốt vòng LISTEN
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            conn.cursor().execute(f"LISTEN {NOTIFY_CHANNEL};")
+            self.refresh()  # bắt các thay đổi xảy ra trước khi LISTEN có hiệu lực
+        except Exception as e:
+            print(f"[⚠️] Không thể LISTEN {NOTIFY_CHANNEL}, dùng delta theo created_at: {e}")
+            return
+
+        try:
+            while not self._stop.is_set():
+                if select.select([conn], [], [], 1.0) == ([], [], []):
+                    continue
+                conn.poll()
+                changed = False
+                while conn.notifies:
+                    op, _, key_id = conn.notifies.pop(0).payload.partition(":")
+                    if op == "DELETE":
+                        self.remove(key_id)
+                    else:
+                        changed = True
+                if changed:
+                    self.refresh()
+        except Exception as e:
+            print(f"[⚠️] Listener gallery dừng: {e}")
+        finally:
+            conn.close()
+
+_SYNC = None
+
+def get_gallery_sync():
+    global _SYNC
+    if _SYNC is None:
+        if ANN_CONFIG["engine"] in QUANTIZED_ENGINES:
+            # chỉ giữ mã uint8 trong RAM; snapshot float không dùng ở chế độ này
+            _SYNC = GallerySync(gallery=new_quantized_index())
+        else:
+            _SYNC = GallerySync(snapshot_path=GALLERY_SNAPSHOT or None)
+    return _SYNC
+
+def start_gallery_listener():
+    """Bật LISTEN/NOTIFY cho gallery (dùng trong process sống lâu như GUI)."""
+    sync = get_gallery_sync()
+    sync.start_listener()
+    return sync
+
+def get_gallery(reload=False, refresh=True):
+    """
+    Gallery dùng chung trong process. Lần đầu nạp toàn bộ; các lần sau chỉ
+    lấy delta (hoặc không truy vấn gì nếu listener NOTIFY đang chạy).
+    refresh=False: dùng gallery đã nạp, không lấy delta (vd. từng khung trong một phiên camera).
+    """
+    sync = get_gallery_sync()
+    if reload:
+        sync.full_reload()
+    elif not sync._loaded or (refresh and not sync.listening):
+        sync.refresh()
+    return sync.gallery
+
+def gallery_upsert(key_id, embedding):
+    """Cập nhật vector trong gallery đã nạp (nếu có) sau khi đăng ký/cập nhật khuôn mặt."""
+    if _SYNC is not None and _SYNC._loaded:
+        _SYNC.upsert(key_id, embedding)
+
+# ========== ENGINE TÌM KIẾM (flat chính xác / IVF xấp xỉ) ==========
+ANN_CONFIG = {
+    "engine": "flat",                     # "flat" = quét chính xác (baseline) | "ivf" = ann_index.IVFIndex
+                                          # | "pgvector" = ORDER BY embedding_vec <-> q trên server
+                                          # | "sq8" | "pq" = gallery lượng tử hóa (mã nhỏ hơn float32 4x / 16x)
+    "ef_search": 40,                      # pgvector HNSW: hnsw.ef_search
+    "nlist": 1024,
+    "nprobe": 16,                         # tăng → recall cao hơn, chậm hơn
+    "index_path": "face_ann_index.npz",   # centroids đã train (python ann_index.py --out ...)
+    "pq_m": 32,                           # pq: số byte mỗi vector (phải chia hết số chiều)
+    "rerank": 32,                         # sq8/pq: số ứng viên tính lại chính xác bằng vector float từ DB
+    "quant_path": "face_quant_index.npz", # codebook đã train (python ann_index.py --kind pq --out ...)
+    "min_train": 1000,                    # sq8/pq: codebook train trên ít dòng hơn → không lưu, tự train lại khi bảng lớn hơn
+    "train_sample": 20000,                # sq8/pq: số dòng lấy mẫu ngẫu nhiên để train codebook
+    "stream_chunk": 5000,                 # sq8/pq: số dòng mỗi khối khi nạp toàn bảng
 }
+QUANTIZED_ENGINES = ("sq8", "pq")
+_ANN = None
 
-def get_conn():
-    return psycopg2.connect(**DB_CONFIG)
+def new_quantized_index():
+    """Index sq8/pq rỗng theo ANN_CONFIG, dùng lại codebook đã lưu nếu cùng kiểu."""
+    engine, path = ANN_CONFIG["engine"], ANN_CONFIG["quant_path"]
+    index = None
+    if os.path.exists(path):
+        index = load_index(path)
+        if index.kind != engine:
+            print(f"[⚠️] {path} là index {index.kind}, cần {engine} → train codebook mới")
+            index = None
+    if index is None:
+        params = {"m": ANN_CONFIG["pq_m"]} if engine == "pq" else {}
+        index = INDEX_TYPES[engine](**params)
+    index.rerank = ANN_CONFIG["rerank"]
+    index.rerank_source = fetch_embeddings
+    return index
 
-# ========== EMBEDDING UTILS ==========
-def get_embedding(image_path):
+def _needs_codebook(index, db_count):
+    """
+    Chưa có codebook, hoặc codebook train trên < min_train dòng mà bảng đã gấp đôi số đó (hoặc đủ min_train)
+    → train lại từ mẫu mới; gallery nhỏ lớn dần chỉ train lại cỡ log2(min_train) lần.
+    """
+    if not db_count:
+        return False
+    if not index.trained:
+        return True
+    min_train = ANN_CONFIG["min_train"]
+    return index.trained_on < min_train and db_count >= min(2 * index.trained_on, min_train)
+
+def _save_codebook(index):
+    """Chỉ lưu quant_path khi codebook train trên đủ min_train dòng (không dùng mãi codebook của vài người)."""
+    if index.trained_on < ANN_CONFIG["min_train"]:
+        print(f"[ℹ️] Codebook {index.kind} train trên {index.trained_on} dòng (< {ANN_CONFIG['min_train']}),"
+              " chưa lưu — sẽ train lại khi gallery lớn hơn")
+        return False
+    index.save(ANN_CONFIG["quant_path"])
+    print(f"[✅] Đã lưu codebook {index.kind} ({index.trained_on} dòng train) tại {ANN_CONFIG['quant_path']}")
+    return True
+
+def retrain_quantized_index():
+    """Train lại codebook sq8/pq từ mẫu mới của bảng rồi mã hóa lại toàn bộ (vd. sau khi gallery tăng nhiều)."""
+    if ANN_CONFIG["engine"] not in QUANTIZED_ENGINES:
+        raise ValueError(f"Engine {ANN_CONFIG['engine']} không dùng codebook lượng tử hóa.")
+    return get_gallery_sync().full_reload(retrain=True)
+
+def get_search_index(refresh=True):
+    """Index dùng cho verify theo ANN_CONFIG; luôn đồng bộ với gallery qua GallerySync."""
+    global _ANN
+    gallery = get_gallery(refresh=refresh)
+    if ANN_CONFIG["engine"] in QUANTIZED_ENGINES:
+        return gallery             # codebook được train/lưu khi GallerySync nạp toàn bộ (_stream_reload)
+    if ANN_CONFIG["engine"] != "ivf" or not len(gallery):
+        return gallery
+    if _ANN is None:
+        sync = get_gallery_sync()
+        path = ANN_CONFIG["index_path"]
+        index = load_index(path) if os.path.exists(path) else None
+        if index is not None and not index.params.get("normalized"):
+            # centroids train trên vector thô (norm ~10) không khớp với gallery vector đơn vị
+            print(f"[ℹ️] {path} train trên embedding chưa chuẩn hóa → train lại")
+            index = None
+        if index is not None:
+            # Dùng lại centroids đã train, vector lấy từ gallery hiện tại
+            index.refill(gallery.keys.tolist(), gallery.matrix)
+        else:
+            index = build_index(ANN_CONFIG["engine"], gallery.keys.tolist(), gallery.matrix,
+                                nlist=ANN_CONFIG["nlist"], nprobe=ANN_CONFIG["nprobe"], normalized=True)
+            index.save(path)
+        if hasattr(index, "nprobe"):
+            index.nprobe = ANN_CONFIG["nprobe"]
+        sync.attach_index(index)
+        _ANN = index
+    return _ANN
+
+_PGVECTOR_OK = None
+# thiếu type/operator vector hoặc cột embedding_vec → không thử lại trong process này
+_PGVECTOR_MISSING = (psycopg2.errors.UndefinedObject, psycopg2.errors.UndefinedColumn,
+                     psycopg2.errors.UndefinedFunction)
+
+def search_pgvector(embedding, k=5):
+    """
+    Top-k tính trên PostgreSQL (pgvector, index HNSW idx_face_embeddings_vec): chỉ k dòng đi qua mạng.
+    Trả về None → gọi nơi khác fallback về in-process:
+    - server không có extension/cột embedding_vec → tắt pgvector cho cả process
+    - lỗi tạm thời (statement timeout, mất kết nối...) → chỉ fallback cho lần gọi này
+    - embedding_vec còn dòng chưa chuẩn hóa → tắt pgvector (d²/2 chỉ là cosine với vector đơn vị)
+    """
+    global _PGVECTOR_OK
+    if _PGVECTOR_OK is False:
+        return None
     try:
-        rep = DeepFace.represent(img_path=image_path, model_name="Facenet", enforce_detection=False)
-        return np.array(rep[0]['embedding'])
-    except Exception as e:
-        print(f"[❌] Không thể lấy embedding: {e}")
+        with transaction() as cur:
+            if _PGVECTOR_OK is None:
+                # kiểm tra một lần mỗi process; dòng ghi mới luôn đã chuẩn hóa (face_register_pg)
+                cur.execute("""
+                    SELECT key_id FROM face_embeddings
+                    WHERE embedding_vec IS NOT NULL AND abs(vector_norm(embedding_vec) - 1) > 1e-3
+                    LIMIT 1
+                """)
+                if cur.fetchone() is not None:
+                    _PGVECTOR_OK = False
+                    print("[⚠️] embedding_vec còn vector chưa chuẩn hóa (chạy: python embedding_codec.py normalize),"
+                          " chuyển sang so khớp trong process")
+                    return None
+            cur.execute("SET LOCAL hnsw.ef_search = %s", (int(ANN_CONFIG["ef_search"]),))
+            q = to_pgvector(embedding)
+            cur.execute("""
+                SELECT key_id, embedding_vec <-> %s::vector AS dist
+                FROM face_embeddings
+                WHERE embedding_vec IS NOT NULL
+                ORDER BY embedding_vec <-> %s::vector
+                LIMIT %s
+            """, (q, q, k))
+            rows = [(key, float(dist)) for key, dist in cur.fetchall()]
+        _PGVECTOR_OK = True
+        return rows
+    except _PGVECTOR_MISSING as e:
+        _PGVECTOR_OK = False
+        print(f"[⚠️] pgvector không khả dụng, chuyển sang so khớp trong process: {e}")
+        return None
+    except psycopg2.Error as e:
+        print(f"[⚠️] pgvector lỗi, lần này so khớp trong process: {e}")
         return None
 
-def load_embeddings_from_db():
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT key_id, embedding FROM face_embeddings")
-    data = {key: pickle.loads(emb) for key, emb in cur.fetchall()}
-    conn.close()
-    return data
+def search_gallery(embedding, k=5, refresh=True):
+    """
+    Top-k [(key_id, khoảng cách cosine)] gần nhất với embedding.
+    Với vector đơn vị ||a-b||² = 2 - 2cos → kết quả L2 của IVF/pgvector đổi sang cosine bằng d²/2
+    (cùng thứ tự xếp hạng, không cần index riêng cho tích vô hướng).
+    refresh=False: không lấy delta từ DB trước khi tìm (xem get_gallery).
+    """
+    q = l2_normalize(embedding)
+    if ANN_CONFIG["engine"] == "pgvector":
+        rows = search_pgvector(q, k)
+        if rows is not None:
+            return [(key, dist * dist / 2.0) for key, dist in rows]
+    index = get_search_index(refresh)
+    rows = index.search(q, k=k)
+    gallery = get_gallery_sync().gallery
+    if not rows and index is not gallery and len(gallery):
+        # IVF: các cụm được probe rỗng hoặc toàn dòng đã xóa → quét chính xác thay vì báo "không có ai"
+        index, rows = gallery, gallery.search(q, k=k)
+    if getattr(index, "metric", None) == "cosine":   # FaceGallery cosine, sq8/pq
+        return rows
+    return [(key, dist * dist / 2.0) for key, dist in rows]
+
+# ========== NGƯỠNG SO KHỚP ==========
+# Khoảng cách cosine (1 - cos) giữa các embedding đã L2-normalize: 0 = trùng hướng, 2 = ngược hướng.
+# Ngưỡng mặc định có thể ghi đè bằng FACE_MATCH_THRESHOLD, hoặc bằng file hiệu chỉnh do
+# calibrate_threshold.py tạo ra (chỉ áp dụng khi cùng model/metric với dữ liệu đang dùng).
+MATCH_CONFIG = {
+    "metric": "cosine",
+    "model": DEFAULT_MODEL,
+    "threshold": float(os.environ.get("FACE_MATCH_THRESHOLD", "0.40")),
+    "source": "mặc định",
+}
+CALIBRATION_PATH = os.environ.get("FACE_MATCH_CALIBRATION", "face_match_calibration.json")
+
+def load_calibration(path=CALIBRATION_PATH):
+    """Áp dụng ngưỡng từ file hiệu chỉnh (nếu có). Trả về dict hiệu chỉnh hoặc None."""
+    if not path or not os.path.exists(path) or "FACE_MATCH_THRESHOLD" in os.environ:
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            calib = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"[⚠️] Không đọc được file hiệu chỉnh {path}: {e}")
+        return None
+    if calib.get("model") != MATCH_CONFIG["model"] or calib.get("metric") != MATCH_CONFIG["metric"]:
+        print(f"[⚠️] Bỏ qua {path}: hiệu chỉnh cho {calib.get('model')}/{calib.get('metric')}, "
+              f"đang dùng {MATCH_CONFIG['model']}/{MATCH_CONFIG['metric']}")
+        return None
+    MATCH_CONFIG["threshold"] = float(calib["threshold"])
+    MATCH_CONFIG["source"] = f"{path} (FAR ≤ {calib.get('far_target')})"
+    return calib
+
+load_calibration()
+
+def match_threshold(threshold=None):
+    """threshold truyền vào, hoặc ngưỡng đã hiệu chỉnh trong MATCH_CONFIG."""
+    return MATCH_CONFIG["threshold"] if threshold is None else threshold
 
 # ========== VERIFY LOGIC ==========
-def verify_person(image_path, threshold=10):
+def cosine_distance(reference, embedding):
+    """1 - cos giữa vector đơn vị reference và embedding (embedding được chuẩn hóa tại chỗ)."""
+    return max(0.0, 1.0 - float(reference @ l2_normalize(embedding)))
+
+class NotEnrolledError(LookupError):
+    """key_id chưa có embedding trong face_embeddings — khác với "không khớp" hay "đã hủy"."""
+
+    def __init__(self, key_id):
+        self.key_id = key_id
+        super().__init__(f"Chưa đăng ký khuôn mặt cho {key_id}.")
+
+def verify_claim(image, key_id, threshold=None):
     """
-    So sánh embedding từ ảnh mới với embeddings trong database.
-    threshold: khoảng cách Euclidean (nhỏ hơn threshold → cùng người)
+    Xác thực 1:1: ảnh có đúng là người đã đăng ký với key_id không (vd. students.face_key khi đăng nhập).
+    Chỉ đọc một dòng face_embeddings → chi phí không phụ thuộc kích thước gallery.
+    Trả về (key_id, khoảng cách) nếu khớp, (None, khoảng cách) nếu không, (None, None) nếu ảnh không
+    lấy được embedding. Raise NotEnrolledError nếu key_id chưa đăng ký khuôn mặt.
     """
-    known_embeddings = load_embeddings_from_db()
-    if not known_embeddings:
-        print("❌ Database trống, chưa có người đăng ký.")
-        return
+    threshold = match_threshold(threshold)
+    reference = fetch_embedding(key_id)
+    if reference is None:
+        raise NotEnrolledError(key_id)
+    emb_new = get_embedding(image)
+    if emb_new is None:
+        print("❌ Không lấy được embedding từ ảnh.")
+        return None, None
 
-    print(f"[ℹ️] Có {len(known_embeddings)} embeddings trong database.")
+    dist = cosine_distance(reference, emb_new)
+    print(f"🔍 So với {key_id}: khoảng cách = {dist:.3f}, ngưỡng {threshold:.3f}")
+    if dist < threshold:
+        print(f"[✅] Xác thực thành công! Ảnh khớp với {key_id}")
+        return key_id, dist
+    print(f"[❌] Ảnh không khớp với {key_id}.")
+    return None, dist
 
-    emb_new = get_embedding(image_path)
+def verify_person(image, threshold=None):
+    """
+    Nhận diện 1:N (kiểu watch-list): tìm người gần nhất trong toàn bộ gallery cho ảnh mới
+    (đường dẫn / khung hình ndarray / bytes). Khi đã biết danh tính cần kiểm tra, dùng verify_claim.
+    threshold: khoảng cách cosine (nhỏ hơn threshold → cùng người); None → MATCH_CONFIG["threshold"]
+    """
+    threshold = match_threshold(threshold)
+    emb_new = get_embedding(image)
     if emb_new is None:
         print("❌ Không lấy được embedding từ ảnh.")
-        return
+        return None, None
 
-    min_dist = float('inf')
-    matched_id = None
-
-    for key_id, emb_ref in known_embeddings.items():
-        dist = np.linalg.norm(emb_new - emb_ref)
-        if dist < min_dist:
-            min_dist = dist
-            matched_id = key_id
+    matches = search_gallery(emb_new, k=1)
+    if not matches:
+        print("❌ Database trống, chưa có người đăng ký.")
+        return None, None
+    matched_id, min_dist = matches[0]
 
-    print(f"🔍 So sánh gần nhất: {matched_id} (Khoảng cách = {min_dist:.2f})")
+    print(f"🔍 So sánh gần nhất: {matched_id} (Khoảng cách = {min_dist:.3f}, ngưỡng {threshold:.3f})")
     if min_dist < threshold:
         print(f"[✅] Xác thực thành công! Ảnh khớp với {matched_id}")
         return matched_id, min_dist
@@ -70,9 +624,11 @@ def verify_person(image_path, threshold=10):
         return None, min_dist
 
 # ========== CAMERA CAPTURE ==========
-def capture_image(save_path="temp_verify.jpg"):
+def capture_frame():
+    """Khung hình BGR (ndarray) chụp khi nhấn 's', None nếu nhấn 'q' — không ghi file."""
     cap = cv2.VideoCapture(0)
     print("Nhấn 's' để chụp, 'q' để thoát.")
+    captured = None
     while True:
         ret, frame = cap.read()
         if not ret:
@@ -80,34 +636,52 @@ def capture_image(save_path="temp_verify.jpg"):
         cv2.imshow("Xác thực khuôn mặt", frame)
         key = cv2.waitKey(1) & 0xFF
         if key == ord('s'):
-            cv2.imwrite(save_path, frame)
-            print(f"[📸] Đã lưu ảnh tạm tại {save_path}")
+            captured = frame
+            print("[📸] Đã chụp ảnh")
             break
         elif key == ord('q'):
-            save_path = None
             break
     cap.release()
     cv2.destroyAllWindows()
+    return captured
+
+def capture_image(save_path="temp_verify.jpg"):
+    """Như capture_frame nhưng ghi ảnh ra file và trả về đường dẫn (khi cần giữ lại ảnh)."""
+    frame = capture_frame()
+    if frame is None:
+        return None
+    cv2.imwrite(save_path, frame)
+    print(f"[📸] Đã lưu ảnh tại {save_path}")
     return save_path
 
 # ========== MAIN ==========
 if __name__ == "__main__":
     print("=== XÁC THỰC KHUÔN MẶT ===")
+    start_embedding_pool_from_env()   # FACE_EMBED_WORKERS=N → dùng pool process
+    claim = input("key_id cần xác thực (bỏ trống = tìm trong toàn bộ gallery): ").strip()
     print("Chọn nguồn ảnh:")
     print("1. Mở camera")
     print("2. Dùng ảnh từ máy tính")
 
     choice = input("Lựa chọn (1/2): ").strip()
     if choice == "1":
-        image_path = capture_image()
+        image = capture_frame()      # khung hình đi thẳng vào model, không ghi file
     elif choice == "2":
-        image_path = input("Nhập đường dẫn tới ảnh: ").strip()
+        image = input("Nhập đường dẫn tới ảnh: ").strip()
+        if not os.path.exists(image):
+            image = None
     else:
         print("❌ Lựa chọn không hợp lệ.")
         exit()
 
-    if image_path is None or not os.path.exists(image_path):
+    if image is None:
         print("❌ Không có ảnh hợp lệ.")
         exit()
 
-    verify_person(image_path, threshold=10)
+    if claim:
+        try:
+            verify_claim(image, claim)
+        except NotEnrolledError as e:
+            print(f"[❌] {e}")
+    else:
+        verify_person(image)
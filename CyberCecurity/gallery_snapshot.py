@@ -0,0 +1,117 @@
+import os
+import struct
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+import numpy as np
+
+
+# ========== SNAPSHOT GALLERY TRÊN ĐĨA (memory-mapped) ==========
+# Bố cục file (little-endian):
+#   header 64 byte : magic "FGAL" | version u8 | flags u8 (bit0 = đã L2-normalize) | dim u16 | count u32 | keys_len u32 | high_water i64 (µs, -1 = không có)
+#   ma trận        : count x dim float32 (bắt đầu ở byte 64 → mmap thẳng thành ndarray, không copy)
+#   bảng key_id    : các key_id UTF-8 nối bằng "\n" (keys_len byte)
+# File được ghi ra file tạm cùng thư mục rồi os.replace → người đọc không bao giờ thấy file dở dang;
+# process đang mmap bản cũ vẫn giữ inode cũ cho tới khi đóng.
+
+MAGIC = b"FGAL"
+VERSION = 1
+HEADER = struct.Struct("<4sBBHIIq")
+DATA_OFFSET = 64
+FLAG_NORMALIZED = 0x01
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _ts_to_us(ts):
+    return -1 if ts is None else (ts - _EPOCH) // timedelta(microseconds=1)
+
+
+def _us_to_ts(us):
+    return None if us < 0 else _EPOCH + timedelta(microseconds=us)
+
+
+def write_snapshot(path, keys, matrix, high_water=None, normalized=False):
+    """
+    Ghi snapshot một cách nguyên tử. high_water: created_at lớn nhất (datetime không timezone) hoặc None;
+    normalized: các hàng là vector đơn vị.
+    """
+    matrix = np.ascontiguousarray(matrix, dtype="<f4")
+    keys = list(keys)
+    if matrix.ndim != 2 or matrix.shape[0] != len(keys):
+        raise ValueError("Số hàng ma trận phải bằng số key_id.")
+    blob = "\n".join(keys).encode("utf-8")
+    flags = FLAG_NORMALIZED if normalized else 0
+    header = HEADER.pack(MAGIC, VERSION, flags, matrix.shape[1], matrix.shape[0], len(blob), _ts_to_us(high_water))
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix=".snapshot-", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(header.ljust(DATA_OFFSET, b"\0"))
+            f.write(matrix.tobytes())
+            f.write(blob)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def read_header(path):
+    """{dim, count, high_water, normalized, size} đọc từ header (không đụng tới ma trận)."""
+    with open(path, "rb") as f:
+        raw = f.read(HEADER.size)
+    if len(raw) < HEADER.size:
+        raise ValueError("File snapshot bị cắt cụt.")
+    magic, version, flags, dim, count, keys_len, hw = HEADER.unpack(raw)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"Không phải snapshot gallery v{VERSION}: {path}")
+    size = DATA_OFFSET + count * dim * 4 + keys_len
+    if os.path.getsize(path) != size:
+        raise ValueError("Kích thước file snapshot không khớp header.")
+    return {"dim": dim, "count": count, "keys_len": keys_len, "high_water": _us_to_ts(hw),
+            "normalized": bool(flags & FLAG_NORMALIZED), "size": size}
+
+
+def read_snapshot(path):
+    """
+    (keys, matrix, high_water): matrix là np.memmap chỉ-đọc (count x dim float32) —
+    các process verifier mở cùng file dùng chung trang trong page cache của OS.
+    """
+    info = read_header(path)
+    count, dim = info["count"], info["dim"]
+    with open(path, "rb") as f:
+        f.seek(DATA_OFFSET + count * dim * 4)
+        blob = f.read(info["keys_len"])
+    keys = blob.decode("utf-8").split("\n") if count else []
+    if len(keys) != count:
+        raise ValueError("Bảng key_id không khớp số hàng ma trận.")
+    if count:
+        matrix = np.memmap(path, dtype="<f4", mode="r", offset=DATA_OFFSET, shape=(count, dim))
+    else:
+        matrix = np.empty((0, dim), dtype=np.float32)
+    return keys, matrix, info["high_water"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Snapshot gallery khuôn mặt (mmap)")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    w = sub.add_parser("write", help="Ghi snapshot từ bảng face_embeddings")
+    w.add_argument("path", nargs="?", default="face_gallery.snap")
+    i = sub.add_parser("info", help="Xem header snapshot")
+    i.add_argument("path", nargs="?", default="face_gallery.snap")
+    args = parser.parse_args()
+
+    if args.cmd == "write":
+        from face_verify_pg import get_gallery_sync
+        sync = get_gallery_sync()
+        sync.snapshot_path = None          # nạp thẳng từ DB, không đọc snapshot cũ
+        sync.full_reload()
+        sync.save_snapshot(args.path)
+        print(f"[✅] Đã ghi {len(sync.gallery)} embedding vào {args.path}")
+    else:
+        info = read_header(args.path)
+        print(f"dim={info['dim']} count={info['count']} high_water={info['high_water']} "
+              f"normalized={info['normalized']} size={info['size']} byte")
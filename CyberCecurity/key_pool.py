@@ -0,0 +1,197 @@
+import os
+import time
+import queue
+import argparse
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives import serialization
+
+
+# ========== KEY POOL: cặp khóa RSA sinh sẵn ==========
+# Sinh số nguyên tố 2048-bit mất hàng trăm ms và dao động mạnh → các process nền sinh sẵn
+# một số cặp khóa; lúc phát hành certificate chỉ việc lấy ra một cặp (claim).
+# Khóa đi qua process dưới dạng PEM (cùng định dạng file mà generate_keys ghi ra).
+
+def _generate_pem(key_size=2048, public_exponent=65537):
+    """(private_pem PKCS8, public_pem SubjectPublicKeyInfo) — chạy trong process con."""
+    private_key = rsa.generate_private_key(public_exponent=public_exponent, key_size=key_size)
+    private_pem = private_key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption()
+    )
+    public_pem = private_key.public_key().public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+    return private_pem, public_pem
+
+
+class KeyPool:
+    """
+    Hàng đợi các cặp khóa sinh sẵn, luôn được bù cho đủ `size`:
+    - workers process "spawn" sinh khóa; một thread nền nộp việc mỗi khi có cặp bị lấy hoặc vừa sinh xong
+    - claim(): lấy một cặp; pool rỗng → chờ tối đa timeout rồi sinh tại chỗ (tính là miss)
+    - stats(): depth, in_flight, generated, claimed, misses, refill_rate (cặp/giây)
+    """
+
+    def __init__(self, size=8, workers=1, key_size=2048, public_exponent=65537):
+        self.size = size
+        self.workers = workers
+        self.key_size = key_size
+        self.public_exponent = public_exponent
+        self.generated = 0
+        self.claimed = 0
+        self.misses = 0
+        self.errors = 0
+        self.last_error = None
+        self._ready = queue.Queue()
+        self._in_flight = 0
+        self._recent = deque(maxlen=64)      # thời điểm sinh xong các cặp gần nhất → refill_rate
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        self._thread = threading.Thread(target=self._refill_loop, name="rsa-key-pool", daemon=True)
+        self._thread.start()
+        self._wake.set()
+
+    # ---------- bù khóa ----------
+    def _refill_loop(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            if self._closed:
+                return
+            if self.last_error is not None:
+                time.sleep(1.0)   # worker đang lỗi → không nộp việc dồn dập
+            with self._lock:
+                need = self.size - self._ready.qsize() - self._in_flight
+                self._in_flight += max(0, need)
+            for _ in range(need):
+                try:
+                    fut = self._executor.submit(_generate_pem, self.key_size, self.public_exponent)
+                except RuntimeError:      # executor đã shutdown
+                    return
+                fut.add_done_callback(self._on_generated)
+
+    def _on_generated(self, fut):
+        with self._lock:
+            self._in_flight -= 1
+            if fut.cancelled():
+                return
+            error = fut.exception()
+            if error is not None:
+                self.errors += 1
+                self.last_error = error
+            else:
+                self.generated += 1
+                self.last_error = None
+                self._recent.append(time.monotonic())
+                self._ready.put(fut.result())
+        self._wake.set()
+
+    # ---------- lấy khóa ----------
+    def claim(self, timeout=0.0):
+        """(private_pem, public_pem) của một cặp khóa chưa dùng."""
+        try:
+            pair = self._ready.get(timeout=timeout) if timeout else self._ready.get_nowait()
+            with self._lock:
+                self.claimed += 1
+        except queue.Empty:
+            with self._lock:
+                self.misses += 1
+            pair = _generate_pem(self.key_size, self.public_exponent)
+        self._wake.set()
+        return pair
+
+    # ---------- theo dõi ----------
+    @property
+    def depth(self):
+        return self._ready.qsize()
+
+    def refill_rate(self):
+        """Số cặp khóa sinh được mỗi giây (theo các lần sinh gần nhất)."""
+        with self._lock:
+            if len(self._recent) < 2:
+                return 0.0
+            return (len(self._recent) - 1) / max(self._recent[-1] - self._recent[0], 1e-9)
+
+    def stats(self):
+        rate = self.refill_rate()
+        with self._lock:
+            return {"size": self.size, "depth": self._ready.qsize(), "in_flight": self._in_flight,
+                    "generated": self.generated, "claimed": self.claimed, "misses": self.misses,
+                    "errors": self.errors, "refill_rate": rate}
+
+    def shutdown(self):
+        self._closed = True
+        self._wake.set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+
+_POOL = None
+
+def start_key_pool(size=8, workers=1, key_size=2048):
+    """Bật key pool dùng chung; generate_keys (rsq_mappingid) sẽ lấy khóa từ pool."""
+    global _POOL
+    if _POOL is None:
+        _POOL = KeyPool(size=size, workers=workers, key_size=key_size)
+    return _POOL
+
+def start_key_pool_from_env():
+    """
+    RSA_KEY_POOL_SIZE (số cặp giữ sẵn, mặc định 0 = tắt) và RSA_KEY_POOL_WORKERS
+    (số process sinh khóa, mặc định 1). Trả về pool hoặc None.
+    Tắt mặc định: process "spawn" nạp lại module __main__ của chương trình gọi (vd. GUI kéo theo
+    DeepFace/TensorFlow) → chỉ bật khi lượng phát hành đủ lớn để bù chi phí đó.
+    """
+    size = int(os.environ.get("RSA_KEY_POOL_SIZE", "0") or 0)
+    if size <= 0:
+        return None
+    return start_key_pool(size, int(os.environ.get("RSA_KEY_POOL_WORKERS", "1") or 1))
+
+def get_key_pool():
+    return _POOL
+
+def stop_key_pool():
+    global _POOL
+    if _POOL is not None:
+        _POOL.shutdown()
+        _POOL = None
+
+
+def print_stats(stats):
+    print(f"[ℹ️] Key pool: {stats['depth']}/{stats['size']} sẵn sàng, {stats['in_flight']} đang sinh | "
+          f"đã sinh {stats['generated']}, đã lấy {stats['claimed']}, miss {stats['misses']}, lỗi {stats['errors']} | "
+          f"tốc độ bù {stats['refill_rate']:.2f} cặp/giây")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Theo dõi key pool RSA (depth, tốc độ bù)")
+    parser.add_argument("--size", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--claims", type=int, default=20, help="số lần claim thử")
+    parser.add_argument("--interval", type=float, default=0.5, help="giây giữa hai lần claim")
+    args = parser.parse_args()
+
+    with KeyPool(size=args.size, workers=args.workers) as pool:
+        latencies = []
+        for _ in range(args.claims):
+            time.sleep(args.interval)
+            t0 = time.perf_counter()
+            pool.claim()
+            latencies.append(time.perf_counter() - t0)
+            print_stats(pool.stats())
+        latencies.sort()
+        print(f"Claim latency (ms): p50={latencies[len(latencies) // 2] * 1000:.2f}, "
+              f"p99={latencies[int(len(latencies) * 0.99)] * 1000:.2f}, max={latencies[-1] * 1000:.2f}")
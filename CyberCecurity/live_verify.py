@@ -0,0 +1,216 @@
+import time
+import queue
+import threading
+import cv2
+import numpy as np
+
+from face_verify_pg import get_embedding, search_gallery, match_threshold, fetch_embedding, cosine_distance, \
+    get_search_index, NotEnrolledError, ANN_CONFIG
+
+
+# ========== XÁC THỰC KHUÔN MẶT TRỰC TIẾP TỪ CAMERA ==========
+# Producer: đọc camera liên tục, chỉ giữ khung hình MỚI NHẤT (khung cũ bị bỏ nếu consumer chưa kịp xử lý).
+# Consumer: phát hiện mặt trên ảnh thu nhỏ (Haar cascade, rẻ) → cổng chất lượng → chỉ khung đạt mới
+# đi qua model embedding → so khớp gallery trong RAM. Dừng khi N khung LIÊN TIẾP cùng khớp một người.
+
+LIVE_CONFIG = {
+    "camera": 0,
+    "detect_width": 320,        # chiều rộng ảnh dùng để phát hiện mặt
+    "min_face": 80,             # cạnh nhỏ nhất của khuôn mặt (pixel, ảnh gốc)
+    "min_sharpness": 60.0,      # phương sai Laplacian của vùng mặt (thấp = mờ / rung)
+    "brightness": (40, 220),    # độ sáng trung bình chấp nhận được của vùng mặt
+    "face_margin": 0.25,        # nới khung mặt khi cắt để detector của model còn bối cảnh
+    "consecutive": 3,           # số khung liên tiếp cùng khớp để chấp nhận
+    "timeout": 15.0,            # giây
+}
+
+_CASCADE = None
+
+def _face_detector():
+    global _CASCADE
+    if _CASCADE is None:
+        _CASCADE = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
+    return _CASCADE
+
+
+def detect_face(frame, config=LIVE_CONFIG):
+    """(x, y, w, h) của khuôn mặt duy nhất trên khung gốc, hoặc (None, lý do)."""
+    h, w = frame.shape[:2]
+    scale = min(1.0, config["detect_width"] / float(w))
+    small = cv2.resize(frame, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA) if scale < 1.0 else frame
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    min_side = max(20, int(config["min_face"] * scale))
+    faces = _face_detector().detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(min_side, min_side))
+    if len(faces) == 0:
+        return None, "không thấy khuôn mặt"
+    if len(faces) > 1:
+        return None, "có nhiều hơn một khuôn mặt"
+    x, y, fw, fh = (int(round(v / scale)) for v in faces[0])
+    return (x, y, fw, fh), None
+
+
+def quality_gate(frame, box, config=LIVE_CONFIG):
+    """Vùng mặt đã cắt (có lề) nếu đủ nét/đủ sáng, ngược lại (None, lý do)."""
+    x, y, fw, fh = box
+    gray = cv2.cvtColor(frame[y:y + fh, x:x + fw], cv2.COLOR_BGR2GRAY)
+    if gray.size == 0:
+        return None, "khuôn mặt sát mép khung hình"
+    lo, hi = config["brightness"]
+    if not lo <= float(gray.mean()) <= hi:
+        return None, "ánh sáng không phù hợp"
+    if cv2.Laplacian(gray, cv2.CV_64F).var() < config["min_sharpness"]:
+        return None, "ảnh bị mờ"
+    m = int(config["face_margin"] * max(fw, fh))
+    H, W = frame.shape[:2]
+    return frame[max(0, y - m):min(H, y + fh + m), max(0, x - m):min(W, x + fw + m)].copy(), None
+
+
+class _FrameGrabber(threading.Thread):
+    """
+    Đọc camera trong thread riêng; latest() luôn trả về khung mới nhất chưa xử lý.
+    show: cửa sổ cv2 (chỉ dùng khi verify_live chạy ở main thread); on_frame(frame): xem trước bên ngoài (Tk).
+    """
+
+    def __init__(self, camera, show, on_frame=None):
+        super().__init__(name="camera-grabber", daemon=True)
+        self.camera = camera
+        self.show = show
+        self.on_frame = on_frame
+        self.status = ""
+        self.stopped = threading.Event()
+        self.user_quit = False
+        self.error = None
+        self._slot = queue.Queue(maxsize=1)
+        self.read = 0
+        self.dropped = 0
+
+    def run(self):
+        cap = cv2.VideoCapture(self.camera)
+        try:
+            if not cap.isOpened():
+                self.error = "không mở được camera"
+                return
+            while not self.stopped.is_set():
+                ret, frame = cap.read()
+                if not ret:
+                    continue
+                self.read += 1
+                try:
+                    self._slot.get_nowait()      # bỏ khung cũ chưa xử lý
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+                self._slot.put(frame)
+                if self.show or self.on_frame is not None:
+                    view = frame.copy()
+                    cv2.putText(view, self.status, (10, 25), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0), 2)
+                    if self.on_frame is not None:
+                        self.on_frame(view)
+                if self.show:
+                    cv2.imshow("Xác thực khuôn mặt", view)
+                    if cv2.waitKey(1) & 0xFF == ord('q'):
+                        self.user_quit = True
+                        break
+        finally:
+            self.stopped.set()
+            cap.release()
+            if self.show:
+                cv2.destroyAllWindows()
+
+    def latest(self, timeout=0.5):
+        return self._slot.get(timeout=timeout)
+
+
+def verify_live(threshold=None, consecutive=None, timeout=None, cancel=None, on_progress=None, show=None,
+                config=LIVE_CONFIG, claim=None, on_frame=None):
+    """
+    Xác thực từ camera không qua file tạm. Trả về (matched_id, khoảng cách trung bình) khi `consecutive`
+    khung liên tiếp cùng khớp một người (khoảng cách cosine < threshold, None → ngưỡng đã hiệu chỉnh);
+    (None, khoảng cách tốt nhất) nếu hết
+    thời gian; (None, None) nếu người dùng nhấn 'q', bị hủy, hoặc không mở được camera.
+    cancel: threading.Event (vd. Task.cancelled); on_progress(str): báo trạng thái (vd. Task.report).
+    show: cửa sổ cv2 — mặc định chỉ khi gọi từ main thread (HighGUI không an toàn ở thread khác);
+    on_frame(frame): nhận khung hình đã chú thích để xem trước ngoài cv2 (vd. CameraPreview.push).
+    claim: key_id đã biết (vd. students.face_key) → so 1:1 với đúng embedding đó thay vì tìm trong gallery;
+    raise NotEnrolledError (trước khi mở camera) nếu claim chưa đăng ký khuôn mặt.
+    """
+    threshold = match_threshold(threshold)
+    if claim is not None:
+        reference = fetch_embedding(claim)      # đọc một lần cho cả phiên camera
+        if reference is None:
+            raise NotEnrolledError(claim)
+        match = lambda emb: [(claim, cosine_distance(reference, emb))]
+    else:
+        if ANN_CONFIG["engine"] != "pgvector":
+            get_search_index()                  # lấy delta MỘT lần; từng khung chỉ tìm trong RAM
+        match = lambda emb: search_gallery(emb, k=1, refresh=False)
+    consecutive = consecutive or config["consecutive"]
+    timeout = timeout or config["timeout"]
+    if show is None:
+        show = threading.current_thread() is threading.main_thread()
+    grabber = _FrameGrabber(config["camera"], show, on_frame)
+    grabber.start()
+    streak_key, streak_dists, best = None, [], None
+    embedded = 0
+    t0 = time.perf_counter()
+
+    def report(msg):
+        grabber.status = msg
+        if on_progress:
+            on_progress(msg)
+
+    try:
+        while time.perf_counter() - t0 < timeout:
+            if (cancel is not None and cancel.is_set()) or grabber.stopped.is_set():
+                break
+            try:
+                frame = grabber.latest()
+            except queue.Empty:
+                continue
+            box, reason = detect_face(frame, config)
+            face = None
+            if box is not None:
+                face, reason = quality_gate(frame, box, config)
+            if face is None:
+                report(f"Đang chờ: {reason}")
+                continue
+
+            emb = get_embedding(face)
+            embedded += 1
+            matches = match(emb) if emb is not None else []
+            if not matches:
+                streak_key, streak_dists = None, []
+                continue
+            key, dist = matches[0]
+            best = dist if best is None else min(best, dist)
+            if dist >= threshold:
+                streak_key, streak_dists = None, []
+                report(f"Không khớp (khoảng cách {dist:.3f})")
+                continue
+            if key != streak_key:
+                streak_key, streak_dists = key, []
+            streak_dists.append(dist)
+            report(f"Khớp {key} ({len(streak_dists)}/{consecutive})")
+            if len(streak_dists) >= consecutive:
+                mean_dist = float(np.mean(streak_dists))
+                print(f"[✅] Xác thực thành công: {key} sau {time.perf_counter() - t0:.1f}s "
+                      f"({embedded} khung qua model, {grabber.read} khung đọc, {grabber.dropped} khung bỏ qua)")
+                return key, mean_dist
+    finally:
+        grabber.stopped.set()
+        grabber.join(timeout=2)
+
+    if grabber.error:
+        print(f"[❌] {grabber.error}")
+        return None, None
+    if grabber.user_quit or (cancel is not None and cancel.is_set()):
+        return None, None
+    print(f"[❌] Hết {timeout:.0f}s mà chưa đủ {consecutive} khung khớp liên tiếp.")
+    return None, best
+
+
+if __name__ == "__main__":
+    from embedding_pool import start_embedding_pool_from_env
+    start_embedding_pool_from_env()
+    matched, dist = verify_live()
+    print(f"Kết quả: {matched} ({dist})")
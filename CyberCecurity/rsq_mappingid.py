@@ -1,12 +1,108 @@
-from cryptography.hazmat.primitives.asymmetric import rsa, padding
+from cryptography.hazmat.primitives.asymmetric import rsa, padding, utils
 from cryptography.hazmat.primitives import hashes, serialization
 import re
 import os
+import hashlib
+import threading
+from collections import OrderedDict
+from key_pool import get_key_pool
+
+
+# ========== KEY STORE: cache khóa đã parse (LRU) ==========
+class KeyStore:
+    """
+    Cache LRU các đối tượng khóa đã deserialize:
+    - private key: theo đường dẫn file, tự nạp lại khi mtime/size của file thay đổi
+    - public key : theo fingerprint SHA-256 của PEM (nội dung PEM không đổi → không cần invalidate)
+    hits/misses để theo dõi hiệu quả cache.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._private = OrderedDict()   # path -> ((mtime_ns, size), key)
+        self._public = OrderedDict()    # fingerprint -> key
+        self._lock = threading.Lock()
+
+    def _remember(self, cache, k, v):
+        cache[k] = v
+        cache.move_to_end(k)
+        while len(cache) > self.maxsize:
+            cache.popitem(last=False)
+
+    def private_key(self, identifier, save_dir="keys"):
+        path = os.path.abspath(os.path.join(save_dir, f"{identifier}_private.pem"))
+        st = os.stat(path)
+        version = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            cached = self._private.get(path)
+            if cached is not None and cached[0] == version:
+                self.hits += 1
+                self._private.move_to_end(path)
+                return cached[1]
+            self.misses += 1
+        with open(path, "rb") as f:
+            key = serialization.load_pem_private_key(f.read(), password=None)
+        with self._lock:
+            self._remember(self._private, path, (version, key))
+        return key
+
+    def put_private(self, path, key):
+        """Đưa khóa vừa sinh vào cache (tránh đọc lại file ngay sau generate_keys)."""
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        with self._lock:
+            self._remember(self._private, path, ((st.st_mtime_ns, st.st_size), key))
+
+    def public_key(self, public_key_pem):
+        pem = bytes(public_key_pem)
+        fp = hashlib.sha256(pem).digest()
+        with self._lock:
+            key = self._public.get(fp)
+            if key is not None:
+                self.hits += 1
+                self._public.move_to_end(fp)
+                return key
+            self.misses += 1
+        key = serialization.load_pem_public_key(pem)
+        with self._lock:
+            self._remember(self._public, fp, key)
+        return key
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "private": len(self._private), "public": len(self._public)}
+
+    def clear(self):
+        with self._lock:
+            self._private.clear()
+            self._public.clear()
+            self.hits = self.misses = 0
+
+
+KEY_STORE = KeyStore()
 
 
 def generate_keys(school_id, student_id, save_dir="keys"):
     identifier = f"{school_id}_{student_id}"
 
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+    private_path = os.path.join(save_dir, f"{identifier}_private.pem")
+
+    pool = get_key_pool()
+    if pool is not None:
+        # Lấy cặp khóa sinh sẵn (PEM) — không tốn thời gian sinh số nguyên tố trên đường phát hành
+        private_pem, pem_public_key = pool.claim()
+        with open(private_path, "wb") as f:
+            f.write(private_pem)
+        # ghi đè file cũ có thể giữ nguyên mtime/size → cập nhật LRU ngay, không chờ phát hiện thay đổi
+        KEY_STORE.put_private(private_path, serialization.load_pem_private_key(private_pem, password=None))
+        print(f"✅ Private key saved at: {private_path}")
+        return identifier, pem_public_key
+
     # Tạo private/public key
     private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
     public_key = private_key.public_key()
@@ -17,10 +113,6 @@ def generate_keys(school_id, student_id, save_dir="keys"):
     )
 
     # Serialize private key và lưu vào file local (bảo mật)
-    if not os.path.exists(save_dir):
-        os.makedirs(save_dir)
-
-    private_path = os.path.join(save_dir, f"{identifier}_private.pem")
     with open(private_path, "wb") as f:
         f.write(
             private_key.private_bytes(
@@ -30,24 +122,77 @@ def generate_keys(school_id, student_id, save_dir="keys"):
             )
         )
 
+    KEY_STORE.put_private(private_path, private_key)
     print(f"✅ Private key saved at: {private_path}")
 
     return identifier, pem_public_key
 
 
-def get_clean_content(file_path):
-    with open(file_path, 'r', encoding='utf-8') as f:
-        content = f.read()
-    cleaned = re.findall(r"[\wÀ-ỹ]+", content)
+CLEAN_PATTERN = re.compile(r"[\wÀ-ỹ]+")
+CHUNK_CHARS = 1 << 20   # số ký tự mỗi lần đọc khi stream file
+
+
+def clean_content(content):
+    cleaned = CLEAN_PATTERN.findall(content)
     cleaned_text = "".join(cleaned)  # chỉ lấy chữ & số
     message = content.encode("utf-8")  # bản gốc để ký
     return cleaned_text, message
 
 
+def read_certificate(file_path):
+    """Đọc file MỘT lần → (certificate_text, cleaned_text, message)."""
+    with open(file_path, 'r', encoding='utf-8') as f:
+        content = f.read()
+    cleaned_text, message = clean_content(content)
+    return content, cleaned_text, message
+
+
+def get_clean_content(file_path):
+    _, cleaned_text, message = read_certificate(file_path)
+    return cleaned_text, message
+
+
+def stream_certificate(file_path, keep_cleaned=True, chunk_chars=CHUNK_CHARS):
+    """
+    Đọc file theo từng khúc → (digest SHA-256 của message, cleaned_text hoặc None).
+    digest == sha256(content.encode("utf-8")) của read_certificate: cùng chế độ text
+    (newline chuẩn hóa như f.read()) và UTF-8 ghép nối theo khúc cho ra cùng dãy byte.
+    Chỉ giữ một khúc trong bộ nhớ; keep_cleaned=False → bộ nhớ không phụ thuộc kích thước file.
+    """
+    hasher = hashlib.sha256()
+    parts = [] if keep_cleaned else None
+    with open(file_path, 'r', encoding='utf-8') as f:
+        while True:
+            chunk = f.read(chunk_chars)
+            if not chunk:
+                break
+            hasher.update(chunk.encode("utf-8"))
+            if parts is not None:
+                # lớp ký tự không phụ thuộc ngữ cảnh → ghép kết quả từng khúc == kết quả cả file
+                parts.append("".join(CLEAN_PATTERN.findall(chunk)))
+    return hasher.digest(), ("".join(parts) if parts is not None else None)
+
+
+def file_digest(file_path):
+    digest, _ = stream_certificate(file_path, keep_cleaned=False)
+    return digest
+
+
+def load_or_generate_keys(school_id, student_id, save_dir="keys"):
+    """Dùng lại private key đã có trong save_dir (suy ra public PEM), chưa có thì sinh mới."""
+    identifier = f"{school_id}_{student_id}"
+    if os.path.exists(os.path.join(save_dir, f"{identifier}_private.pem")):
+        private_key = KEY_STORE.private_key(identifier, save_dir)
+        pem_public_key = private_key.public_key().public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+        return identifier, pem_public_key
+    return generate_keys(school_id, student_id, save_dir)
+
+
 def sign_message(identifier, message, save_dir="keys"):
-    private_path = os.path.join(save_dir, f"{identifier}_private.pem")
-    with open(private_path, "rb") as f:
-        private_key = serialization.load_pem_private_key(f.read(), password=None)
+    private_key = KEY_STORE.private_key(identifier, save_dir)   # cache, tự nạp lại khi file đổi
 
     signature = private_key.sign(
         message,
@@ -60,8 +205,25 @@ def sign_message(identifier, message, save_dir="keys"):
     return signature
 
 
+def sign_digest(identifier, digest, save_dir="keys"):
+    """Ký digest SHA-256 đã tính sẵn (Prehashed) — chữ ký giống hệt sign_message trên toàn bộ message."""
+    private_key = KEY_STORE.private_key(identifier, save_dir)
+    return private_key.sign(
+        digest,
+        padding.PSS(
+            mgf=padding.MGF1(hashes.SHA256()),
+            salt_length=padding.PSS.MAX_LENGTH
+        ),
+        utils.Prehashed(hashes.SHA256())
+    )
+
+
+def sign_file(identifier, file_path, save_dir="keys"):
+    return sign_digest(identifier, file_digest(file_path), save_dir)
+
+
 def verify_signature(public_key_pem, signature, message):
-    public_key = serialization.load_pem_public_key(public_key_pem)
+    public_key = KEY_STORE.public_key(public_key_pem)
     try:
         public_key.verify(
             signature,
@@ -77,6 +239,28 @@ def verify_signature(public_key_pem, signature, message):
         return False
 
 
+def verify_digest(public_key_pem, signature, digest):
+    """Verify chữ ký (kể cả chữ ký cũ tạo bằng sign_message) với digest SHA-256 của message."""
+    public_key = KEY_STORE.public_key(public_key_pem)
+    try:
+        public_key.verify(
+            signature,
+            digest,
+            padding.PSS(
+                mgf=padding.MGF1(hashes.SHA256()),
+                salt_length=padding.PSS.MAX_LENGTH
+            ),
+            utils.Prehashed(hashes.SHA256())
+        )
+        return True
+    except Exception:
+        return False
+
+
+def verify_file(public_key_pem, signature, file_path):
+    """Verify file theo luồng: bộ nhớ cố định bất kể kích thước file."""
+    return verify_digest(public_key_pem, signature, file_digest(file_path))
+
 
 if __name__ ==  '__main__':
     school_id = "PKA"
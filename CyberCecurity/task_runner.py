@@ -0,0 +1,233 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import tkinter as tk
+from tkinter import ttk, messagebox
+from PIL import Image, ImageTk
+
+
+# ========== CHẠY TÁC VỤ NỀN CHO TKINTER ==========
+# Camera, embedding, verify, DB, sinh khóa RSA chạy trên thread pool; kết quả được đưa
+# về Tk main loop qua một hàng đợi được poll bằng after() → cửa sổ không bị "đơ".
+
+class Task:
+    """Một tác vụ nền. Hàm chạy nền (with_task=True) có thể gọi task.report(...) và kiểm tra task.cancelled."""
+
+    def __init__(self, runner):
+        self._runner = runner
+        self.cancelled = threading.Event()
+        self.future = None
+        self._cancel_callbacks = []
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled.set()
+            callbacks, self._cancel_callbacks = self._cancel_callbacks, []
+            for fn in callbacks:
+                try:
+                    fn()
+                except Exception:
+                    pass
+        if self.future is not None:
+            self.future.cancel()
+        self._runner._discard(self)
+
+    def on_cancel(self, fn):
+        """
+        Đăng ký fn gọi khi task bị hủy (vd. conn.cancel để dừng truy vấn đang chạy).
+        Trả về hàm gỡ đăng ký — gọi trước khi tài nguyên (kết nối) được trả lại pool.
+        """
+        with self._lock:
+            if self.cancelled.is_set():
+                fn()
+                return lambda: None
+            self._cancel_callbacks.append(fn)
+
+        def remove():
+            with self._lock:
+                if fn in self._cancel_callbacks:
+                    self._cancel_callbacks.remove(fn)
+        return remove
+
+    def report(self, message):
+        """Gửi thông báo tiến độ về giao diện (gọi được từ thread nền)."""
+        self._runner._queue.put(("progress", self, message))
+
+
+class BusyDialog(tk.Toplevel):
+    """Hộp thoại 'đang xử lý' với thanh tiến trình và nút Hủy."""
+
+    def __init__(self, root, message, on_cancel=None):
+        super().__init__(root)
+        self.title("Đang xử lý")
+        self.resizable(False, False)
+        self.transient(root)
+        self.protocol("WM_DELETE_WINDOW", on_cancel or (lambda: None))
+        self.label = ttk.Label(self, text=message, font=("Verdana", 11), wraplength=360)
+        self.label.pack(padx=20, pady=(15, 5))
+        bar = ttk.Progressbar(self, mode="indeterminate", length=300)
+        bar.pack(padx=20, pady=5)
+        bar.start(15)
+        if on_cancel:
+            ttk.Button(self, text="Hủy", command=on_cancel).pack(pady=(5, 15))
+
+    def set_message(self, message):
+        self.label.config(text=message)
+
+
+class CameraPreview(tk.Toplevel):
+    """
+    Khung xem trước camera vẽ bằng Tk: thread nền gọi push(frame BGR), main loop lấy khung mới nhất
+    qua after(). Thay cho cv2.imshow/waitKey — HighGUI không an toàn ngoài main thread (macOS, bản Qt).
+    capture_label → thêm nút chụp, bấm sẽ set sự kiện `capture` cho thread nền.
+    """
+
+    def __init__(self, root, title, on_cancel=None, capture_label=None, width=480, poll_ms=40):
+        super().__init__(root)
+        self.title(title)
+        self.resizable(False, False)
+        self.transient(root)
+        self.protocol("WM_DELETE_WINDOW", on_cancel or (lambda: None))
+        self.width = width
+        self.poll_ms = poll_ms
+        self.capture = threading.Event()
+        self._latest = None
+        self._lock = threading.Lock()
+        self._photo = None
+        self._closed = False
+        self.image_label = ttk.Label(self, text="Đang mở camera...")
+        self.image_label.pack(padx=10, pady=10)
+        self.status = ttk.Label(self, text="", font=("Verdana", 10), wraplength=width)
+        self.status.pack(padx=10)
+        buttons = ttk.Frame(self)
+        buttons.pack(pady=10)
+        if capture_label:
+            ttk.Button(buttons, text=capture_label, command=self.capture.set).pack(side="left", padx=5)
+        if on_cancel:
+            ttk.Button(buttons, text="Hủy", command=on_cancel).pack(side="left", padx=5)
+        self.after(self.poll_ms, self._poll)
+
+    def push(self, frame):
+        """Gọi từ thread nền: chỉ giữ khung mới nhất, không đụng tới Tk."""
+        with self._lock:
+            self._latest = frame
+
+    def set_status(self, message):
+        if not self._closed:
+            self.status.config(text=message)
+
+    def _poll(self):
+        if self._closed:
+            return
+        self.after(self.poll_ms, self._poll)
+        with self._lock:
+            frame, self._latest = self._latest, None
+        if frame is None:
+            return
+        image = Image.fromarray(frame[:, :, ::-1])          # BGR → RGB
+        image.thumbnail((self.width, self.width))
+        self._photo = ImageTk.PhotoImage(image)             # giữ tham chiếu, nếu không Tk sẽ vẽ ảnh trống
+        self.image_label.config(image=self._photo, text="")
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self.destroy()
+
+
+class TaskRunner:
+    """
+    submit(fn, *args, on_done=..., on_error=..., busy="...") chạy fn trên thread pool;
+    on_done/on_error/on_progress luôn được gọi trên Tk main loop.
+    """
+
+    def __init__(self, root, max_workers=4, poll_ms=50):
+        self.root = root
+        self.poll_ms = poll_ms
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="gui-task")
+        self._queue = queue.Queue()
+        self._handlers = {}
+        self._poll()
+
+    @property
+    def active(self):
+        return len(self._handlers)
+
+    def submit(self, fn, *args, on_done=None, on_error=None, on_progress=None, busy=None,
+               with_task=False, **kwargs):
+        task = Task(self)
+        dialog = BusyDialog(self.root, busy, on_cancel=task.cancel) if busy else None
+        self._handlers[task] = (on_done, on_error, on_progress, dialog)
+
+        def run():
+            if task.cancelled.is_set():
+                return
+            try:
+                result = fn(task, *args, **kwargs) if with_task else fn(*args, **kwargs)
+                self._queue.put(("done", task, result))
+            except Exception as e:
+                self._queue.put(("error", task, e))
+
+        task.future = self._executor.submit(run)
+        return task
+
+    def submit_camera(self, fn, *args, title, on_done=None, capture_label=None, **kwargs):
+        """
+        Như submit(with_task=True) nhưng mở CameraPreview trên main thread; fn(task, preview, *args)
+        đẩy khung hình bằng preview.push. Cửa sổ xem trước đóng khi xong, lỗi hoặc bấm Hủy.
+        """
+        holder = {}
+
+        def cancel():
+            holder["task"].cancel()
+            preview.close()
+
+        def finish(handler, value):
+            preview.close()
+            handler(value)
+
+        preview = CameraPreview(self.root, title, on_cancel=cancel, capture_label=capture_label)
+        holder["task"] = self.submit(
+            fn, preview, *args, with_task=True,
+            on_done=lambda res: finish(on_done or (lambda _: None), res),
+            on_error=lambda e: finish(lambda err: messagebox.showerror("Lỗi", f"Đã xảy ra lỗi: {err}"), e),
+            on_progress=preview.set_status, **kwargs)
+        return holder["task"]
+
+    def _discard(self, task):
+        handlers = self._handlers.pop(task, None)
+        if handlers and handlers[3] is not None:
+            handlers[3].destroy()
+
+    def _poll(self):
+        # lên lịch lần poll sau TRƯỚC khi gọi callback: callback có thể mở messagebox (vòng lặp lồng)
+        self.root.after(self.poll_ms, self._poll)
+        try:
+            while True:
+                kind, task, payload = self._queue.get_nowait()
+                handlers = self._handlers.get(task)
+                if handlers is None:          # đã hủy → bỏ kết quả
+                    continue
+                on_done, on_error, on_progress, dialog = handlers
+                if kind == "progress":
+                    if dialog is not None:
+                        dialog.set_message(payload)
+                    if on_progress:
+                        on_progress(payload)
+                    continue
+                self._discard(task)
+                if kind == "done":
+                    if on_done:
+                        on_done(payload)
+                elif on_error:
+                    on_error(payload)
+                else:
+                    messagebox.showerror("Lỗi", f"Đã xảy ra lỗi: {payload}")
+        except queue.Empty:
+            pass
+
+    def shutdown(self):
+        for task in list(self._handlers):
+            task.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Các module trong CyberCecurity/ import lẫn nhau bằng tên trần (chạy từ chính thư mục đó)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "CyberCecurity"))
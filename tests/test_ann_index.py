@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from ann_index import INDEX_TYPES, load_index
+
+
+def _unit(rng, n, dim):
+    mat = rng.standard_normal((n, dim)).astype(np.float32)
+    return mat / np.linalg.norm(mat, axis=1, keepdims=True)
+
+
+@pytest.fixture(params=[("sq8", {}), ("pq", {"m": 8})], ids=["sq8", "pq"])
+def quantized(request):
+    kind, params = request.param
+    rng = np.random.default_rng(0)
+    keys = [f"PKA_{i:05d}" for i in range(2000)]
+    matrix = _unit(rng, len(keys), 32)
+    index = INDEX_TYPES[kind](**params).build(keys, matrix)
+    index.rerank_source = lambda ks: {k: matrix[int(k[4:])] for k in ks if k.startswith("PKA_")}
+    return index, keys, matrix, rng
+
+
+def test_upsert_remove_and_longer_keys(quantized):
+    index, keys, matrix, rng = quantized
+    vec = _unit(rng, 1, 32)[0]
+    index.upsert("NEW_STUDENT_WITH_LONG_KEY", vec)
+    assert "NEW_STUDENT_WITH_LONG_KEY" in index and len(index) == 2001
+    assert index.search(vec, k=1, rerank=0)[0][0] == "NEW_STUDENT_WITH_LONG_KEY"
+
+    assert index.remove("PKA_00007")
+    assert "PKA_00007" not in index and not index.remove("PKA_00007")
+    for key in keys[10:1500]:   # đủ nhiều để compact()
+        index.remove(key)
+    assert len(index) == 2001 - 1491
+    assert "PKA_01999" in index and "PKA_00020" not in index and "NEW_STUDENT_WITH_LONG_KEY" in index
+    assert index.search(matrix[1999], k=1)[0][0] == "PKA_01999"
+
+
+def test_save_load_roundtrip(quantized, tmp_path):
+    index, keys, matrix, _ = quantized
+    index.remove("PKA_00003")
+    path = str(tmp_path / "quant.npz")
+    index.save(path)
+    loaded = load_index(path)
+    assert loaded.params["trained_on"] == len(keys)
+    assert sorted(loaded.keys.tolist()) == sorted(index.keys.tolist())
+    assert "PKA_00003" not in loaded and "PKA_00004" in loaded
+
+
+def test_load_chunks_with_sample(quantized):
+    index, keys, matrix, rng = quantized
+    fresh = type(index)(**{**index.params, "trained_on": 0})
+    chunks = ((keys[s:s + 300], matrix[s:s + 300]) for s in range(0, len(keys), 300))
+    assert fresh.load_chunks(chunks, sample=matrix[rng.choice(len(keys), 500, replace=False)]) == len(keys)
+    assert fresh.trained_on == 500
+    assert fresh.search(matrix[42], k=1, rerank=0)[0][0] == "PKA_00042"
+    stats = fresh.memory_stats()
+    assert stats["bytes_per_identity"] < stats["float_bytes"]
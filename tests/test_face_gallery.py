@@ -0,0 +1,42 @@
+import numpy as np
+
+from face_gallery import FaceGallery
+from gallery_snapshot import write_snapshot, read_snapshot
+
+
+def _unit(rng, n, dim):
+    mat = rng.standard_normal((n, dim)).astype(np.float32)
+    return mat / np.linalg.norm(mat, axis=1, keepdims=True)
+
+
+def test_upsert_existing_key_after_snapshot_load(tmp_path):
+    rng = np.random.default_rng(0)
+    keys = [f"K{i}" for i in range(5)]
+    matrix = _unit(rng, 5, 8)
+    path = str(tmp_path / "gallery.snap")
+    write_snapshot(path, keys, matrix, normalized=True)
+    on_disk = open(path, "rb").read()
+
+    snap_keys, snap_matrix, _ = read_snapshot(path)
+    gallery = FaceGallery(metric="cosine").load_arrays(snap_keys, snap_matrix)
+    new = _unit(rng, 1, 8)[0]
+    gallery.upsert("K2", new)
+
+    np.testing.assert_allclose(gallery.get("K2"), new)
+    np.testing.assert_allclose(gallery.get("K3"), matrix[3])
+    assert gallery.search(new, k=1)[0][0] == "K2"
+    assert len(gallery) == 5
+    assert open(path, "rb").read() == on_disk   # snapshot trên đĩa không bị ghi đè
+
+
+def test_remove_after_snapshot_load(tmp_path):
+    rng = np.random.default_rng(1)
+    keys = ["A", "B", "C"]
+    matrix = _unit(rng, 3, 4)
+    path = str(tmp_path / "gallery.snap")
+    write_snapshot(path, keys, matrix, normalized=True)
+
+    gallery = FaceGallery(metric="cosine").load_arrays(*read_snapshot(path)[:2])
+    assert gallery.remove("A")
+    assert "A" not in gallery and len(gallery) == 2
+    np.testing.assert_allclose(gallery.get("C"), matrix[2])
@@ -0,0 +1,73 @@
+from contextlib import contextmanager
+
+import numpy as np
+import pytest
+
+psycopg2 = pytest.importorskip("psycopg2")
+pytest.importorskip("cv2")
+pytest.importorskip("deepface")
+
+import psycopg2.errors  # noqa: E402
+import face_verify_pg  # noqa: E402
+
+
+class FakeCursor:
+    """Cursor giả: raise `error` ở câu truy vấn top-k, ngược lại trả về `rows`."""
+
+    def __init__(self, rows=(), error=None, unnormalized=None):
+        self.rows = list(rows)
+        self.error = error
+        self.unnormalized = unnormalized   # key_id trả về cho câu kiểm tra vector_norm
+        self.queries = 0
+
+    def execute(self, sql, params=None):
+        if "ORDER BY" in sql:
+            self.queries += 1
+            if self.error is not None:
+                raise self.error
+
+    def fetchone(self):
+        return None if self.unnormalized is None else (self.unnormalized,)
+
+    def fetchall(self):
+        return self.rows
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    state = {"cursor": FakeCursor()}
+
+    @contextmanager
+    def transaction():
+        yield state["cursor"]
+
+    monkeypatch.setattr(face_verify_pg, "transaction", transaction)
+    monkeypatch.setattr(face_verify_pg, "_PGVECTOR_OK", None)
+    return state
+
+
+def test_transient_error_falls_back_once(fake_db):
+    fake_db["cursor"] = FakeCursor(error=psycopg2.errors.QueryCanceled("statement timeout"))
+    assert face_verify_pg.search_pgvector(np.ones(4, dtype=np.float32)) is None
+    assert face_verify_pg._PGVECTOR_OK is not False
+
+    fake_db["cursor"] = FakeCursor(rows=[("PKA_1", 0.5)])
+    assert face_verify_pg.search_pgvector(np.ones(4, dtype=np.float32)) == [("PKA_1", 0.5)]
+    assert face_verify_pg._PGVECTOR_OK is True
+
+
+def test_missing_column_disables_pgvector(fake_db):
+    fake_db["cursor"] = FakeCursor(error=psycopg2.errors.UndefinedColumn("column embedding_vec does not exist"))
+    assert face_verify_pg.search_pgvector(np.ones(4, dtype=np.float32)) is None
+    assert face_verify_pg._PGVECTOR_OK is False
+
+    fake_db["cursor"] = cur = FakeCursor(rows=[("PKA_1", 0.5)])
+    assert face_verify_pg.search_pgvector(np.ones(4, dtype=np.float32)) is None
+    assert cur.queries == 0
+
+
+def test_unnormalized_rows_disable_pgvector(fake_db):
+    fake_db["cursor"] = cur = FakeCursor(rows=[("PKA_1", 0.5)], unnormalized="PKA_OLD")
+    assert face_verify_pg.search_pgvector(np.ones(4, dtype=np.float32)) is None
+    assert face_verify_pg._PGVECTOR_OK is False
+    assert cur.queries == 0